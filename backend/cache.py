@@ -0,0 +1,85 @@
+import hashlib
+from datetime import datetime, timedelta
+from decouple import config
+from database import db
+
+# Persistente Caches in MongoDB, damit alle uvicorn-Worker dieselben Treffer sehen.
+# Abgelaufene Einträge entfernt der TTL-Index, bei zu vielen Einträgen werden die
+# am längsten nicht gelesenen gelöscht.
+
+EVICT_EVERY = config("CACHE_EVICT_EVERY", default=100, cast=int)
+
+
+def make_key(*parts) -> str:
+    return hashlib.sha256("\x1f".join(str(p) for p in parts).encode()).hexdigest()
+
+
+def prompt_version(prompt: str) -> str:
+    # Kurzer Hash des Prompts: Prompt-Änderungen machen alte Einträge unerreichbar
+    return hashlib.sha256(prompt.encode()).hexdigest()[:12]
+
+
+class MongoCache:
+    def __init__(self, collection, ttl_seconds: int, max_entries: int):
+        self.collection = collection
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.max_entries = max_entries
+        self._writes = 0
+
+    async def get(self, key: str):
+        now = datetime.utcnow()
+        doc = await self.collection.find_one_and_update(
+            {"_id": key, "expires_at": {"$gt": now}},
+            {"$set": {"accessed_at": now}, "$inc": {"hits": 1}},
+            projection={"value": 1}
+        )
+        return doc["value"] if doc else None
+
+    async def set(self, key: str, value, **meta):
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"_id": key},
+            {"$set": {
+                "value": value,
+                "created_at": now,
+                "accessed_at": now,
+                "expires_at": now + self.ttl,
+                **meta
+            }, "$setOnInsert": {"hits": 0}},
+            upsert=True
+        )
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            await self.evict()
+
+    async def evict(self):
+        excess = await self.collection.estimated_document_count() - self.max_entries
+        if excess <= 0:
+            return
+        cursor = self.collection.find({}, {"_id": 1}).sort("accessed_at", 1).limit(excess)
+        ids = [doc["_id"] async for doc in cursor]
+        await self.collection.delete_many({"_id": {"$in": ids}})
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+        await self.collection.create_index("accessed_at")
+
+
+identification_cache = MongoCache(
+    db["identification_cache"],
+    ttl_seconds=config("IDENTIFICATION_CACHE_TTL", default=30 * 24 * 3600, cast=int),
+    max_entries=config("IDENTIFICATION_CACHE_MAX_ENTRIES", default=100_000, cast=int),
+)
+
+listing_cache = MongoCache(
+    db["listing_cache"],
+    ttl_seconds=config("LISTING_CACHE_TTL", default=30 * 24 * 3600, cast=int),
+    max_entries=config("LISTING_CACHE_MAX_ENTRIES", default=100_000, cast=int),
+)
+
+# Rohantworten der Kleinanzeigen-Suche je (normalisierter Suchbegriff, Limit)
+comparables_cache = MongoCache(
+    db["comparables_cache"],
+    ttl_seconds=config("COMPARABLES_CACHE_TTL", default=6 * 3600, cast=int),
+    max_entries=config("COMPARABLES_CACHE_SIZE", default=5000, cast=int),
+)
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import re
+from collections import Counter
+from datetime import datetime, timedelta
+from decouple import config
+from pymongo import UpdateOne
+from database import catalog_collection, market_collection
+
+# In-Memory-Katalog kanonischer Marken und Modelle. Freitext aus der Bilderkennung
+# oder von Nutzern ("Apple iPhone 12 Pro", "iphone 12pro", "Apple / iPhone 12 Pro 128GB")
+# wird auf einen gemeinsamen Produktschlüssel abgebildet, damit Caches und die
+# Vergleichssuche dieselben Treffer teilen. Der Katalog wächst mit jeder Identifikation
+# und jeder gespeicherten Vergleichsanzeige.
+# Jeder Worker-Prozess hält eine eigene Kopie; neue Einträge werden in der Collection
+# "catalog" gespeichert und alle CATALOG_SYNC_INTERVAL Sekunden zwischen den Workern abgeglichen.
+
+CATALOG_BRAND_THRESHOLD = config("CATALOG_BRAND_THRESHOLD", default=0.5, cast=float)
+CATALOG_MODEL_THRESHOLD = config("CATALOG_MODEL_THRESHOLD", default=0.6, cast=float)
+CATALOG_WARMUP_LIMIT = config("CATALOG_WARMUP_LIMIT", default=50_000, cast=int)
+CATALOG_SYNC_INTERVAL = config("CATALOG_SYNC_INTERVAL", default=30.0, cast=float)
+
+_CAPACITY_RE = re.compile(r"\b\d+\s?(?:gb|tb|mb)\b")
+_BOUNDARY_RE = re.compile(r"(?<=\d)(?=[^\W\d])|(?<=[^\W\d])(?=\d)")
+_SPLIT_RE = re.compile(r"[\W_]+")
+
+
+def normalize(text) -> str:
+    # Kleinschreibung, Speichergrößen entfernen, "12pro" -> "12 pro", Trennzeichen vereinheitlichen
+    text = _CAPACITY_RE.sub(" ", str(text or "").casefold())
+    text = _BOUNDARY_RE.sub(" ", text)
+    return " ".join(t for t in _SPLIT_RE.split(text) if t)
+
+
+def _trigrams(key: str) -> set[str]:
+    padded = f" {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _model_token(tokens: list[str], i: int) -> bool:
+    # Teil der Modellbezeichnung: Zahl, Kürzel bis 2 Zeichen ("s", "a", "se") oder
+    # Buchstabenfolge bis 3 Zeichen direkt an einer Zahl ("5 ds", "gtx 1080")
+    token = tokens[i]
+    if token.isdigit() or len(token) <= 2:
+        return True
+    return len(token) <= 3 and any(0 <= j < len(tokens) and tokens[j].isdigit() for j in (i - 1, i + 1))
+
+
+def _shape(key: str) -> tuple:
+    # Anzahl Tokens und alle Modell-Tokens müssen für einen Treffer exakt übereinstimmen,
+    # unscharf verglichen wird nur die Schreibweise der übrigen Wörter
+    tokens = key.split()
+    return len(tokens), tuple(t if _model_token(tokens, i) else None for i, t in enumerate(tokens))
+
+
+class _FuzzyIndex:
+    # Trigramm-Index für Tippfehler. Token-Anzahl und Modell-Tokens müssen exakt übereinstimmen,
+    # damit "iphone 12" weder auf "iphone 13" noch auf "iphone 12 mini" und "galaxy a 21"
+    # nicht auf "galaxy s 21" fällt
+    def __init__(self):
+        self.sizes: dict[str, int] = {}
+        self.grams: dict[str, set[str]] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.sizes
+
+    def add(self, key: str):
+        if not key or key in self.sizes:
+            return
+        grams = _trigrams(key)
+        self.sizes[key] = len(grams)
+        for gram in grams:
+            self.grams.setdefault(gram, set()).add(key)
+
+    def match(self, key: str, threshold: float) -> str | None:
+        if not key:
+            return None
+        if key in self.sizes:
+            return key
+        grams = _trigrams(key)
+        shared = Counter(c for g in grams for c in self.grams.get(g, ()))
+        shape = _shape(key)
+        best, best_score = None, threshold
+        for candidate, common in shared.items():
+            score = common / (len(grams) + self.sizes[candidate] - common)
+            if score >= best_score and _shape(candidate) == shape:
+                best, best_score = candidate, score
+        return best
+
+
+_brands = _FuzzyIndex()
+_models: dict[str, _FuzzyIndex] = {}
+# Modell -> Marke, um fehlende Marken zu ergänzen
+_model_brand: dict[str, str] = {}
+# In diesem Prozess gelernt, noch nicht gespeichert
+_unsaved: set[tuple[str, str]] = set()
+_synced_at: datetime | None = None
+_task: asyncio.Task | None = None
+logger = logging.getLogger(__name__)
+
+
+def canonical(brand, model) -> tuple[str, str]:
+    b = normalize(brand)
+    b = _brands.match(b, CATALOG_BRAND_THRESHOLD) or b
+    m = normalize(model)
+
+    # Marke am Modellanfang entfernen ("apple iphone 12" -> "iphone 12")
+    if b and m.startswith(b + " "):
+        m = m[len(b) + 1:]
+    if not b:
+        b = _model_brand.get(m, "")
+
+    if b in _models:
+        m = _models[b].match(m, CATALOG_MODEL_THRESHOLD) or m
+    return b, m
+
+
+def product_key(brand, model) -> str:
+    return " ".join(p for p in canonical(brand, model) if p)
+
+
+def learn(brand, model) -> str:
+    b, m = canonical(brand, model)
+    if b and _add(b, m):
+        _unsaved.add((b, m))
+    return " ".join(p for p in (b, m) if p)
+
+
+def _add(b: str, m: str) -> bool:
+    # Kanonische Einträge übernehmen; True, wenn Marke oder Modell neu sind
+    new = b not in _brands or bool(m) and (b not in _models or m not in _models[b])
+    _brands.add(b)
+    if m:
+        _models.setdefault(b, _FuzzyIndex()).add(m)
+        _model_brand.setdefault(m, b)
+    return new
+
+
+async def _flush():
+    if not _unsaved:
+        return
+    entries = list(_unsaved)
+    _unsaved.clear()
+    now = datetime.utcnow()
+    try:
+        await catalog_collection.bulk_write([
+            UpdateOne({"_id": f"{b}|{m}"},
+                      {"$setOnInsert": {"brand": b, "model": m, "created_at": now}},
+                      upsert=True)
+            for b, m in entries
+        ], ordered=False)
+    except Exception:
+        _unsaved.update(entries)
+        raise
+
+
+async def sync():
+    # Eigene Einträge speichern, Einträge der anderen Worker übernehmen.
+    # Überlappendes Zeitfenster, damit spät geschriebene Einträge nicht fehlen.
+    global _synced_at
+    await _flush()
+    now = datetime.utcnow()
+    query = {}
+    if _synced_at is not None:
+        query["created_at"] = {"$gte": _synced_at - timedelta(seconds=2 * CATALOG_SYNC_INTERVAL)}
+    async for doc in catalog_collection.find(query, {"brand": 1, "model": 1}).limit(CATALOG_WARMUP_LIMIT):
+        _add(doc["brand"], doc["model"])
+    _synced_at = now
+
+
+async def warm_up():
+    # Katalog beim Start aus dem lokalen Preisindex und den gespeicherten Einträgen aufbauen
+    cursor = market_collection.aggregate([
+        {"$group": {"_id": {"brand": "$brand", "model": "$model_or_type"}}},
+        {"$limit": CATALOG_WARMUP_LIMIT}
+    ])
+    async for doc in cursor:
+        # Steht schon im Preisindex, muss nicht in "catalog" gespeichert werden
+        b, m = canonical(doc["_id"].get("brand"), doc["_id"].get("model"))
+        if b:
+            _add(b, m)
+    await sync()
+
+
+async def _loop():
+    while True:
+        await asyncio.sleep(CATALOG_SYNC_INTERVAL)
+        try:
+            await sync()
+        except Exception:
+            logger.warning("Katalog-Abgleich fehlgeschlagen", exc_info=True)
+
+
+def start():
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_loop())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    await _flush()
+
+
+async def ensure_indexes():
+    await catalog_collection.create_index("created_at")
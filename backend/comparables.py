@@ -0,0 +1,110 @@
+import asyncio
+import httpx
+from decouple import config
+from cache import comparables_cache, make_key
+from upstream import Upstream
+
+# Client für die Kleinanzeigen-Suche: ein Verbindungspool pro Worker-Prozess, Timeouts
+# mit Wiederholungen, ein gemeinsamer TTL-Cache in MongoDB je (normalisierter
+# Suchbegriff, Limit) für alle Worker und Single-Flight, damit gleichzeitige gleiche
+# Suchen im Prozess nur eine Upstream-Anfrage auslösen.
+# Rate-Limit, Circuit Breaker und Backoff übernimmt die gemeinsame Zugangskontrolle.
+
+# Für Lasttests auf tools/kleinanzeigen_standin.py umstellbar
+SEARCH_URL = config("KLEINANZEIGEN_SEARCH_URL", default="https://api.kleinanzeigen-agent.de/ads/v1/kleinanzeigen/search")
+
+COMPARABLES_TIMEOUT = config("COMPARABLES_TIMEOUT", default=10.0, cast=float)
+COMPARABLES_RETRIES = config("COMPARABLES_RETRIES", default=2, cast=int)
+COMPARABLES_CONCURRENCY = config("COMPARABLES_CONCURRENCY", default=20, cast=int)
+COMPARABLES_RPM = config("COMPARABLES_RPM", default=300, cast=int)
+
+# Vorübergehende Fehler, bei denen sich ein erneuter Versuch lohnt
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Wird im Lifespan der App angelegt (connect/close)
+_client: httpx.AsyncClient | None = None
+
+ads_upstream = Upstream("Kleinanzeigen-Suche", concurrency=COMPARABLES_CONCURRENCY, rpm=COMPARABLES_RPM)
+
+_inflight: dict[str, asyncio.Task] = {}
+
+
+class ComparablesError(Exception):
+    pass
+
+
+class _Transient(Exception):
+    # Vorübergehender Fehler (Netzwerk, 429, 5xx): wird von ads_upstream wiederholt
+    def __init__(self, message: str, response: httpx.Response | None = None):
+        super().__init__(message)
+        self.response = response
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.casefold().split())
+
+
+async def _get(params: dict) -> dict:
+    try:
+        response = await _client.get(SEARCH_URL, params=params)
+    except httpx.TransportError as e:
+        raise _Transient(f"Suche nicht erreichbar: {e}")
+    if response.status_code in _RETRY_STATUS:
+        raise _Transient(response.text, response)
+    if response.status_code != 200:
+        raise ComparablesError(response.text)
+    try:
+        data = response.json()
+    except ValueError as e:
+        # Abgeschnittenes oder kaputtes JSON (Verbindungsabbruch, Proxy): wie 5xx wiederholen
+        raise _Transient(f"Ungültige Antwort der Suche: {e}")
+    if not isinstance(data, dict):
+        raise ComparablesError(f"Unerwartete Antwort der Suche: {type(data).__name__}")
+    return data
+
+
+async def _fetch(query: str, limit: int) -> dict:
+    params = {"query": query, "limit": str(limit)}
+    return await ads_upstream.call(lambda: _get(params), retries=COMPARABLES_RETRIES, transient=(_Transient,))
+
+
+async def _fetch_cached(key: str, query: str, limit: int) -> dict:
+    data = await _fetch(query, limit)
+    await comparables_cache.set(key, data, query=normalize_query(query), limit=limit)
+    return data
+
+
+async def search(query: str, limit: int = 5, key: str | None = None) -> dict:
+    # key: Schlüssel für Cache und Single-Flight, sonst der normalisierte Suchtext
+    key = make_key(key or normalize_query(query), limit)
+    data = await comparables_cache.get(key)
+    if data is not None:
+        return data
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_cached(key, query, limit))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _inflight.pop(key, None))
+
+    # shield: bricht ein Aufrufer ab, läuft die Suche für die anderen weiter
+    return await asyncio.shield(task)
+
+
+def connect():
+    global _client
+    _client = httpx.AsyncClient(
+        timeout=httpx.Timeout(COMPARABLES_TIMEOUT, connect=5.0),
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=10),
+        headers={
+            "ads_key": config("KLEINANZEIGEN_API_KEY"),
+            "Content-Type": "application/json"
+        }
+    )
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -12,6 +12,9 @@ class Config:
     
     # API settings
     API_PREFIX = os.getenv("API_PREFIX", "/api")
+
+    # Anzahl uvicorn-Worker (wie uvicorn --workers), für Limits pro Prozess
+    WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
     
     @classmethod
     def get_config(cls) -> Dict[str, Any]:
@@ -20,7 +23,8 @@ class Config:
             "mongodb_url": cls.MONGODB_URL,
             "mongodb_db": cls.MONGODB_DB,
             "cors_origins": cls.CORS_ORIGINS,
-            "api_prefix": cls.API_PREFIX
+            "api_prefix": cls.API_PREFIX,
+            "workers": cls.WORKERS
         }
 
 # Environment-specific configurations
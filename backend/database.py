@@ -1,6 +1,29 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from decouple import config
+from config import CurrentConfig
+import metrics
 
-client = AsyncIOMotorClient(config("MONGODB_URI"))
-db = client["kleinanzeigen"]
-ad_collection = db["ad_processes"]
\ No newline at end of file
+# connect=False: Verbindungen und Monitor-Threads entstehen erst beim ersten Zugriff
+# im jeweiligen Worker-Prozess, nicht schon beim Import (sicher bei fork)
+# event_listeners: Dauer jedes Befehls für /metrics
+client = AsyncIOMotorClient(config("MONGODB_URI"), connect=False,
+                            event_listeners=[metrics.MongoCommandListener()])
+db = client[CurrentConfig.MONGODB_DB]
+ad_collection = db["ad_processes"]
+upload_collection = db["uploads"]
+job_collection = db["jobs"]
+market_collection = db["market_data"]
+batch_collection = db["batches"]
+offline_collection = db["offline_batches"]
+catalog_collection = db["catalog"]
+metrics_collection = db["metrics"]
+
+
+async def ensure_indexes():
+    # Übersicht pro Nutzer (neueste zuerst, Keyset-Pagination) und Abfragen nach Wizard-Schritt
+    await ad_collection.create_index([("user_id", 1), ("created_at", -1), ("_id", -1)])
+    await ad_collection.create_index("wizard_state")
+
+
+def close():
+    client.close()
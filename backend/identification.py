@@ -0,0 +1,74 @@
+import json
+from cache import identification_cache, make_key, prompt_version
+from models import IdentificationData
+import llm
+
+# Prompt, Modell, Ergebnis-Cache und Zusammenführung der Produkterkennung. Eigenes Modul,
+# damit Upload und Erkennung denselben Cache-Schlüssel nutzen, ohne voneinander abzuhängen.
+
+# Feste Anweisungen vor den Bildern, damit jeder Aufruf mit demselben Präfix beginnt
+# (Prompt-Caching bei OpenAI). Felder, Kategorien und Zustände gibt das Schema vor.
+IDENTIFY_PROMPT = (
+    "Du bist Produkterkennungs-Experte für digitale Kleinanzeigen. "
+    "Identifiziere das Produkt auf den Bildern des Nutzers. "
+    "Wähle Kategorie und Zustand aus den vorgegebenen Werten. Alle Texte auf Deutsch."
+)
+IDENTIFY_FORMAT = llm.json_schema(IdentificationData)
+
+IDENTIFY_MODEL = "gpt-4.1-mini"
+PROMPT_VERSION = prompt_version(IDENTIFY_PROMPT + json.dumps(IDENTIFY_FORMAT, sort_keys=True))
+
+
+def identification_key(fingerprint: str) -> str:
+    return make_key(fingerprint, IDENTIFY_MODEL, PROMPT_VERSION)
+
+
+async def cached_identification(fingerprint: str) -> dict | None:
+    return await identification_cache.get(identification_key(fingerprint))
+
+
+async def store_identification(fingerprint: str, parsed: dict):
+    await identification_cache.set(
+        identification_key(fingerprint), parsed,
+        fingerprint=fingerprint, model=IDENTIFY_MODEL, prompt_version=PROMPT_VERSION
+    )
+
+
+def _vote_key(value) -> str:
+    return " ".join(str(value).casefold().split())
+
+
+def fuse_identifications(results: list[tuple[dict, int]]) -> tuple[dict, dict]:
+    # Feldweise gewichtete Mehrheitsentscheidung. Konfidenz = Anteil der Bilder,
+    # die den gewählten Wert liefern. Bei Gleichstand gewinnt das frühere Bild.
+    total = sum(weight for _, weight in results)
+    fields = list(dict.fromkeys(k for data, _ in results for k in data))
+    fused, confidence = {}, {}
+
+    for field in fields:
+        if field == "special_notes":
+            # Hinweise aus allen Bildern zusammenführen statt abstimmen
+            notes = list(dict.fromkeys(
+                str(data[field]).strip() for data, _ in results if data.get(field)
+            ))
+            fused[field] = "; ".join(notes) if notes else None
+            continue
+
+        votes, first = {}, {}
+        for data, weight in results:
+            value = data.get(field)
+            if value in (None, ""):
+                continue
+            key = _vote_key(value)
+            votes[key] = votes.get(key, 0) + weight
+            first.setdefault(key, value)
+
+        if not votes:
+            fused[field] = None
+            confidence[field] = 0.0
+            continue
+        winner = max(votes, key=votes.get)
+        fused[field] = first[winner]
+        confidence[field] = round(votes[winner] / total, 2)
+
+    return fused, confidence
@@ -0,0 +1,236 @@
+import asyncio
+import hashlib
+import os
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+from fastapi import Request, UploadFile
+from PIL import Image, ImageOps
+from starlette.datastructures import FormData
+from starlette.formparsers import MultiPartParser
+from config import CurrentConfig
+from database import upload_collection
+
+# Upload-Verarbeitung: Datei in Blöcken auf die Platte streamen und
+# Bilder außerhalb des Event-Loops neu kodieren.
+
+UPLOAD_MAX_BYTES = config("UPLOAD_MAX_BYTES", default=20 * 1024 * 1024, cast=int)
+UPLOAD_CHUNK_SIZE = config("UPLOAD_CHUNK_SIZE", default=1024 * 1024, cast=int)
+# Spielraum für Multipart-Grenzen und Part-Header über UPLOAD_MAX_BYTES hinaus
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+# Threads pro Worker-Prozess; zusammen etwa ein Thread pro Kern
+IMAGE_WORKERS = config("IMAGE_WORKERS", default=max(1, (os.cpu_count() or 2) // CurrentConfig.WORKERS), cast=int)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+# Abgeleitete Varianten: Name -> (max. Kantenlänge, Format, Qualität).
+# "vision" ist auf die Kachelgröße der Vision-Modelle abgestimmt (weniger Input-Tokens),
+# "thumb" für die Vorschau im Wizard, "display_*" für die Anzeige in modernen Formaten.
+VISION_MAX_SIDE = config("VISION_MAX_SIDE", default=1024, cast=int)
+DERIVATIVES = {
+    "display_webp": (1600, "WEBP", 80),
+    "display_avif": (1600, "AVIF", 60),
+    "vision": (VISION_MAX_SIDE, "JPEG", 85),
+    "thumb": (320, "WEBP", 75),
+}
+
+# Ähnliche Bilder (erneut komprimiert, leicht skaliert) über den Hamming-Abstand
+# des 64-Bit-dHash erkennen. Der Hash wird in 4 Bänder à 16 Bit geteilt: Zwei Hashes
+# mit Abstand <= 3 stimmen in mindestens einem Band exakt überein (Schubfachprinzip),
+# so genügt eine indizierte $in-Abfrage für die Kandidatensuche.
+PHASH_MAX_DISTANCE = min(config("PHASH_MAX_DISTANCE", default=3, cast=int), 3)
+_PHASH_BANDS = 4
+# Flächige Bilder (einfarbig, fast schwarz, Fehlbelichtung) haben keinen aussagekräftigen
+# dHash, fast alle landen auf 0000000000000000. Unterhalb dieser Standardabweichung der
+# Graustufen im 9x8-Bild gibt es keinen Hash und keinen Ähnlichkeitsabgleich.
+PHASH_MIN_STDDEV = config("PHASH_MIN_STDDEV", default=4.0, cast=float)
+
+# Schutz vor Dekompressionsbomben (Pillow warnt sonst nur)
+Image.MAX_IMAGE_PIXELS = config("IMAGE_MAX_PIXELS", default=60_000_000, cast=int)
+
+# Pillow gibt beim Dekodieren/Kodieren die GIL frei, ein Thread-Pool reicht.
+# Die Größe begrenzt gleichzeitig, wie viele Bilder parallel im Speicher liegen.
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+# Metadaten, die für die korrekte Darstellung nötig sind und keine Nutzerdaten enthalten
+_KEEP_INFO = ("transparency",)
+
+# AVIF nur erzeugen, wenn Pillow mit AVIF-Unterstützung gebaut ist
+Image.init()
+_SAVE_FORMATS = set(Image.SAVE)
+
+_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "AVIF": ".avif"}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+async def run_in_pool(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, fn, *args)
+
+
+async def _capped(stream, max_bytes: int):
+    size = 0
+    async for chunk in stream:
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge(size)
+        yield chunk
+
+
+async def receive_upload(request: Request, max_bytes: int | None = None) -> FormData:
+    # Multipart-Body selbst lesen: mit File(...) nimmt Starlette ihn vor dem Handler
+    # vollständig an, die Grenze griffe erst danach. So wird ein zu großer Upload per
+    # Content-Length sofort bzw. beim Überschreiten während der Übertragung abgebrochen.
+    max_bytes = (max_bytes or UPLOAD_MAX_BYTES) + UPLOAD_FORM_OVERHEAD
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > max_bytes:
+        raise UploadTooLarge(int(length))
+    parser = MultiPartParser(request.headers, _capped(request.stream(), max_bytes), max_files=1, max_fields=10)
+    return await parser.parse()
+
+
+def _write_chunk(out, digest, chunk: bytes) -> None:
+    digest.update(chunk)
+    out.write(chunk)
+
+
+async def save_upload(file: UploadFile, dest_path: str, max_bytes: int | None = None) -> tuple[int, str]:
+    # Liefert Größe und SHA-256 des Uploads
+    max_bytes = max_bytes or UPLOAD_MAX_BYTES
+    # Größe vorab prüfen, falls der Client sie mitschickt
+    if file.size is not None and file.size > max_bytes:
+        raise UploadTooLarge(file.size)
+
+    size = 0
+    digest = hashlib.sha256()
+    with open(dest_path, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(size)
+            await run_in_pool(_write_chunk, out, digest, chunk)
+    return size, digest.hexdigest()
+
+
+def perceptual_hash(path: str) -> str | None:
+    # dHash: Helligkeitsverlauf benachbarter Pixel eines 9x8-Graustufenbilds.
+    # draft() lässt JPEGs direkt verkleinert dekodieren, das ist sehr billig.
+    with Image.open(path) as image:
+        image.draft("L", (64, 64))
+        small = ImageOps.exif_transpose(image).convert("L").resize((9, 8), Image.LANCZOS)
+    px = small.tobytes()
+    if statistics.pstdev(px) < PHASH_MIN_STDDEV:
+        return None
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+def phash_bands(phash: str | None) -> list[str]:
+    if phash is None:
+        return []
+    width = len(phash) // _PHASH_BANDS
+    return [f"{i}:{phash[i * width:(i + 1) * width]}" for i in range(_PHASH_BANDS)]
+
+
+def hamming(a: str, b: str) -> int:
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+async def find_exact(digest: str) -> dict | None:
+    return await upload_collection.find_one({"sha256": digest})
+
+
+async def find_similar(phash: str | None, user_id: str | None) -> dict | None:
+    # Nächstgelegenes Bild desselben Nutzers innerhalb des erlaubten Abstands. Nur
+    # byte-identische Dateien (find_exact) werden nutzerübergreifend zusammengelegt,
+    # sonst bekäme ein Nutzer die Datei und Erkennung eines anderen.
+    if phash is None or not user_id:
+        return None
+    best, best_distance = None, PHASH_MAX_DISTANCE + 1
+    query = {"user_id": user_id, "phash_bands": {"$in": phash_bands(phash)}}
+    async for doc in upload_collection.find(query):
+        distance = hamming(phash, doc["phash"])
+        if distance < best_distance:
+            best, best_distance = doc, distance
+    return best
+
+
+async def ensure_indexes():
+    await upload_collection.create_index("sha256", unique=True, sparse=True)
+    await upload_collection.create_index([("user_id", 1), ("phash_bands", 1)])
+
+
+def _save(image: Image.Image, path: str, fmt: str, **params) -> None:
+    if fmt == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+        image = image.convert("RGB")
+    image.save(path, format=fmt, **params)
+
+
+def ingest_image(src_path: str, dest_path: str) -> dict:
+    # EXIF & Co. entfernen, ohne die Pixel als Python-Objekte zu materialisieren.
+    # Die EXIF-Orientierung wird vorher angewendet, damit Handyfotos nicht gedreht erscheinen.
+    with Image.open(src_path) as image:
+        clean = ImageOps.exif_transpose(image)
+        clean.info = {k: v for k, v in image.info.items() if k in _KEEP_INFO}
+
+    _save(clean, dest_path, Image.registered_extensions().get(os.path.splitext(dest_path)[1].lower()))
+
+    manifest = {
+        "file": os.path.basename(dest_path),
+        "width": clean.width,
+        "height": clean.height,
+        "bytes": os.path.getsize(dest_path),
+        "derivatives": {},
+    }
+
+    # Varianten absteigend nach Größe, jede wird aus der vorherigen verkleinert
+    stem = os.path.splitext(dest_path)[0]
+    current = clean
+    for name, (max_side, fmt, quality) in sorted(DERIVATIVES.items(), key=lambda d: -d[1][0]):
+        if fmt not in _SAVE_FORMATS:
+            continue
+        if max(current.size) > max_side:
+            current = current.copy()
+            current.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+        path = f"{stem}_{name}{_EXTENSIONS[fmt]}"
+        _save(current, path, fmt, quality=quality)
+        manifest["derivatives"][name] = {
+            "file": os.path.basename(path),
+            "format": fmt,
+            "width": current.width,
+            "height": current.height,
+            "bytes": os.path.getsize(path),
+        }
+
+    return manifest
+
+
+def file_url(url: str, file_name: str) -> str:
+    # URL einer Variante liegt neben dem Original
+    return f"{url.rsplit('/', 1)[0]}/{file_name}"
+
+
+async def load_manifests(urls: list[str]) -> list[dict | None]:
+    # Manifeste zu den hochgeladenen Bild-URLs, in derselben Reihenfolge
+    names = [url.rsplit("/", 1)[-1] for url in urls]
+    docs = {doc["_id"]: doc async for doc in upload_collection.find({"_id": {"$in": names}})}
+    return [docs.get(name) for name in names]
+
+
+def fingerprint(url: str, manifest: dict | None) -> str:
+    # Inhalts-Hash des (ggf. als Duplikat aufgelösten) Uploads, sonst Hash der URL
+    if manifest and manifest.get("sha256"):
+        return manifest["sha256"]
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def vision_url(url: str, manifest: dict | None) -> str:
+    # Verkleinerte Variante für das Vision-Modell, sonst das Original
+    vision = (manifest or {}).get("derivatives", {}).get("vision")
+    return file_url(url, vision["file"]) if vision else url
@@ -0,0 +1,187 @@
+import asyncio
+from datetime import datetime, timedelta
+from bson import ObjectId
+from decouple import config
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from pymongo import ReturnDocument
+from config import CurrentConfig
+from database import job_collection
+from models import JobStatus
+import log
+import logging
+import upstream
+import wizard
+
+# Hintergrund-Jobs für die Wizard-Schritte. Die Warteschlange liegt in MongoDB,
+# damit Jobs Neustarts überleben und sich mehrere Worker-Prozesse die Arbeit teilen.
+# Ein Job wird atomar per find_one_and_update übernommen und erhält eine Lease;
+# läuft sie ab (Prozess abgestürzt), wird der Job erneut vergeben.
+# Jobs laufen mit niedriger Upstream-Priorität; bei Überlast werden sie mit
+# not_before zurückgestellt statt als Fehler beendet.
+
+JOB_WORKERS = config("JOB_WORKERS", default=8, cast=int)
+JOB_POLL_INTERVAL = config("JOB_POLL_INTERVAL", default=0.5, cast=float)
+JOB_LEASE_SECONDS = config("JOB_LEASE_SECONDS", default=300, cast=int)
+JOB_MAX_ATTEMPTS = config("JOB_MAX_ATTEMPTS", default=3, cast=int)
+
+# Job-Art -> Wizard-Schritt, dessen Status den Fortschritt zeigt (routes/jobs.py)
+JOB_STEPS = {
+    "identify": "identification",
+    "comparables": "comparables",
+    "price_suggestion": "price",
+    "listing": "listing",
+    "pipeline": "pipeline",
+}
+
+# Art -> (Handler, Request-Modell); wird von den Routern befüllt
+_handlers: dict[str, tuple] = {}
+_tasks: list[asyncio.Task] = []
+logger = logging.getLogger(__name__)
+_wakeup = asyncio.Event()
+
+
+def register(kind: str, handler, request_model: type[BaseModel]):
+    _handlers[kind] = (handler, request_model)
+
+
+async def submit(kind: str, req: BaseModel) -> JSONResponse:
+    # Job anlegen und sofort mit 202 antworten; ungültige ad_process_id schon hier mit 400
+    ad_process_id = getattr(req, "ad_process_id", None)
+    if ad_process_id:
+        wizard.object_id(ad_process_id)
+    now = datetime.utcnow()
+    job = {
+        "kind": kind,
+        "payload": req.model_dump(),
+        "ad_process_id": ad_process_id,
+        "status": JobStatus.QUEUED,
+        "attempts": 0,
+        "created_at": now,
+        "updated_at": now
+    }
+    result = await job_collection.insert_one(job)
+    _wakeup.set()
+
+    job_id = str(result.inserted_id)
+    return JSONResponse(status_code=202, content={
+        "status": "accepted",
+        "job_id": job_id,
+        "ad_process_id": job["ad_process_id"],
+        "events": f"{CurrentConfig.API_PREFIX}/jobs/{job_id}/events"
+    })
+
+
+async def _claim() -> dict | None:
+    now = datetime.utcnow()
+    return await job_collection.find_one_and_update(
+        {"$or": [
+            {"status": JobStatus.QUEUED, "not_before": {"$not": {"$gt": now}}},
+            {"status": JobStatus.RUNNING, "lease_until": {"$lt": now}}
+        ]},
+        {"$set": {
+            "status": JobStatus.RUNNING,
+            "started_at": now,
+            "updated_at": now,
+            "lease_until": now + timedelta(seconds=JOB_LEASE_SECONDS)
+        }, "$inc": {"attempts": 1}},
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def _finish(job_id: ObjectId, status: JobStatus, **fields):
+    now = datetime.utcnow()
+    await job_collection.update_one(
+        {"_id": job_id},
+        {"$set": {"status": status, "finished_at": now, "updated_at": now, **fields},
+         "$unset": {"lease_until": ""}}
+    )
+
+
+async def _requeue(job: dict, retry_after: float, error: str):
+    now = datetime.utcnow()
+    await job_collection.update_one(
+        {"_id": job["_id"]},
+        {"$set": {
+            "status": JobStatus.QUEUED,
+            "not_before": now + timedelta(seconds=retry_after),
+            "updated_at": now,
+            "error": error
+        }, "$unset": {"lease_until": ""}}
+    )
+
+
+async def _heartbeat(job_id: ObjectId):
+    # Lease verlängern, solange der Handler läuft (z. B. lange Batches)
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        await job_collection.update_one(
+            {"_id": job_id},
+            {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)}}
+        )
+
+
+async def _run(job: dict):
+    handler, request_model = _handlers[job["kind"]]
+
+    # Abgebrochene Läufe nicht endlos wiederholen (jeder Versuch kostet Upstream-Aufrufe)
+    if job["attempts"] > JOB_MAX_ATTEMPTS:
+        await _finish(job["_id"], JobStatus.ERROR, error="Maximale Anzahl Versuche erreicht")
+        return
+
+    heartbeat = asyncio.create_task(_heartbeat(job["_id"]))
+    try:
+        with upstream.priority(upstream.BACKGROUND), \
+                log.context(job_id=job["_id"], ad_process_id=job.get("ad_process_id")):
+            result = await handler(request_model(**job["payload"]))
+        # Identifikation ohne ad_process_id legt den AdProcess erst im Job an
+        ad_process_id = job.get("ad_process_id") or (result or {}).get("ad_process_id")
+        await _finish(job["_id"], JobStatus.DONE, result=jsonable_encoder(result), ad_process_id=ad_process_id)
+    except upstream.UpstreamError as e:
+        if job["attempts"] < JOB_MAX_ATTEMPTS:
+            await _requeue(job, e.retry_after, e.detail)
+        else:
+            await _finish(job["_id"], JobStatus.ERROR, error=e.detail, status_code=e.status_code)
+    except HTTPException as e:
+        await _finish(job["_id"], JobStatus.ERROR, error=e.detail, status_code=e.status_code)
+    except Exception as e:
+        logger.exception("Job fehlgeschlagen", extra={"job_id": str(job["_id"]), "kind": job["kind"]})
+        await _finish(job["_id"], JobStatus.ERROR, error=str(e), status_code=500)
+    finally:
+        heartbeat.cancel()
+
+
+async def _worker():
+    while True:
+        try:
+            job = await _claim()
+        except Exception:
+            job = None
+        if job is None:
+            # Leerlauf: bis zum nächsten Poll oder bis lokal ein Job eingereiht wird
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await _run(job)
+
+
+def start_workers():
+    for _ in range(JOB_WORKERS):
+        _tasks.append(asyncio.create_task(_worker()))
+
+
+async def stop_workers():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+
+
+async def ensure_indexes():
+    await job_collection.create_index([("status", 1), ("created_at", 1)])
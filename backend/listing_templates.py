@@ -0,0 +1,74 @@
+# Lokale Anzeigentexte für strukturierte Kategorien: Titel und Beschreibung werden
+# ausschließlich aus den Identifikationsdaten zusammengesetzt, ohne LLM-Aufruf.
+
+TITLE_MAX = 60
+
+# Kategorien, in denen Marke + Modell das Produkt ausreichend beschreiben
+TEMPLATE_CATEGORIES = (
+    "Elektronik/",
+    "Auto, Rad & Boot/Fahrräder & Zubehör",
+    "Auto, Rad & Boot/Autoteile & Reifen",
+    "Auto, Rad & Boot/Motorradteile & Zubehör",
+    "Haus & Garten/Heimwerken",
+    "Haus & Garten/Küche & Esszimmer",
+    "Haus & Garten/Lampen & Licht",
+)
+
+# Einleitungssatz je Hauptkategorie
+_INTRO = {
+    "Elektronik": "Ich verkaufe hier mein {product}.",
+    "Auto, Rad & Boot": "Zum Verkauf steht {product}.",
+    "Haus & Garten": "Ich verkaufe {product}.",
+}
+
+_CONDITION_TEXT = {
+    "neu": "Der Artikel ist neu und unbenutzt.",
+    "sehr gut": "Der Artikel ist in sehr gutem Zustand.",
+    "gut": "Der Artikel ist in gutem Zustand mit normalen Gebrauchsspuren.",
+    "in ordnung": "Der Artikel ist in Ordnung, hat aber deutliche Gebrauchsspuren.",
+    "defekt": "Der Artikel ist defekt und wird als Bastler- bzw. Ersatzteilobjekt verkauft.",
+}
+
+
+def supports(features: dict) -> bool:
+    category = features.get("category") or ""
+    return bool(features.get("brand") and features.get("model_or_type")) and category.startswith(TEMPLATE_CATEGORIES)
+
+
+def _product(features: dict) -> str:
+    brand = features["brand"].strip()
+    model = features["model_or_type"].strip()
+    # Marke nicht doppeln, wenn sie schon im Modellnamen steht
+    return model if model.casefold().startswith(brand.casefold()) else f"{brand} {model}"
+
+
+def _title(product: str, condition: str | None, color: str | None) -> str:
+    parts = [product]
+    for extra in (color, condition):
+        if extra and len(" – ".join(parts + [extra])) <= TITLE_MAX:
+            parts.append(extra)
+    return " – ".join(parts)[:TITLE_MAX].rstrip()
+
+
+def render(features: dict, price_text: str) -> dict:
+    product = _product(features)
+    condition = (features.get("condition") or "").strip() or None
+    color = (features.get("color") or "").strip() or None
+    main_category = (features.get("category") or "").split("/", 1)[0]
+
+    sentences = [_INTRO.get(main_category, "Ich verkaufe {product}.").format(product=product)]
+    if color:
+        sentences.append(f"Farbe: {color}.")
+    if condition:
+        sentences.append(_CONDITION_TEXT.get(condition.casefold(), f"Zustand: {condition}."))
+    if features.get("special_notes"):
+        sentences.append(f"{features['special_notes'].strip().rstrip('.')}.")
+    sentences.append("Bei Fragen gerne melden.")
+
+    return {
+        "title": _title(product, condition, color),
+        "description": " ".join(sentences),
+        "condition": condition or "Unbekannt",
+        "category": features.get("category") or "Unbekannt",
+        "price": price_text
+    }
@@ -0,0 +1,242 @@
+import json
+import time
+import httpx
+import openai
+from decouple import config
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from pydantic import BaseModel
+import metrics
+import upstream
+
+# Gemeinsamer, nicht-blockierender OpenAI-Zugang für alle Router.
+# Ein Client pro Worker-Prozess, damit Verbindungen (TLS, Keep-Alive) wiederverwendet werden;
+# angelegt und geschlossen im Lifespan der App (connect/close).
+# Jeder Aufruf läuft durch die Zugangskontrolle des Modells (upstream.py); Wiederholungen
+# übernimmt diese statt des OpenAI-Clients, damit auch sie die Limits einhalten.
+
+LLM_TIMEOUT = config("LLM_TIMEOUT", default=60.0, cast=float)
+LLM_MAX_CONNECTIONS = config("LLM_MAX_CONNECTIONS", default=100, cast=int)
+LLM_MAX_KEEPALIVE = config("LLM_MAX_KEEPALIVE", default=20, cast=int)
+LLM_DEFAULT_CONCURRENCY = config("LLM_DEFAULT_CONCURRENCY", default=16, cast=int)
+# Geschätzte Tokens pro Bild (Vision-Variante mit max. 1024 px)
+LLM_IMAGE_TOKENS = config("LLM_IMAGE_TOKENS", default=800, cast=int)
+
+# Maximale parallele Aufrufe, Timeout (Sekunden) und Quoten (pro Minute, 0 = ohne) je Modell
+MODEL_LIMITS = {
+    "gpt-4.1-mini": {
+        "concurrency": config("LLM_CONCURRENCY_GPT41_MINI", default=32, cast=int),
+        "timeout": config("LLM_TIMEOUT_GPT41_MINI", default=45.0, cast=float),
+        "rpm": config("LLM_RPM_GPT41_MINI", default=500, cast=int),
+        "tpm": config("LLM_TPM_GPT41_MINI", default=200_000, cast=int),
+    },
+    "gpt-4o": {
+        "concurrency": config("LLM_CONCURRENCY_GPT4O", default=16, cast=int),
+        "timeout": config("LLM_TIMEOUT_GPT4O", default=60.0, cast=float),
+        "rpm": config("LLM_RPM_GPT4O", default=500, cast=int),
+        "tpm": config("LLM_TPM_GPT4O", default=30_000, cast=int),
+    },
+}
+
+# USD pro 1 Mio. Tokens (Eingabe, Ausgabe) für die Kostenschätzung
+MODEL_PRICES = {
+    "gpt-4.1-mini": (
+        config("LLM_PRICE_IN_GPT41_MINI", default=0.40, cast=float),
+        config("LLM_PRICE_OUT_GPT41_MINI", default=1.60, cast=float),
+    ),
+    "gpt-4o": (
+        config("LLM_PRICE_IN_GPT4O", default=2.50, cast=float),
+        config("LLM_PRICE_OUT_GPT4O", default=10.00, cast=float),
+    ),
+}
+
+# Fehler, bei denen sich ein erneuter Versuch lohnt
+TRANSIENT_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+client: AsyncOpenAI | None = None
+# Eigener Client für die Batch-Schnittstelle (offline.py)
+batch_client: AsyncOpenAI | None = None
+
+_upstreams: dict[str, upstream.Upstream] = {}
+
+
+def _upstream(model: str) -> upstream.Upstream:
+    up = _upstreams.get(model)
+    if up is None:
+        limits = MODEL_LIMITS.get(model, {})
+        up = _upstreams[model] = upstream.Upstream(
+            f"OpenAI ({model})",
+            concurrency=limits.get("concurrency", LLM_DEFAULT_CONCURRENCY),
+            rpm=limits.get("rpm", 0),
+            tpm=limits.get("tpm", 0),
+        )
+    return up
+
+
+def _timeout(model: str) -> float:
+    return MODEL_LIMITS.get(model, {}).get("timeout", LLM_TIMEOUT)
+
+
+def estimate_tokens(kwargs: dict) -> int:
+    # Grobe Schätzung vor dem Aufruf: ~4 Zeichen pro Token, Bilder pauschal, plus maximale Ausgabe
+    # Anweisungen und Ausgabeschema zählen wie Eingabe
+    payload = json.dumps([kwargs.get(k) for k in ("instructions", "messages", "input", "text", "response_format")],
+                         default=str, ensure_ascii=False)
+    images = payload.count('"input_image"') + payload.count('"type": "image_url"')
+    output = kwargs.get("max_tokens") or kwargs.get("max_output_tokens") or 0
+    return len(payload) // 4 + images * LLM_IMAGE_TOKENS + output
+
+
+def _without_titles(schema):
+    # Von Pydantic erzeugte "title" kosten bei jedem Aufruf Tokens und helfen dem Modell nicht
+    if isinstance(schema, list):
+        return [_without_titles(s) for s in schema]
+    if not isinstance(schema, dict):
+        return schema
+    return {
+        k: {name: _without_titles(s) for name, s in v.items()} if k in ("properties", "$defs") else _without_titles(v)
+        for k, v in schema.items() if k != "title"
+    }
+
+
+def json_schema(model: type[BaseModel]) -> dict:
+    # Strukturierte Ausgabe (strict): die Antwort entspricht immer dem Pydantic-Modell,
+    # Anweisungen zum Format im Prompt und Nachbessern beim Parsen entfallen
+    return {"type": "json_schema", "name": model.__name__, "schema": _without_titles(model.model_json_schema()), "strict": True}
+
+
+def chat_response_format(model: type[BaseModel]) -> dict:
+    # Dasselbe für die Chat-Completions-API (response_format)
+    schema = json_schema(model)
+    return {"type": "json_schema", "json_schema": {k: v for k, v in schema.items() if k != "type"}}
+
+
+def _usage(response) -> int | None:
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None) if usage is not None else None
+
+
+def _usage_field(usage, *names) -> int:
+    for name in names:
+        value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+        if value:
+            return value
+    return 0
+
+
+def record_usage(model: str, usage, price_factor: float = 1.0):
+    # Tokens und Kosten aus usage (Responses: input/output, Chat: prompt/completion).
+    # usage als Objekt oder, aus Batch-Ergebnissen, als dict
+    if not usage:
+        return
+    input_tokens = _usage_field(usage, "input_tokens", "prompt_tokens")
+    output_tokens = _usage_field(usage, "output_tokens", "completion_tokens")
+    # Versionierte Namen ("gpt-4o-2024-08-06") über den Modellpräfix zuordnen
+    known = max((m for m in MODEL_PRICES if model.startswith(m)), key=len, default=None)
+    price_in, price_out = MODEL_PRICES[known] if known else (0.0, 0.0)
+    cost = (input_tokens * price_in + output_tokens * price_out) / 1_000_000 * price_factor
+    metrics.record_usage(known or model, input_tokens, output_tokens, cost)
+
+
+async def _call(model: str, create, kwargs: dict):
+    kwargs.setdefault("timeout", _timeout(model))
+    up = _upstream(model)
+    tokens = estimate_tokens(kwargs)
+    response = await up.call(lambda: create(model=model, **kwargs), tokens=tokens, transient=TRANSIENT_ERRORS)
+    up.spend(tokens, _usage(response))
+    record_usage(model, getattr(response, "usage", None))
+    return response
+
+
+async def create_response(*, model: str, **kwargs):
+    # Responses-API (z. B. Bildanalyse) mit Modell-Limit und Timeout
+    return await _call(model, client.responses.create, kwargs)
+
+
+async def create_chat_completion(*, model: str, **kwargs):
+    # Chat-Completions-API mit Modell-Limit und Timeout
+    return await _call(model, client.chat.completions.create, kwargs)
+
+
+async def stream_chat_completion(*, model: str, **kwargs):
+    # Wie create_chat_completion, liefert aber die Text-Stücke, sobald sie eintreffen.
+    # Der Slot bleibt belegt, bis der Stream beendet ist. Ohne Wiederholung: bereits
+    # gesendete Tokens lassen sich nicht zurücknehmen.
+    kwargs.setdefault("timeout", _timeout(model))
+    up = _upstream(model)
+    tokens = estimate_tokens(kwargs)
+    async with up.admit(tokens):
+        started = time.perf_counter()
+        try:
+            # include_usage: der letzte Chunk enthält den Verbrauch (ohne choices)
+            stream = await client.chat.completions.create(
+                model=model, stream=True, stream_options={"include_usage": True}, **kwargs
+            )
+        except TRANSIENT_ERRORS as e:
+            metrics.record_upstream(up.name, time.perf_counter() - started, "transient")
+            up.breaker.failure()
+            up.refund(tokens)
+            raise upstream.UpstreamBusy(f"{up.name} überlastet: {e}", upstream.backoff(0) + 1.0) from e
+        except BaseException:
+            metrics.record_upstream(up.name, time.perf_counter() - started, "error")
+            up.breaker.release()
+            up.refund(tokens)
+            raise
+        outcome = None
+        try:
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    up.spend(tokens, chunk.usage.total_tokens)
+                    record_usage(model, chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+            outcome = "ok"
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            metrics.record_upstream(up.name, time.perf_counter() - started, outcome or "error")
+            # Erfolg erst, wenn der Stream vollständig war. Bricht der Upstream ab, zählt
+            # das als Fehler; trennt nur der Client die Verbindung, zählt es gar nicht.
+            if outcome == "ok":
+                up.breaker.success()
+            elif outcome == "error":
+                up.breaker.failure()
+            else:
+                up.breaker.release()
+
+
+def connect():
+    global client, batch_client
+    # OPENAI_BASE_URL für Lasttests gegen tools/openai_standin.py
+    client = AsyncOpenAI(
+        api_key=config("OPENAI_API_KEY"),
+        base_url=config("OPENAI_BASE_URL", default=None),
+        timeout=LLM_TIMEOUT,
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            )
+        ),
+    )
+    # OPENAI_BATCH_BASE_URL kann auf einen lokalen Stand-in zeigen (tools/openai_standin.py)
+    batch_client = AsyncOpenAI(
+        api_key=config("OPENAI_API_KEY"),
+        base_url=config("OPENAI_BATCH_BASE_URL", default=None),
+        timeout=LLM_TIMEOUT,
+        max_retries=2,
+    )
+
+
+async def close():
+    global client, batch_client
+    for c in (client, batch_client):
+        if c is not None:
+            await c.close()
+    client = batch_client = None
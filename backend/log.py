@@ -0,0 +1,198 @@
+import contextvars
+import hashlib
+import json
+import logging
+import queue
+import random
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import urlsplit
+from decouple import config
+
+# Strukturiertes Logging: eine JSON-Zeile pro Eintrag. Der Event-Loop legt Einträge nur
+# in eine Queue, formatiert und geschrieben wird in einem eigenen Thread. Ist die Queue
+# voll, werden Einträge verworfen statt den Loop zu blockieren.
+#
+# Jeder Eintrag trägt die Korrelations-IDs der aktuellen Anfrage (request_id,
+# ad_process_id, job_id). Vollständige Prompts/Antworten nur stichprobenartig
+# (LOG_PAYLOAD_SAMPLE_RATE) und gekürzt, Bild-URLs nur als Host + Hash.
+
+LOG_LEVEL = config("LOG_LEVEL", default="INFO")
+LOG_FORMAT = config("LOG_FORMAT", default="json")
+LOG_QUEUE_SIZE = config("LOG_QUEUE_SIZE", default=10_000, cast=int)
+LOG_PAYLOAD_SAMPLE_RATE = config("LOG_PAYLOAD_SAMPLE_RATE", default=0.01, cast=float)
+LOG_MAX_FIELD_CHARS = config("LOG_MAX_FIELD_CHARS", default=500, cast=int)
+LOG_MAX_ITEMS = config("LOG_MAX_ITEMS", default=20, cast=int)
+
+# Felder eines LogRecord, die nicht als Zusatzdaten ausgegeben werden
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "context", "asctime"}
+
+_context = contextvars.ContextVar("log_context", default={})
+_listener: QueueListener | None = None
+_handler: "_DroppingQueueHandler | None" = None
+
+
+def bind(**ids):
+    # Korrelations-IDs für den Rest der aktuellen Anfrage bzw. des Tasks setzen
+    _context.set({**_context.get(), **{k: str(v) for k, v in ids.items() if v is not None}})
+
+
+@contextmanager
+def context(**ids):
+    # Wie bind, aber nur innerhalb des Blocks (z. B. ein Job in einem langlebigen Worker)
+    token = _context.set({**_context.get(), **{k: str(v) for k, v in ids.items() if v is not None}})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def current() -> dict:
+    return _context.get()
+
+
+def sampled() -> bool:
+    # Vor dem Aufbau großer Payloads prüfen
+    return LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE
+
+
+def _url(value: str) -> str:
+    if value.startswith("data:"):
+        return f"<data-url {len(value)} Zeichen>"
+    digest = hashlib.sha256(value.encode()).hexdigest()[:12]
+    return f"<url {urlsplit(value).netloc or '-'} {digest}>"
+
+
+def redact(value, limit: int = LOG_MAX_FIELD_CHARS):
+    # Kopie mit gekürzten Texten, Listen und ohne vollständige URLs
+    if isinstance(value, str):
+        if value.startswith(("http://", "https://", "data:", "/uploads/")):
+            return _url(value)
+        if len(value) > limit:
+            return f"{value[:limit]}…(+{len(value) - limit} Zeichen)"
+        return value
+    if isinstance(value, dict):
+        return {k: redact(v, limit) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [redact(v, limit) for v in value[:LOG_MAX_ITEMS]]
+        if len(value) > LOG_MAX_ITEMS:
+            items.append(f"…(+{len(value) - LOG_MAX_ITEMS} Einträge)")
+        return items
+    return value
+
+
+class RequestContextMiddleware:
+    # ASGI-Middleware: request_id aus X-Request-ID übernehmen oder erzeugen und zurückgeben
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex[:16]
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        with context(request_id=request_id):
+            await self.app(scope, receive, send_with_id)
+
+
+class _ContextFilter(logging.Filter):
+    # Läuft im aufrufenden Task: Korrelations-IDs am Eintrag festhalten
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.context = _context.get()
+        return True
+
+
+class _DroppingQueueHandler(QueueHandler):
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatierung erst im Listener-Thread; nur Ausnahmen jetzt als Text festhalten
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **getattr(record, "context", {}),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_FIELDS})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    # Lesbare Ausgabe für die lokale Entwicklung (LOG_FORMAT=text)
+    def format(self, record: logging.LogRecord) -> str:
+        ids = " ".join(f"{k}={v}" for k, v in getattr(record, "context", {}).items())
+        extra = {k: v for k, v in vars(record).items() if k not in _RECORD_FIELDS}
+        line = f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        if ids:
+            line += f" [{ids}]"
+        if extra:
+            line += " " + json.dumps(extra, default=str, ensure_ascii=False)
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+def start():
+    # Pro Worker-Prozess einmal: Root-Logger auf die Queue umstellen
+    global _listener, _handler
+    if _listener is not None:
+        return
+    q = queue.Queue(LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+    _handler = _DroppingQueueHandler(q)
+    _handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [_handler]
+    root.setLevel(LOG_LEVEL.upper())
+    # Eine Zeile pro HTTP-Aufruf ist zu viel
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    # uvicorn schreibt sonst synchron mit eigenen Handlern
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+
+    _listener = QueueListener(q, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop():
+    # Restliche Einträge schreiben
+    global _listener, _handler
+    if _listener is None:
+        return
+    if _handler.dropped:
+        logging.getLogger(__name__).warning("Log-Einträge verworfen", extra={"dropped": _handler.dropped})
+    _listener.stop()
+    logging.getLogger().removeHandler(_handler)
+    _listener = _handler = None
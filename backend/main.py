@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -5,33 +6,103 @@ from routes.identify import router as identify_router
 from routes.price import router as price_router
 from routes.listing import router as listing_router
 from routes.upload import router as upload_router
+from routes.jobs import router as jobs_router
+from routes.pipeline import router as pipeline_router
+from routes.batch import router as batch_router
+from routes.offline import router as offline_router
+from routes.metrics import router as metrics_router
+from routes import batch
+from routes import metrics as metrics_routes
 from config import CurrentConfig
+from cache import comparables_cache, identification_cache, listing_cache
+import catalog
+import database
+import comparables
+import images
+import jobs
+import llm
+import log
+import market
+import offline
 import os
 
-# Upload-Verzeichnis sicherstellen
-UPLOAD_DIR = CurrentConfig.UPLOAD_DIR
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-app = FastAPI(debug=CurrentConfig.DEBUG)
-
-# CORS konfigurieren, damit das Frontend Anfragen stellen kann
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=CurrentConfig.CORS_ORIGINS,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# API-Router einbinden
-app.include_router(identify_router, prefix=f"{CurrentConfig.API_PREFIX}/identify", tags=["identify"])
-app.include_router(price_router,     prefix=f"{CurrentConfig.API_PREFIX}/price",    tags=["price"])
-app.include_router(listing_router,   prefix=f"{CurrentConfig.API_PREFIX}/listing",  tags=["listing"])
-app.include_router(upload_router,    prefix=f"{CurrentConfig.API_PREFIX}/upload",   tags=["upload"])
-
-# Statische Dateien ausliefern (Upload-Ordner)
-app.mount("/api/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
-
-@app.get("/")
-def root():
-    return {"message": "Kleinanzeigen KI Wizard Backend", "environment": os.getenv("FLASK_ENV", "development")}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Läuft in jedem Worker-Prozess: Clients und Hintergrund-Tasks gehören dem Prozess,
+    # geteilter Zustand (Caches, Jobs, Katalog) liegt in MongoDB
+    log.start()
+    llm.connect()
+    comparables.connect()
+    await database.ensure_indexes()
+    await images.ensure_indexes()
+    await identification_cache.ensure_indexes()
+    await listing_cache.ensure_indexes()
+    await comparables_cache.ensure_indexes()
+    await jobs.ensure_indexes()
+    await market.ensure_indexes()
+    await batch.ensure_indexes()
+    await offline.ensure_indexes()
+    await catalog.ensure_indexes()
+    await metrics_routes.ensure_indexes()
+    await catalog.warm_up()
+    jobs.start_workers()
+    offline.start()
+    catalog.start()
+    metrics_routes.start()
+    try:
+        yield
+    finally:
+        # Gepoolte Upstream-Verbindungen beim Beenden sauber schließen
+        await jobs.stop_workers()
+        await offline.stop()
+        await catalog.stop()
+        await metrics_routes.stop()
+        await llm.close()
+        await comparables.close()
+        database.close()
+        log.stop()
+
+
+def create_app() -> FastAPI:
+    # Upload-Verzeichnis sicherstellen
+    os.makedirs(CurrentConfig.UPLOAD_DIR, exist_ok=True)
+
+    app = FastAPI(debug=CurrentConfig.DEBUG, lifespan=lifespan)
+
+    # CORS konfigurieren, damit das Frontend Anfragen stellen kann
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CurrentConfig.CORS_ORIGINS,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # request_id je Anfrage für die Log-Einträge (log.py)
+    app.add_middleware(log.RequestContextMiddleware)
+
+    # API-Router einbinden
+    app.include_router(identify_router, prefix=f"{CurrentConfig.API_PREFIX}/identify", tags=["identify"])
+    app.include_router(price_router,     prefix=f"{CurrentConfig.API_PREFIX}/price",    tags=["price"])
+    app.include_router(listing_router,   prefix=f"{CurrentConfig.API_PREFIX}/listing",  tags=["listing"])
+    app.include_router(upload_router,    prefix=f"{CurrentConfig.API_PREFIX}/upload",   tags=["upload"])
+    app.include_router(jobs_router,      prefix=f"{CurrentConfig.API_PREFIX}/jobs",     tags=["jobs"])
+    app.include_router(pipeline_router,  prefix=f"{CurrentConfig.API_PREFIX}/pipeline", tags=["pipeline"])
+    app.include_router(batch_router,     prefix=f"{CurrentConfig.API_PREFIX}/batch",    tags=["batch"])
+    app.include_router(offline_router,   prefix=f"{CurrentConfig.API_PREFIX}/offline",  tags=["offline"])
+    # Ohne API-Präfix: wird intern abgefragt, nicht über den Reverse Proxy
+    app.include_router(metrics_router,   prefix="/metrics", tags=["metrics"])
+
+    # Statische Dateien ausliefern (Upload-Ordner)
+    app.mount("/api/uploads", StaticFiles(directory=CurrentConfig.UPLOAD_DIR), name="uploads")
+
+    @app.get("/")
+    def root():
+        return {"message": "Kleinanzeigen KI Wizard Backend", "environment": os.getenv("FLASK_ENV", "development")}
+
+    return app
+
+
+# uvicorn main:app (auch mit --workers N) oder uvicorn main:create_app --factory
+app = create_app()
@@ -0,0 +1,85 @@
+import re
+from datetime import datetime, timedelta
+from decouple import config
+from pymongo import UpdateOne
+from cache import make_key
+from database import market_collection
+import catalog
+
+# Lokaler Preisindex: jede abgerufene Vergleichsanzeige wird normalisiert gespeichert.
+# Sind genug frische Treffer für ein Produkt vorhanden, wird die externe Suche übersprungen.
+
+MARKET_MAX_AGE_DAYS = config("MARKET_MAX_AGE_DAYS", default=7, cast=int)
+MARKET_MIN_MATCHES = config("MARKET_MIN_MATCHES", default=5, cast=int)
+
+_PRICE_RE = re.compile(r"\d{1,3}(?:\.\d{3})+(?:,\d+)?|\d+(?:[.,]\d+)?")
+
+
+def parse_price(text) -> float | None:
+    # "1.200 € VB" -> 1200.0, "349,99 €" -> 349.99, "Zu verschenken" -> None
+    if text is None:
+        return None
+    if isinstance(text, (int, float)):
+        return float(text)
+    match = _PRICE_RE.search(str(text))
+    if not match:
+        return None
+    number = match.group(0)
+    if "," in number or number.count(".") > 1 or re.search(r"\.\d{3}$", number):
+        number = number.replace(".", "").replace(",", ".")
+    return float(number)
+
+
+def product_key(features: dict) -> str:
+    return catalog.product_key(features.get("brand"), features.get("model_or_type"))
+
+
+def _source_id(ad: dict) -> str:
+    return str(ad.get("id") or ad.get("url") or make_key(ad.get("title"), ad.get("price"), ad.get("description")))
+
+
+async def store(ads: list[dict], cleaned: list[dict], features: dict):
+    # Rohanzeigen und bereinigte Felder parallel (gleiche Reihenfolge)
+    if not ads:
+        return
+    now = datetime.utcnow()
+    key = catalog.learn(features.get("brand"), features.get("model_or_type"))
+    brand, model = catalog.canonical(features.get("brand"), features.get("model_or_type"))
+    ops = [
+        UpdateOne(
+            {"_id": _source_id(ad)},
+            {"$set": {
+                "product_key": key,
+                "brand": brand,
+                "model_or_type": model,
+                "category": features.get("category"),
+                "title": item["title"],
+                "description": item["description"],
+                "price": item["price"],
+                "price_value": parse_price(item["price"]),
+                "condition": item["condition"],
+                "fetched_at": now
+            }},
+            upsert=True
+        )
+        for ad, item in zip(ads, cleaned)
+    ]
+    await market_collection.bulk_write(ops, ordered=False)
+
+
+async def find_comparables(features: dict, limit: int) -> list[dict] | None:
+    # Frische lokale Treffer oder None, wenn es zu wenige sind
+    since = datetime.utcnow() - timedelta(days=MARKET_MAX_AGE_DAYS)
+    cursor = market_collection.find(
+        {"product_key": product_key(features), "fetched_at": {"$gte": since}},
+        {"_id": 0, "title": 1, "description": 1, "price": 1, "condition": 1}
+    ).sort("fetched_at", -1).limit(limit)
+    docs = await cursor.to_list(length=limit)
+    if len(docs) < min(MARKET_MIN_MATCHES, limit):
+        return None
+    return docs
+
+
+async def ensure_indexes():
+    await market_collection.create_index([("product_key", 1), ("fetched_at", -1)])
+    await market_collection.create_index("category")
@@ -0,0 +1,243 @@
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from pymongo import monitoring
+
+# Laufzeit-, Token- und Kostenmessung. Histogramme und Zähler im Prometheus-Format,
+# pro Worker-Prozess im Speicher; routes/metrics.py fasst die Worker zusammen.
+#
+# stage("price") misst einen Wizard-Schritt. Upstream-Zeit, Tokens und Kosten der
+# Aufrufe innerhalb des Schritts werden ihm zugerechnet; wizard.complete/fail speichern
+# die Zusammenfassung unter ad_processes.timings.<schritt>.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+PIXELS_BUCKETS = (300_000, 1_000_000, 3_000_000, 12_000_000, 24_000_000, 48_000_000)
+
+_registry: dict[str, "_Metric"] = {}
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, object] = {}
+        # Mongo-Monitoring ruft aus Treiber-Threads auf
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [Anzahl je Bucket (nicht kumuliert) ..., +Inf, Summe]
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            else:
+                state[len(self.buckets)] += 1
+            state[-1] += value
+
+
+def snapshot() -> dict:
+    # {name: [[labelwerte, wert], ...]} – als Liste, da Labelwerte Punkte enthalten können
+    result = {}
+    for name, metric in _registry.items():
+        with metric._lock:
+            result[name] = [[list(k), list(v) if isinstance(v, list) else v] for k, v in metric.values.items()]
+    return result
+
+
+def merge(snapshots: list[dict]) -> dict:
+    # Snapshots mehrerer Worker addieren
+    merged: dict[str, dict[tuple, object]] = {}
+    for snap in snapshots:
+        for name, series in snap.items():
+            target = merged.setdefault(name, {})
+            for labels, value in series:
+                key = tuple(labels)
+                current = target.get(key)
+                if current is None:
+                    target[key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target[key] = current + value
+    return merged
+
+
+def _labels(metric: _Metric, key: tuple, extra: str = "") -> str:
+    pairs = [f'{label}="{_escape(value)}"' for label, value in zip(metric.labels, key)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render(merged: dict) -> str:
+    # Textformat 0.0.4 für Prometheus
+    lines = []
+    for name, metric in _registry.items():
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for key, value in sorted(merged.get(name, {}).items()):
+            if metric.kind == "counter":
+                lines.append(f"{name}{_labels(metric, key)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip((*metric.buckets, math.inf), value):
+                cumulative += count
+                le = 'le="+Inf"' if bound == math.inf else f'le="{_number(bound)}"'
+                lines.append(f"{name}_bucket{_labels(metric, key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric, key)} {_number(round(value[-1], 6))}")
+            lines.append(f"{name}_count{_labels(metric, key)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram("wizard_stage_seconds", "Laufzeit der Wizard-Schritte", ("stage", "outcome"))
+UPSTREAM_SECONDS = Histogram("upstream_call_seconds", "Dauer einzelner Upstream-Aufrufe", ("upstream", "outcome"))
+UPSTREAM_WAIT_SECONDS = Histogram("upstream_wait_seconds", "Wartezeit in der Zugangskontrolle", ("upstream",))
+MONGO_SECONDS = Histogram("mongo_command_seconds", "Dauer von MongoDB-Befehlen", ("command", "collection", "outcome"))
+LLM_TOKENS = Counter("llm_tokens_total", "Verbrauchte Tokens laut usage", ("model", "kind"))
+LLM_COST = Counter("llm_cost_usd_total", "Geschätzte OpenAI-Kosten in USD", ("model",))
+UPLOAD_BYTES = Histogram("upload_bytes", "Größe hochgeladener Dateien", ("kind",), BYTES_BUCKETS)
+UPLOAD_PIXELS = Histogram("upload_pixels", "Pixel hochgeladener Bilder", (), PIXELS_BUCKETS)
+
+
+class Span:
+    def __init__(self, name: str, parent: "Span | None"):
+        self.name = name
+        self.parent = parent
+        self.started = time.perf_counter()
+        self.ended: float | None = None
+        self.upstream = 0.0
+        self.tokens = 0
+        self.cost = 0.0
+        self.failed = False
+        self.children: dict[str, dict] = {}
+
+    @property
+    def seconds(self) -> float:
+        return (self.ended or time.perf_counter()) - self.started
+
+    def summary(self) -> dict:
+        summary = {"ms": round(self.seconds * 1000), "upstream_ms": round(self.upstream * 1000)}
+        if self.tokens:
+            summary["tokens"] = self.tokens
+            summary["cost_usd"] = round(self.cost, 6)
+        return summary
+
+    def timings(self) -> dict:
+        # $set-Felder: dieser Schritt und bereits beendete Unterschritte
+        fields = {f"timings.{name}": summary for name, summary in self.children.items()}
+        fields[f"timings.{self.name}"] = self.summary()
+        return fields
+
+
+_current = contextvars.ContextVar("metrics_span", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    span = Span(name, _current.get())
+    token = _current.set(span)
+    outcome = "ok"
+    try:
+        yield span
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # Stream-Generator wurde in einem anderen Kontext geschlossen
+            pass
+        span.ended = time.perf_counter()
+        # Abgefangene Fehler (z. B. SSE-Fehlerevent) markiert wizard.fail
+        STAGE_SECONDS.observe(span.seconds, stage=name, outcome="error" if span.failed else outcome)
+        if span.parent is not None:
+            span.parent.children[name] = span.summary()
+
+
+def span_for(name: str) -> Span | None:
+    span = _current.get()
+    while span is not None and span.name != name:
+        span = span.parent
+    return span
+
+
+def record_upstream(upstream: str, seconds: float, outcome: str):
+    UPSTREAM_SECONDS.observe(seconds, upstream=upstream, outcome=outcome)
+    span = _current.get()
+    while span is not None:
+        span.upstream += seconds
+        span = span.parent
+
+
+def record_usage(model: str, input_tokens: int, output_tokens: int, cost: float):
+    LLM_TOKENS.inc(input_tokens, model=model, kind="input")
+    LLM_TOKENS.inc(output_tokens, model=model, kind="output")
+    LLM_COST.inc(cost, model=model)
+    span = _current.get()
+    while span is not None:
+        span.tokens += input_tokens + output_tokens
+        span.cost += cost
+        span = span.parent
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    # Dauer jedes Befehls, gruppiert nach Befehl und Collection
+    def __init__(self):
+        self._collections: dict[tuple, str] = {}
+
+    def started(self, event):
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        if isinstance(collection, str):
+            self._collections[(event.connection_id, event.request_id)] = collection
+
+    def _observe(self, event, outcome: str):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name,
+                              collection=collection, outcome=outcome)
+
+    def succeeded(self, event):
+        self._observe(event, "ok")
+
+    def failed(self, event):
+        self._observe(event, "error")
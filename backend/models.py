@@ -1,6 +1,6 @@
 from enum import Enum
-from typing import List, Optional
-from pydantic import BaseModel, Field
+from typing import Dict, List, Optional
+from pydantic import BaseModel, ConfigDict, Field
 from datetime import datetime
 
 class StepStatus(str, Enum):
@@ -8,26 +8,100 @@ class StepStatus(str, Enum):
     DONE = "DONE"
     ERROR = "ERROR"
 
+class JobStatus(str, Enum):
+    QUEUED = "QUEUED"
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    ERROR = "ERROR"
+
 class WizardState(str, Enum):
     STARTED = "STARTED"
     UPLOADED = "UPLOADED"
     IDENTIFIED = "IDENTIFIED"
+    COMPARABLES_RETRIEVED = "COMPARABLES_RETRIEVED"
+    PRICE_SUGGESTED = "PRICE_SUGGESTED"
+    LISTING_READY = "LISTING_READY"
+
+# Kategorien im Format "Hauptkategorie/Unterkategorie"
+CATEGORIES = [
+    "Auto, Rad & Boot/Autos",
+    "Auto, Rad & Boot/Autoteile & Reifen",
+    "Auto, Rad & Boot/Boote & Bootszubehör",
+    "Auto, Rad & Boot/Fahrräder & Zubehör",
+    "Auto, Rad & Boot/Motorräder & Motorroller",
+    "Auto, Rad & Boot/Motorradteile & Zubehör",
+    "Auto, Rad & Boot/Nutzfahrzeuge & Anhänger",
+    "Auto, Rad & Boot/Reparaturen & Dienstleistungen",
+    "Auto, Rad & Boot/Wohnwagen & -mobile",
+    "Auto, Rad & Boot/Weiteres Auto, Rad & Boot",
+    "Elektronik/Audio & Hifi",
+    "Elektronik/Dienstleistungen Elektronik",
+    "Elektronik/Foto",
+    "Elektronik/Handy & Telefon",
+    "Elektronik/Haushaltsgeräte",
+    "Elektronik/Konsolen",
+    "Elektronik/Notebooks",
+    "Elektronik/PCs",
+    "Elektronik/PC-Zubehör & Software",
+    "Elektronik/Tablets & Reader",
+    "Elektronik/TV & Video",
+    "Elektronik/Videospiele",
+    "Elektronik/Weitere Elektronik",
+    "Haus & Garten/Badezimmer",
+    "Haus & Garten/Büro",
+    "Haus & Garten/Dekoration",
+    "Haus & Garten/Dienstleistungen Haus & Garten",
+    "Haus & Garten/Gartenzubehör & Pflanzen",
+    "Haus & Garten/Heimtextilien",
+    "Haus & Garten/Heimwerken",
+    "Haus & Garten/Küche & Esszimmer",
+    "Haus & Garten/Lampen & Licht",
+    "Haus & Garten/Schlafzimmer",
+    "Haus & Garten/Wohnzimmer",
+    "Haus & Garten/Weiteres Haus & Garten",
+]
+Category = Enum("Category", {c: c for c in CATEGORIES}, type=str)
+
+class Condition(str, Enum):
+    NEU = "Neu"
+    SEHR_GUT = "Sehr Gut"
+    GUT = "Gut"
+    IN_ORDNUNG = "In Ordnung"
+    DEFEKT = "Defekt"
+
+# Antwortformate der LLM-Schritte (strukturierte Ausgabe, siehe llm.json_schema).
+# Für strict müssen alle Felder Pflicht sein; "kann fehlen" heißt Optional ohne Default.
 
 class IdentificationData(BaseModel):
-    brand: Optional[str]
-    model_or_type: Optional[str]
-    main_category: Optional[str]
-    sub_category: Optional[str]
+    model_config = ConfigDict(extra="forbid")
+
+    brand: Optional[str] = Field(description="Marke bzw. Hersteller")
+    model_or_type: Optional[str] = Field(description="Modell oder Produkttyp")
+    category: Category
     color: Optional[str]
-    condition: Optional[str]
-    special_notes: Optional[str]
-    user_input: str
+    condition: Condition
+    special_notes: Optional[str] = Field(description="Hinweise wie Zubehör oder Verpackung")
+
+class PriceSuggestionData(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    suggested_price: Optional[float] = Field(description="Preis in Euro, null ohne passende Vergleichsanzeigen")
+    pricerelevante_faktoren: str
+    explanation: str = Field(description="Wie viele und welche Anzeigen passen, sonst warum keine")
+
+class ListingData(BaseModel):
+    # Zustand, Kategorie und Preis ergänzt finalize_listing aus den Eingaben
+    model_config = ConfigDict(extra="forbid")
+
+    title: str = Field(description="max. 60 Zeichen")
+    description: str = Field(description="max. 500 Zeichen")
 
 class IdentificationStep(BaseModel):
     status: StepStatus = StepStatus.PENDING
     started_at: Optional[datetime] = None
     finished_at: Optional[datetime] = None
     data: Optional[IdentificationData] = None
+    confidence: Optional[Dict[str, float]] = None
 
 class AdProcess(BaseModel):
     user_id: str
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from decouple import config
+from pymongo import ReturnDocument
+from database import ad_collection, offline_collection
+from models import JobStatus
+import llm
+import log
+import logging
+
+# Offline-Modus für Schritte, die nicht sofort fertig sein müssen. Zurückgestellte
+# Schritte (ad_processes.offline.<schritt>) werden gesammelt, als JSONL-Datei an die
+# Batch-Schnittstelle übergeben und die Ergebnisse später in die Dokumente übernommen.
+# Das spart Kosten und lässt die Live-Quote für interaktive Nutzer frei.
+#
+# Status je Schritt: QUEUED (wartet) -> RUNNING (in einem Batch) -> DONE / ERROR.
+
+OFFLINE_ENABLED = config("OFFLINE_ENABLED", default=True, cast=bool)
+OFFLINE_INTERVAL = config("OFFLINE_INTERVAL", default=60.0, cast=float)
+OFFLINE_MAX_REQUESTS = config("OFFLINE_MAX_REQUESTS", default=5000, cast=int)
+OFFLINE_COMPLETION_WINDOW = config("OFFLINE_COMPLETION_WINDOW", default="24h")
+OFFLINE_LEASE_SECONDS = config("OFFLINE_LEASE_SECONDS", default=300, cast=int)
+# Preisnachlass der Batch-Schnittstelle für die Kostenschätzung
+OFFLINE_PRICE_FACTOR = config("OFFLINE_PRICE_FACTOR", default=0.5, cast=float)
+
+# Batch-Status der Schnittstelle, bei denen noch Ergebnisse kommen
+_ACTIVE = ("validating", "in_progress", "finalizing", "cancelling")
+
+# Schritt -> {"endpoint", "build", "ingest", "after"}; wird von den Routern befüllt.
+#   build(ad) -> Request-Body oder None, wenn Voraussetzungen fehlen
+#   ingest(ad, text) -> $set-Felder für das Dokument
+#   after: Schritte, die vorher fertig sein müssen, falls sie ebenfalls zurückgestellt sind
+_steps: dict[str, dict] = {}
+_task: asyncio.Task | None = None
+logger = logging.getLogger(__name__)
+
+
+def register(step: str, endpoint: str, build, ingest, after: tuple = ()):
+    _steps[step] = {"endpoint": endpoint, "build": build, "ingest": ingest, "after": after}
+
+
+async def defer(ad_id: ObjectId, step: str) -> dict:
+    await ad_collection.update_one(
+        {"_id": ad_id},
+        {"$set": {f"offline.{step}": {"status": JobStatus.QUEUED, "requested_at": datetime.utcnow()}}}
+    )
+    return {"status": "deferred", "ad_process_id": str(ad_id), "step": step}
+
+
+def _reply_text(body: dict) -> str:
+    # Text aus einer Chat-Completion oder einer Responses-Antwort
+    if body.get("choices"):
+        return body["choices"][0]["message"]["content"]
+    if body.get("output_text"):
+        return body["output_text"]
+    for item in body.get("output") or []:
+        for content in item.get("content") or []:
+            if content.get("type") == "output_text":
+                return content["text"]
+    raise ValueError("Antwort ohne Text")
+
+
+async def _create_batch(endpoint: str, lines: list[str]):
+    file = await llm.batch_client.files.create(
+        file=("requests.jsonl", "\n".join(lines).encode()),
+        purpose="batch"
+    )
+    return await llm.batch_client.batches.create(
+        input_file_id=file.id,
+        endpoint=endpoint,
+        completion_window=OFFLINE_COMPLETION_WINDOW
+    )
+
+
+async def _submit_step(step: str, spec: dict) -> dict | None:
+    # Wartende Dokumente mit eindeutiger Markierung übernehmen (sicher bei mehreren Workern)
+    query = {f"offline.{step}.status": JobStatus.QUEUED}
+    for dependency in spec["after"]:
+        query[f"offline.{dependency}.status"] = {"$nin": [JobStatus.QUEUED, JobStatus.RUNNING]}
+    ids = [doc["_id"] async for doc in ad_collection.find(query, {"_id": 1}).limit(OFFLINE_MAX_REQUESTS)]
+    if not ids:
+        return None
+    claim = uuid.uuid4().hex
+    await ad_collection.update_many(
+        {"_id": {"$in": ids}, f"offline.{step}.status": JobStatus.QUEUED},
+        {"$set": {f"offline.{step}.status": JobStatus.RUNNING, f"offline.{step}.claim": claim}}
+    )
+
+    lines, missing = [], []
+    async for ad in ad_collection.find({f"offline.{step}.claim": claim}):
+        body = spec["build"](ad)
+        if body is None:
+            missing.append(ad["_id"])
+            continue
+        lines.append(json.dumps({
+            "custom_id": f"{step}:{ad['_id']}",
+            "method": "POST",
+            "url": spec["endpoint"],
+            "body": body
+        }, ensure_ascii=False))
+
+    if missing:
+        await ad_collection.update_many({"_id": {"$in": missing}}, {"$set": {
+            f"offline.{step}.status": JobStatus.ERROR,
+            f"offline.{step}.error": "Voraussetzungen für den Schritt fehlen"
+        }})
+    if not lines:
+        return None
+
+    try:
+        batch = await _create_batch(spec["endpoint"], lines)
+    except Exception as e:
+        # Übergabe fehlgeschlagen: beim nächsten Durchlauf erneut versuchen
+        await ad_collection.update_many(
+            {f"offline.{step}.claim": claim, f"offline.{step}.status": JobStatus.RUNNING},
+            {"$set": {f"offline.{step}.status": JobStatus.QUEUED, f"offline.{step}.error": str(e)}}
+        )
+        raise
+
+    now = datetime.utcnow()
+    await offline_collection.insert_one({
+        "_id": batch.id,
+        "step": step,
+        "endpoint": spec["endpoint"],
+        "status": batch.status,
+        "requests": len(lines),
+        "created_at": now,
+        "updated_at": now
+    })
+    await ad_collection.update_many(
+        {f"offline.{step}.claim": claim, f"offline.{step}.status": JobStatus.RUNNING},
+        {"$set": {f"offline.{step}.batch_id": batch.id, f"offline.{step}.submitted_at": now}}
+    )
+    return {"batch_id": batch.id, "step": step, "requests": len(lines)}
+
+
+async def submit_pending() -> list[dict]:
+    submitted = []
+    for step, spec in _steps.items():
+        while (result := await _submit_step(step, spec)) is not None:
+            submitted.append(result)
+            if result["requests"] < OFFLINE_MAX_REQUESTS:
+                break
+    return submitted
+
+
+async def _ingest(record: dict, content: str) -> tuple[int, int]:
+    step = record["step"]
+    spec = _steps[step]
+    docs = {ad["_id"]: ad async for ad in ad_collection.find({f"offline.{step}.batch_id": record["_id"]})}
+
+    done = failed = 0
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            ad_id = ObjectId(item["custom_id"].split(":", 1)[1])
+        except (ValueError, KeyError, TypeError, AttributeError, IndexError, InvalidId) as e:
+            # Nur diese Zeile verwerfen; ihr Dokument bleibt RUNNING und wird in _finish als Fehler markiert
+            logger.warning("Offline-Ergebniszeile nicht lesbar", extra={"step": step, "error": str(e)})
+            failed += 1
+            continue
+        ad = docs.get(ad_id)
+        if ad is None:
+            continue
+        response = item.get("response") or {}
+        try:
+            if response.get("status_code") != 200:
+                raise ValueError((item.get("error") or {}).get("message") or f"HTTP {response.get('status_code')}")
+            body = response["body"]
+            llm.record_usage(body.get("model", ""), body.get("usage"), OFFLINE_PRICE_FACTOR)
+            fields = await spec["ingest"](ad, _reply_text(body))
+            fields.update({f"offline.{step}.status": JobStatus.DONE, f"offline.{step}.finished_at": datetime.utcnow()})
+            done += 1
+        except Exception as e:
+            with log.context(ad_process_id=ad_id):
+                logger.warning("Offline-Ergebnis nicht übernommen", extra={"step": step, "error": str(getattr(e, "detail", e))})
+            fields = {f"offline.{step}.status": JobStatus.ERROR, f"offline.{step}.error": str(getattr(e, "detail", e))}
+            failed += 1
+        await ad_collection.update_one({"_id": ad_id}, {"$set": fields})
+    return done, failed
+
+
+async def _finish(record: dict, batch) -> dict:
+    step = record["step"]
+    done = failed = 0
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            content = await llm.batch_client.files.content(file_id)
+            d, f = await _ingest(record, content.text)
+            done, failed = done + d, failed + f
+
+    # Ohne Ergebnis gebliebene Anfragen: abgelaufene Batches erneut einreihen, sonst Fehler
+    requeue = batch.status in ("expired", "cancelled")
+    await ad_collection.update_many(
+        {f"offline.{step}.batch_id": record["_id"], f"offline.{step}.status": JobStatus.RUNNING},
+        {"$set": {f"offline.{step}.status": JobStatus.QUEUED if requeue else JobStatus.ERROR,
+                  f"offline.{step}.error": f"Batch {batch.status}"}}
+    )
+    summary = {"status": batch.status, "done": done, "failed": failed}
+    await offline_collection.update_one({"_id": record["_id"]}, {
+        "$set": {**summary, "finished_at": datetime.utcnow(), "updated_at": datetime.utcnow()},
+        "$unset": {"lease_until": ""}
+    })
+    return {"batch_id": record["_id"], "step": step, **summary}
+
+
+async def poll() -> list[dict]:
+    finished = []
+    while True:
+        now = datetime.utcnow()
+        # Offenen Batch per Lease übernehmen, damit ihn nur ein Worker verarbeitet
+        record = await offline_collection.find_one_and_update(
+            {"status": {"$in": _ACTIVE}, "lease_until": {"$not": {"$gt": now}},
+             "checked_at": {"$not": {"$gt": now - timedelta(seconds=OFFLINE_INTERVAL / 2)}}},
+            {"$set": {"lease_until": now + timedelta(seconds=OFFLINE_LEASE_SECONDS), "checked_at": now}},
+            return_document=ReturnDocument.AFTER
+        )
+        if record is None:
+            return finished
+
+        batch = await llm.batch_client.batches.retrieve(record["_id"])
+        if batch.status in _ACTIVE:
+            await offline_collection.update_one({"_id": record["_id"]}, {
+                "$set": {"status": batch.status, "updated_at": datetime.utcnow()},
+                "$unset": {"lease_until": ""}
+            })
+            continue
+        finished.append(await _finish(record, batch))
+
+
+async def _loop():
+    while True:
+        try:
+            await submit_pending()
+            await poll()
+        except Exception:
+            logger.exception("Offline-Durchlauf fehlgeschlagen")
+        await asyncio.sleep(OFFLINE_INTERVAL)
+
+
+def start():
+    global _task
+    if OFFLINE_ENABLED and _task is None:
+        _task = asyncio.create_task(_loop())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+
+async def ensure_indexes():
+    await offline_collection.create_index("status")
+    for step in _steps:
+        await ad_collection.create_index(f"offline.{step}.status", sparse=True)
+        await ad_collection.create_index(f"offline.{step}.batch_id", sparse=True)
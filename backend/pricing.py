@@ -0,0 +1,86 @@
+import re
+import numpy as np
+from decouple import config
+from market import parse_price
+
+# Statistische Preisschätzung aus Vergleichsanzeigen als schneller Pfad vor GPT-4o:
+# Preise parsen, Ausreißer entfernen, nach Ähnlichkeit zu Marke/Modell/Zustand
+# gewichten und einen gewichteten Median samt Konfidenzintervall berechnen.
+
+PRICE_ESTIMATE_MIN_CONFIDENCE = config("PRICE_ESTIMATE_MIN_CONFIDENCE", default=0.6, cast=float)
+# Ab dieser effektiven Anzahl Vergleichsanzeigen gilt die Datenbasis als ausreichend
+PRICE_ESTIMATE_MIN_SAMPLES = config("PRICE_ESTIMATE_MIN_SAMPLES", default=4.0, cast=float)
+
+_BOOTSTRAP_ROUNDS = 500
+_OUTLIER_Z = 3.5
+
+# Zustände in absteigender Qualität (wie im Identifikations-Prompt)
+CONDITION_RANK = {"neu": 0, "sehr gut": 1, "gut": 2, "in ordnung": 3, "defekt": 4}
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _tokens(text) -> set[str]:
+    return set(_TOKEN_RE.findall(str(text or "").casefold()))
+
+
+def _condition_rank(condition) -> int | None:
+    return CONDITION_RANK.get(" ".join(str(condition or "").casefold().split()))
+
+
+def _weighted_median(values: np.ndarray, weights: np.ndarray) -> float:
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order])
+    return float(values[order][np.searchsorted(cumulative, cumulative[-1] / 2)])
+
+
+def estimate(features: dict, comparables: list[dict]) -> dict | None:
+    prices = np.array([parse_price(c.get("price")) or np.nan for c in comparables], dtype=float)
+
+    # Ähnlichkeit: Anteil der Marken-/Modell-Tokens, die im Titel vorkommen
+    product = _tokens(features.get("brand")) | _tokens(features.get("model_or_type"))
+    similarity = np.array([
+        len(product & _tokens(c.get("title"))) / len(product) if product else 1.0
+        for c in comparables
+    ])
+
+    # Zustand: je weiter entfernt vom eigenen Zustand, desto geringer das Gewicht
+    own = _condition_rank(features.get("condition"))
+    ranks = [_condition_rank(c.get("condition")) for c in comparables]
+    condition_weight = np.array([
+        1.0 if own is None or r is None else 1.0 / (1 + abs(own - r)) for r in ranks
+    ])
+
+    weights = similarity * condition_weight
+    mask = (prices > 0) & (weights > 0)
+    prices, weights = prices[mask], weights[mask]
+    if prices.size == 0:
+        return None
+
+    # Ausreißer über den robusten z-Wert (Median/MAD) auf Log-Preisen entfernen
+    logs = np.log(prices)
+    median = np.median(logs)
+    mad = np.median(np.abs(logs - median))
+    if mad > 0:
+        keep = np.abs(0.6745 * (logs - median) / mad) <= _OUTLIER_Z
+        prices, weights = prices[keep], weights[keep]
+
+    value = _weighted_median(prices, weights)
+
+    # Konfidenzintervall per gewichtetem Bootstrap (fester Seed -> deterministisch)
+    rng = np.random.default_rng(0)
+    samples = prices[rng.choice(prices.size, size=(_BOOTSTRAP_ROUNDS, prices.size), p=weights / weights.sum())]
+    low, high = np.percentile(np.median(samples, axis=1), [5, 95])
+
+    effective_n = weights.sum() ** 2 / (weights ** 2).sum()
+    spread = (high - low) / value if value > 0 else 1.0
+    confidence = float(min(1.0, effective_n / PRICE_ESTIMATE_MIN_SAMPLES) * max(0.0, 1.0 - spread))
+
+    return {
+        "value": round(float(value), 2),
+        "low": round(float(low), 2),
+        "high": round(float(high), 2),
+        "confidence": round(confidence, 2),
+        "samples": int(prices.size),
+        "outliers_removed": int(mask.sum() - prices.size)
+    }
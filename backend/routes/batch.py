@@ -0,0 +1,324 @@
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import Response
+from pydantic import BaseModel, Field
+from typing import Literal, Optional
+from bson import ObjectId
+from bson.errors import InvalidId
+from datetime import datetime
+from decouple import config
+from config import CurrentConfig
+from database import ad_collection, batch_collection
+from models import JobStatus, StepStatus, WizardState
+from routes.identify import identify_images
+from routes.price import search_comparables, suggest_price
+from routes.listing import write_listing
+import asyncio
+import catalog
+import csv
+import images
+import io
+import jobs
+import log
+import metrics
+import wizard
+
+router = APIRouter()
+
+# Sammel-Erstellung für Händler: viele Bildsätze in einem Aufruf. Die AdProcesses
+# werden per insert_many angelegt und im Job-Worker mit begrenzter Parallelität
+# durchlaufen. Gleiche Produkte (Produktschlüssel + Zustand) werden nur einmal bepreist.
+
+BATCH_MAX_ITEMS = config("BATCH_MAX_ITEMS", default=500, cast=int)
+BATCH_CONCURRENCY = config("BATCH_CONCURRENCY", default=8, cast=int)
+
+
+class BatchItem(BaseModel):
+    image_urls: list[str] = Field(..., min_length=1)
+    brand: Optional[str] = None
+    model_or_type: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    items: list[BatchItem] = Field(..., min_length=1)
+    user_id: Optional[str] = None
+    explain_price: bool = False
+    listing_generator: Literal["llm", "template"] = "llm"
+
+
+class BatchRunRequest(BaseModel):
+    batch_id: str
+
+
+def _batch_id(batch_id: str) -> ObjectId:
+    try:
+        return ObjectId(batch_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Ungültige batch_id")
+
+
+def price_group(features: dict) -> str:
+    # Gleiches Produkt im gleichen Zustand -> ein gemeinsamer Preis
+    condition = " ".join(str(features.get("condition") or "").casefold().split())
+    return f"{catalog.product_key(features.get('brand'), features.get('model_or_type'))}|{condition}"
+
+
+@router.post("/")
+async def create_batch(req: BatchRequest):
+    if len(req.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Maximal {BATCH_MAX_ITEMS} Artikel pro Batch")
+
+    now = datetime.utcnow()
+    batch = await batch_collection.insert_one({
+        "user_id": req.user_id,
+        "status": JobStatus.QUEUED,
+        "total": len(req.items),
+        "done": 0,
+        "failed": 0,
+        "options": {"explain_price": req.explain_price, "listing_generator": req.listing_generator},
+        "created_at": now,
+        "updated_at": now
+    })
+    batch_id = batch.inserted_id
+
+    # Manifeste aller Bilder mit einer einzigen Abfrage laden
+    all_urls = [url for item in req.items for url in item.image_urls]
+    manifests = iter(await images.load_manifests(all_urls))
+
+    docs = []
+    for index, item in enumerate(req.items):
+        hints = {k: v for k, v in (("brand", item.brand), ("model_or_type", item.model_or_type)) if v}
+        docs.append({
+            "user_id": req.user_id,
+            "batch_id": batch_id,
+            "batch_index": index,
+            "created_at": now,
+            "wizard_state": WizardState.STARTED,
+            "image_urls": item.image_urls,
+            "images": [next(manifests) for _ in item.image_urls],
+            "hints": hints
+        })
+    await ad_collection.insert_many(docs, ordered=True)
+
+    response = await jobs.submit("batch", BatchRunRequest(batch_id=str(batch_id)))
+    response.headers["Location"] = f"{CurrentConfig.API_PREFIX}/batch/{batch_id}"
+    return response
+
+
+async def _process(ad: dict, options: dict, groups: dict[str, asyncio.Task], sem: asyncio.Semaphore):
+    ad_id = ad["_id"]
+    log.bind(ad_process_id=ad_id)
+    stage = "identification"
+    claimed = False
+    with metrics.stage("batch_item") as span:
+        try:
+            async with sem:
+                # Artikel wie eine Pipeline belegen: solange er läuft, werden Einzelschritte,
+                # Änderungen des Nutzers und ein zweiter Lauf (retry) abgelehnt
+                await wizard.begin(ad_id, "pipeline", {"_id": 1}, fields={
+                    "identification.status": StepStatus.PENDING,
+                    "identification.started_at": datetime.utcnow()
+                })
+                claimed = True
+                features, confidence = await identify_images(ad["image_urls"], ad.get("images") or [None] * len(ad["image_urls"]))
+                features.update(ad.get("hints") or {})
+                await wizard.save(ad_id, "pipeline", {
+                    "identification.data": features,
+                    "identification.confidence": confidence,
+                    "identification.status": StepStatus.DONE,
+                    "identification.finished_at": datetime.utcnow(),
+                    "wizard_state": WizardState.IDENTIFIED
+                })
+
+                stage = "price"
+                if not features.get("brand") or not features.get("model_or_type"):
+                    raise HTTPException(status_code=400, detail="Produktdaten unvollständig für Vergleichssuche")
+                key = price_group(features)
+                task = groups.get(key)
+                if task is None:
+                    task = groups[key] = asyncio.create_task(_price(features, options["explain_price"]))
+            # Auf den Gruppenpreis ohne Slot warten, damit andere Artikel weiterlaufen
+            comparables, suggestion = await asyncio.shield(task)
+
+            async with sem:
+                await wizard.save(ad_id, "pipeline", {
+                    "price_data.comparables": comparables,
+                    "price_data.suggestion": suggestion,
+                    "price_data.group": key,
+                    "wizard_state": WizardState.PRICE_SUGGESTED if suggestion else WizardState.COMPARABLES_RETRIEVED
+                })
+
+                stage = "listing"
+                listing = await write_listing(features, suggestion.get("suggested_price"), options["listing_generator"])
+                saved = await wizard.complete(ad_id, "pipeline", {"listing": listing, **span.timings()},
+                                              WizardState.LISTING_READY)
+                if not saved:
+                    raise wizard.StepLost()
+            return True
+
+        except Exception as e:
+            span.failed = True
+            # Nicht belegte Artikel gehören einem anderen Lauf und bleiben unverändert
+            if claimed:
+                fields = {"pipeline.failed_stage": stage, **span.timings()}
+                if stage == "identification":
+                    fields["identification.status"] = StepStatus.ERROR
+                await wizard.fail(ad_id, "pipeline", e, fields)
+            return False
+
+
+async def _price(features: dict, explain: bool) -> tuple[list[dict], dict]:
+    comparables = await search_comparables(features)
+    suggestion = await suggest_price(features, comparables, explain) if comparables else {}
+    return comparables, suggestion
+
+
+async def run_batch(req: BatchRunRequest):
+    batch_id = _batch_id(req.batch_id)
+    batch = await batch_collection.find_one({"_id": batch_id})
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch nicht gefunden")
+
+    # Zähler aus dem Stand der Artikel neu aufsetzen: bei Wiederholung (retry) und
+    # Wiederaufnahme laufen alle nicht fertigen Artikel erneut und zählen nur einmal
+    finished = await ad_collection.count_documents({"batch_id": batch_id, "wizard_state": WizardState.LISTING_READY})
+    await batch_collection.update_one({"_id": batch_id}, {"$set": {
+        "status": JobStatus.RUNNING, "done": finished, "failed": 0,
+        "started_at": datetime.utcnow(), "updated_at": datetime.utcnow()
+    }})
+
+    # Bereits fertige Artikel überspringen (Wiederaufnahme nach Neustart)
+    pending = await ad_collection.find(
+        {"batch_id": batch_id, "wizard_state": {"$ne": WizardState.LISTING_READY}},
+        {"image_urls": 1, "images": 1, "hints": 1}
+    ).to_list(length=None)
+
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+    groups: dict[str, asyncio.Task] = {}
+
+    async def tracked(ad: dict):
+        ok = await _process(ad, batch["options"], groups, sem)
+        await batch_collection.update_one({"_id": batch_id}, {
+            "$inc": {"done" if ok else "failed": 1},
+            "$set": {"updated_at": datetime.utcnow()}
+        })
+
+    try:
+        await asyncio.gather(*(tracked(ad) for ad in pending))
+    finally:
+        for task in groups.values():
+            task.cancel()
+
+    done = await ad_collection.count_documents({"batch_id": batch_id, "wizard_state": WizardState.LISTING_READY})
+    summary = {
+        "done": done,
+        "failed": batch["total"] - done,
+        "price_groups": len(groups)
+    }
+    await batch_collection.update_one({"_id": batch_id}, {"$set": {
+        **summary,
+        "status": JobStatus.DONE if done == batch["total"] else JobStatus.ERROR,
+        "finished_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
+    }})
+    return {"batch_id": req.batch_id, **summary}
+
+
+jobs.register("batch", run_batch, BatchRunRequest)
+
+
+@router.get("/{batch_id}")
+async def get_batch(batch_id: str):
+    oid = _batch_id(batch_id)
+    batch = await batch_collection.find_one({"_id": oid})
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch nicht gefunden")
+
+    # Verteilung der Artikel auf die Wizard-Schritte
+    states = {
+        doc["_id"]: doc["count"]
+        async for doc in ad_collection.aggregate([
+            {"$match": {"batch_id": oid}},
+            {"$group": {"_id": "$wizard_state", "count": {"$sum": 1}}}
+        ])
+    }
+    return {
+        "batch_id": batch_id,
+        "status": batch["status"],
+        "total": batch["total"],
+        "done": batch.get("done", 0),
+        "failed": batch.get("failed", 0),
+        "price_groups": batch.get("price_groups"),
+        "states": states,
+        "created_at": batch["created_at"],
+        "finished_at": batch.get("finished_at")
+    }
+
+
+@router.post("/{batch_id}/retry")
+async def retry_batch(batch_id: str):
+    # Nicht fertige Artikel (z. B. nach Upstream-Überlast) erneut durchlaufen
+    oid = _batch_id(batch_id)
+    batch = await batch_collection.find_one_and_update(
+        {"_id": oid, "status": {"$in": [JobStatus.DONE, JobStatus.ERROR]}},
+        {"$set": {"status": JobStatus.QUEUED, "updated_at": datetime.utcnow()}}
+    )
+    if not batch:
+        raise HTTPException(status_code=409, detail="Batch nicht gefunden oder läuft noch")
+    return await jobs.submit("batch", BatchRunRequest(batch_id=batch_id))
+
+
+RESULT_FIELDS = ["batch_index", "ad_process_id", "wizard_state", "brand", "model_or_type", "category",
+                 "condition", "suggested_price", "title", "description", "error"]
+
+
+def _result_row(ad: dict) -> dict:
+    data = ad.get("identification", {}).get("data") or {}
+    listing = ad.get("listing") or {}
+    return {
+        "batch_index": ad.get("batch_index"),
+        "ad_process_id": str(ad["_id"]),
+        "wizard_state": ad.get("wizard_state"),
+        "brand": data.get("brand"),
+        "model_or_type": data.get("model_or_type"),
+        "category": listing.get("category") or data.get("category"),
+        "condition": listing.get("condition") or data.get("condition"),
+        "suggested_price": ad.get("price_data", {}).get("suggestion", {}).get("suggested_price"),
+        "title": listing.get("title"),
+        "description": listing.get("description"),
+        "error": ad.get("pipeline", {}).get("error")
+    }
+
+
+@router.get("/{batch_id}/results")
+async def get_batch_results(batch_id: str, format: Literal["json", "csv"] = Query("json")):
+    oid = _batch_id(batch_id)
+    if not await batch_collection.find_one({"_id": oid}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Batch nicht gefunden")
+
+    cursor = ad_collection.find({"batch_id": oid}, {
+        "batch_index": 1,
+        "wizard_state": 1,
+        "identification.data": 1,
+        "price_data.suggestion.suggested_price": 1,
+        "listing": 1,
+        "pipeline.error": 1
+    }).sort("batch_index", 1)
+    rows = [_result_row(ad) async for ad in cursor]
+
+    if format == "json":
+        return rows
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=RESULT_FIELDS, delimiter=";")
+    writer.writeheader()
+    writer.writerows(rows)
+    return Response(
+        # BOM, damit Excel Umlaute korrekt erkennt
+        content="\ufeff" + buffer.getvalue(),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="batch-{batch_id}.csv"'}
+    )
+
+
+async def ensure_indexes():
+    await ad_collection.create_index([("batch_id", 1), ("batch_index", 1)], sparse=True)
@@ -1,85 +1,122 @@
 from fastapi import APIRouter, HTTPException
 from database import ad_collection
 from schemas import IdentifyRequest
-from models import StepStatus, WizardState
+from models import IdentificationData, StepStatus, WizardState
 from datetime import datetime
-from openai import OpenAI
-from bson import ObjectId
+from identification import IDENTIFY_FORMAT, IDENTIFY_MODEL, IDENTIFY_PROMPT, PROMPT_VERSION, \
+    cached_identification, fuse_identifications, store_identification
 from decouple import config
-import json
-from pydantic import BaseModel, Field
-from bson.errors import InvalidId
+import asyncio
+import catalog
+import images
+import jobs
+import llm
+import metrics
+import offline
+import upstream
+import wizard
+import math
+import log
+import logging
+from pydantic import BaseModel, Field, ValidationError
 
 router = APIRouter(tags=["identify"])
-client = OpenAI(api_key=config("OPENAI_API_KEY"))
-
-PROMPT_1 = """
-Du bist Produkterkennungs-Experte für digitale Kleinanzeigen. 
-Analysiere Nutzer-Bilder, um das Produkt zu identifizieren. 
-
-Gib als Ergebnis ein JSON mit folgenden Feldern zurück. Die Werte in den Feldern auf deutsch!:
-- brand
-- model_or_type
-- category
-- color
-- condition
-- special_notes
-
-Wähle für \"category\" exakt eine Kombination im Format \"Hauptkategorie/Unterkategorie\" aus dieser Liste:
-Auto, Rad & Boot/Autos
-Auto, Rad & Boot/Autoteile & Reifen
-Auto, Rad & Boot/Boote & Bootszubehör
-Auto, Rad & Boot/Fahrräder & Zubehör
-Auto, Rad & Boot/Motorräder & Motorroller
-Auto, Rad & Boot/Motorradteile & Zubehör
-Auto, Rad & Boot/Nutzfahrzeuge & Anhänger
-Auto, Rad & Boot/Reparaturen & Dienstleistungen
-Auto, Rad & Boot/Wohnwagen & -mobile
-Auto, Rad & Boot/Weiteres Auto, Rad & Boot
-Elektronik/Audio & Hifi
-Elektronik/Dienstleistungen Elektronik
-Elektronik/Foto
-Elektronik/Handy & Telefon
-Elektronik/Haushaltsgeräte
-Elektronik/Konsolen
-Elektronik/Notebooks
-Elektronik/PCs
-Elektronik/PC-Zubehör & Software
-Elektronik/Tablets & Reader
-Elektronik/TV & Video
-Elektronik/Videospiele
-Elektronik/Weitere Elektronik
-Haus & Garten/Badezimmer
-Haus & Garten/Büro
-Haus & Garten/Dekoration
-Haus & Garten/Dienstleistungen Haus & Garten
-Haus & Garten/Gartenzubehör & Pflanzen
-Haus & Garten/Heimtextilien
-Haus & Garten/Heimwerken
-Haus & Garten/Küche & Esszimmer
-Haus & Garten/Lampen & Licht
-Haus & Garten/Schlafzimmer
-Haus & Garten/Wohnzimmer
-Haus & Garten/Weiteres Haus & Garten
-
-Für \"condition\" verwende nur einen dieser Begriffe:
-- Neu
-- Sehr Gut
-- Gut
-- In Ordnung
-- Defekt
-
-\"special_notes\" kann optional Hinweise wie Zubehör oder Verpackung in deutscher Sprache enthalten.
-
-Antworte ausschließlich mit einem gültigen JSON, keine zusätzlichen Erklärungen oder Freitexte. Werte in den Feldern auf deutsch!
-"""
+logger = logging.getLogger(__name__)
+
+# Maximale Anzahl paralleler Vision-Aufrufe pro Identifikation
+IDENTIFY_FANOUT_MAX = config("IDENTIFY_FANOUT_MAX", default=4, cast=int)
+
 
 class IdentificationValidation(BaseModel):
     ad_process_id: str
     validated_data: dict = Field(...)
 
+def identify_request(image_urls: list[str]) -> dict:
+    # Parameter der Responses-API, auch als Body für die Batch-Schnittstelle (offline.py)
+    return {
+        "model": IDENTIFY_MODEL,
+        "instructions": IDENTIFY_PROMPT,
+        "input": [{
+            "role": "user",
+            "content": [{"type": "input_image", "image_url": url} for url in image_urls]
+        }],
+        "text": {"format": IDENTIFY_FORMAT},
+        "prompt_cache_key": f"identify-{PROMPT_VERSION}",
+        "reasoning": {},
+        "tools": [],
+        "temperature": 1,
+        "max_output_tokens": 2048,
+        "top_p": 1,
+        "store": True
+    }
+
+
+def parse_identification(text: str) -> dict:
+    # Bei strukturierter Ausgabe nur noch bei Abbruch (max_output_tokens) oder Ablehnung
+    try:
+        return IdentificationData.model_validate_json(text).model_dump(mode="json")
+    except ValidationError:
+        raise HTTPException(status_code=500, detail=f"Antwort entspricht nicht dem Schema: {text}")
+
+
+async def _identify_image(image_urls: list[str]) -> dict:
+    request = identify_request(image_urls)
+    response = await llm.create_response(**request)
+
+    # Vollständige Anfrage/Antwort nur stichprobenartig und gekürzt
+    if log.sampled():
+        logger.info("OpenAI-Aufruf (Erkennung)", extra={
+            "request": log.redact(request),
+            "response": log.redact(response.model_dump())
+        })
+
+    return parse_identification(response.output_text)
+
+
+async def _identify_group(urls: list[str], manifests: list[dict | None]) -> dict:
+    # Eine Bildgruppe erkennen, Ergebnis pro Gruppe (bzw. Einzelbild) cachen
+    fingerprint = "+".join(images.fingerprint(u, m) for u, m in zip(urls, manifests))
+    cached = await cached_identification(fingerprint)
+    if cached is not None:
+        return cached
+
+    # Verkleinerte Varianten sparen Vision-Tokens und Übertragungszeit
+    parsed = await _identify_image([images.vision_url(u, m) for u, m in zip(urls, manifests)])
+    await store_identification(fingerprint, parsed)
+    return parsed
+
+
+async def identify_images(urls: list[str], manifests: list[dict | None]) -> tuple[dict, dict]:
+    # Bis IDENTIFY_FANOUT_MAX Bilder werden einzeln und parallel erkannt, größere
+    # Sätze in höchstens so viele Mehrbild-Anfragen gepackt. Die Laufzeit bleibt
+    # damit nahe an einem einzelnen Aufruf.
+    size = max(1, math.ceil(len(urls) / IDENTIFY_FANOUT_MAX))
+    groups = [range(i, min(i + size, len(urls))) for i in range(0, len(urls), size)]
+
+    results = await asyncio.gather(
+        *(_identify_group([urls[i] for i in g], [manifests[i] for i in g]) for g in groups),
+        return_exceptions=True
+    )
+    weighted = [(r, len(g)) for r, g in zip(results, groups) if not isinstance(r, BaseException)]
+    if not weighted:
+        raise results[0]
+    fused, confidence = fuse_identifications(weighted)
+    catalog.learn(fused.get("brand"), fused.get("model_or_type"))
+    return fused, confidence
+
+
 @router.post("/")
-async def identify(req: IdentifyRequest):
+async def identify(req: IdentifyRequest, job: bool = False):
+    # Job-Modus: sofort 202 zurückgeben, Ausführung im Hintergrund-Worker
+    if job:
+        return await jobs.submit("identify", req)
+
+    if not req.image_urls:
+        raise HTTPException(status_code=400, detail="No image URLs provided")
+
+    # Bild-Manifeste der Uploads (Varianten, Größen) am AdProcess ablegen
+    manifests = await images.load_manifests(req.image_urls)
+
     # Falls keine ad_process_id übergeben wurde, neues Dokument anlegen
     if not req.ad_process_id:
         new_ad = {
@@ -89,123 +126,92 @@ async def identify(req: IdentifyRequest):
                 "started_at": datetime.utcnow()
             },
             "image_urls": req.image_urls,
+            "images": manifests,
+            "user_id": req.user_id,
             "created_at": datetime.utcnow()
         }
         insert_result = await ad_collection.insert_one(new_ad)
         ad_id = insert_result.inserted_id
+        log.bind(ad_process_id=ad_id)
     else:
-        # Gültige ObjectId prüfen
-        try:
-            ad_id = ObjectId(req.ad_process_id)
-        except InvalidId:
-            raise HTTPException(status_code=400, detail="Ungültige ad_process_id")
-
-        ad = await ad_collection.find_one({"_id": ad_id})
-        if not ad:
-            raise HTTPException(status_code=404, detail="AdProcess not found")
-
-        # Bei erneutem Aufruf Status und Zeit aktualisieren
-        await ad_collection.update_one(
-            {"_id": ad_id},
-            {"$set": {
-                "identification.status": StepStatus.PENDING,
-                "identification.started_at": datetime.utcnow(),
-                "image_urls": req.image_urls
-            }}
-        )
-
-    if not req.image_urls:
-        raise HTTPException(status_code=400, detail="No image URLs provided")
+        # Erneuter Aufruf: Status setzen und Bilder ersetzen, abgelehnt solange eine Erkennung läuft
+        ad_id = wizard.object_id(req.ad_process_id)
+        await wizard.begin(ad_id, "identification", {"_id": 1}, fields={
+            "image_urls": req.image_urls,
+            "images": manifests
+        })
 
-    try:
-        print("\n🔍 OPENAI REQUEST (IDENTIFY):")
-        print("=" * 80)
-        print(json.dumps({
-            "model": "gpt-4.1-mini",
-            "input": [{
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": PROMPT_1},
-                    {"type": "input_image", "image_url": req.image_urls[0]}
-                ]
-            }],
-            "text": {"format": {"type": "text"}},
-            "reasoning": {},
-            "tools": [],
-            "temperature": 1,
-            "max_output_tokens": 2048,
-            "top_p": 1,
-            "store": True
-        }, indent=2, ensure_ascii=False))
-        print("=" * 80)
-        
-        response = client.responses.create(
-            model="gpt-4.1-mini",
-            input=[{
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": PROMPT_1},
-                    {"type": "input_image", "image_url": req.image_urls[0]}
-                ]
-            }],
-            text={"format": {"type": "text"}},
-            reasoning={},
-            tools=[],
-            temperature=1,
-            max_output_tokens=2048,
-            top_p=1,
-            store=True
-        )
-        
-        print("\n🔍 OPENAI RESPONSE (IDENTIFY):")
-        print("=" * 80)
-        print(json.dumps(response.model_dump(), indent=2, ensure_ascii=False))
-        print("=" * 80)
-
-        parsed_text = response.output[0].content[0].text.strip()
-        # JSON-Code-Fence entfernen
-        if parsed_text.startswith("```json"):
-            parsed_text = parsed_text.removeprefix("```json").removesuffix("```").strip()
-        elif parsed_text.startswith("```"):
-            parsed_text = parsed_text.removeprefix("```").removesuffix("```").strip()
+    if req.deferred:
+        return await offline.defer(ad_id, "identification")
 
+    with metrics.stage("identification"):
         try:
-            parsed = json.loads(parsed_text)
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=500, detail=f"Antwort kein gültiges JSON: {parsed_text}")
-
-        # Ergebnis speichern
-        await ad_collection.update_one(
-            {"_id": ad_id},
-            {"$set": {
-                "identification.data": parsed,
-                "identification.status": StepStatus.DONE,
-                "identification.finished_at": datetime.utcnow(),
-                "wizard_state": WizardState.IDENTIFIED
-            }}
-        )
-
-        return {"status": "success", "ad_process_id": str(ad_id), "identification": parsed}
+            parsed, confidence = await identify_images(req.image_urls, manifests)
 
-    except Exception as e:
-        await ad_collection.update_one(
-            {"_id": ad_id},
-            {"$set": {"identification.status": StepStatus.ERROR}}
-        )
-        raise HTTPException(status_code=500, detail=f"OpenAI-Fehler: {str(e)}")
+            # Ergebnis speichern
+            saved = await wizard.complete(ad_id, "identification", {
+                "identification.data": parsed,
+                "identification.confidence": confidence
+            }, WizardState.IDENTIFIED)
+            if not saved:
+                raise wizard.StepLost()
+
+            return {
+                "status": "success",
+                "ad_process_id": str(ad_id),
+                "identification": parsed,
+                "confidence": confidence
+            }
+
+        except Exception as e:
+            await wizard.fail(ad_id, "identification", e)
+            # Überlast als 503 mit Retry-After weiterreichen, nicht als 500
+            if isinstance(e, (upstream.UpstreamError, wizard.StepLost)):
+                raise
+            raise HTTPException(status_code=500, detail=f"OpenAI-Fehler: {str(e)}")
+
+
+jobs.register("identify", identify, IdentifyRequest)
+
+
+def _offline_request(ad: dict) -> dict | None:
+    urls = ad.get("image_urls")
+    if not urls:
+        return None
+    manifests = ad.get("images") or [None] * len(urls)
+    return identify_request([images.vision_url(u, m) for u, m in zip(urls, manifests)])
+
+
+async def _offline_result(ad: dict, text: str) -> dict:
+    # Alle Bilder in einer Anfrage: wie eine einzelne Gruppe in identify_images
+    urls = ad["image_urls"]
+    manifests = ad.get("images") or [None] * len(urls)
+    parsed = parse_identification(text)
+    fingerprint = "+".join(images.fingerprint(u, m) for u, m in zip(urls, manifests))
+    await store_identification(fingerprint, parsed)
+    fused, confidence = fuse_identifications([(parsed, len(urls))])
+    catalog.learn(fused.get("brand"), fused.get("model_or_type"))
+    return {
+        "identification.data": fused,
+        "identification.confidence": confidence,
+        "identification.status": StepStatus.DONE,
+        "identification.finished_at": datetime.utcnow(),
+        "wizard_state": WizardState.IDENTIFIED
+    }
+
+offline.register("identification", "/v1/responses", _offline_request, _offline_result)
 
 
 @router.patch("/validate")
 async def validate_identification(data: IdentificationValidation):
-    ad_id = ObjectId(data.ad_process_id)
-    result = await ad_collection.update_one(
-        {"_id": ad_id},
-        {"$set": {
-            "identification.data": data.validated_data,
-            "wizard_state": WizardState.IDENTIFIED
-        }}
+    # Nicht während einer laufenden Erkennung überschreiben
+    await wizard.update(
+        wizard.object_id(data.ad_process_id),
+        {"identification.data": data.validated_data},
+        {"_id": 1},
+        idle="identification",
+        state=WizardState.IDENTIFIED
     )
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Eintrag nicht gefunden oder nicht geändert")
+    catalog.learn(data.validated_data.get("brand"), data.validated_data.get("model_or_type"))
 
     return {"status": "validation stored"}
@@ -0,0 +1,97 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from bson import ObjectId
+from bson.errors import InvalidId
+from database import ad_collection, job_collection
+from models import JobStatus
+from streaming import SSE_HEADERS, sse
+import asyncio
+import jobs
+import wizard
+
+router = APIRouter()
+
+EVENT_POLL_INTERVAL = 0.5
+FINAL_STATES = (JobStatus.DONE, JobStatus.ERROR)
+
+
+def _job_id(job_id: str) -> ObjectId:
+    try:
+        return ObjectId(job_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Ungültige job_id")
+
+
+def _job_view(job: dict) -> dict:
+    return {
+        "job_id": str(job["_id"]),
+        "kind": job["kind"],
+        "status": job["status"],
+        "ad_process_id": job.get("ad_process_id"),
+        "attempts": job.get("attempts", 0),
+        "result": job.get("result"),
+        "error": job.get("error")
+    }
+
+
+def _step_status(ad: dict, step: str):
+    node = ad
+    for part in wizard.STEP_FIELDS[step].split("."):
+        node = node.get(part) or {}
+    return node.get("status")
+
+
+async def _progress(job: dict) -> dict:
+    # Job-Status plus Wizard-Status und Status des Schritts, den der Job ausführt
+    view = _job_view(job)
+    try:
+        ad_id = ObjectId(job.get("ad_process_id"))
+    except (InvalidId, TypeError):
+        # Ohne (gültige) ad_process_id, z. B. Batches oder Altbestand
+        return view
+
+    step = jobs.JOB_STEPS.get(job["kind"])
+    projection = {"wizard_state": 1, "identification.status": 1}
+    if step:
+        projection[f"{wizard.STEP_FIELDS[step]}.status"] = 1
+    ad = await ad_collection.find_one({"_id": ad_id}, projection)
+    if ad:
+        view["wizard_state"] = ad.get("wizard_state")
+        view["identification_status"] = _step_status(ad, "identification")
+        if step:
+            view["step"] = step
+            view["step_status"] = _step_status(ad, step)
+    return view
+
+
+@router.get("/{job_id}")
+async def get_job(job_id: str):
+    job = await job_collection.find_one({"_id": _job_id(job_id)})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job nicht gefunden")
+    return await _progress(job)
+
+
+@router.get("/{job_id}/events")
+async def job_events(job_id: str):
+    oid = _job_id(job_id)
+    if not await job_collection.find_one({"_id": oid}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Job nicht gefunden")
+
+    async def stream():
+        # Server-Sent Events: jede Änderung von Job- oder Wizard-Status wird gesendet
+        last = None
+        while True:
+            job = await job_collection.find_one({"_id": oid})
+            if job is None:
+                return
+            view = await _progress(job)
+            if view != last:
+                event = "done" if job["status"] in FINAL_STATES else "progress"
+                yield sse(event, view)
+                last = view
+            if job["status"] in FINAL_STATES:
+                return
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=SSE_HEADERS)
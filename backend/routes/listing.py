@@ -1,16 +1,32 @@
 # listing.py
 from fastapi import APIRouter, HTTPException, Query
-from fastapi.encoders import jsonable_encoder
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from typing import Literal, Optional
 from bson import ObjectId
-from bson.json_util import dumps
-from decouple import config
+from bson.errors import InvalidId
+from datetime import datetime
 from database import ad_collection
-from openai import OpenAI
+from models import ListingData, WizardState
+from serialization import MongoJSONResponse
+from cache import listing_cache, make_key, prompt_version
+from streaming import JsonFieldStream, SSE_HEADERS, sse
+import asyncio
+import catalog
+import jobs
+import listing_templates
+import llm
+import metrics
+import offline
+import upstream
+import wizard
+import base64
 import json
+import log
+import logging
 
 router = APIRouter()
-client = OpenAI(api_key=config("OPENAI_API_KEY"))
+logger = logging.getLogger(__name__)
 
 # Hilfsfunktion für die Preisformatierung
 def format_price(price: str | float | None) -> str:
@@ -24,116 +40,256 @@ def format_price(price: str | float | None) -> str:
 
 class ListingRequest(BaseModel):
     ad_process_id: str
+    # "template" erzeugt den Text lokal (nur strukturierte Kategorien, sonst LLM)
+    generator: Literal["llm", "template"] = "llm"
+    # Gleiches Produkt zum gleichen Preis schon einmal generiert -> Text wiederverwenden
+    use_cache: bool = True
+    # Nicht dringend: Text über die Batch-Schnittstelle erzeugen (offline.py)
+    deferred: bool = False
+
+# Konstanter System-Prompt zuerst, Produktdaten danach (Prompt-Caching bei OpenAI).
+# Das Antwortformat erzwingt das Schema (models.ListingData).
+LISTING_PROMPT = {
+    "role": "system",
+    "content": (
+        "Du bist ein Experte für Kleinanzeigen-Texte. Schreibe aus den Produktdaten Titel und "
+        "Beschreibung einer Anzeige auf Deutsch.\n"
+        "Titel: klare Schlagwörter wie Produktname, Marke, Zustand und ggf. relevante Eigenschaften.\n"
+        "Beschreibung: möglichst viele relevante Informationen wie Maße, Gewicht, Kaufdatum, Zustand, "
+        "Zubehör und Besonderheiten, freundlich und strukturiert formuliert.\n"
+        "Verwende ausschließlich die übergebenen Daten. Erfinde keine Eigenschaften, Zubehörteile, "
+        "Nutzungs- oder Versandangaben."
+    )
+}
+LISTING_FORMAT = llm.chat_response_format(ListingData)
+
+LISTING_MODEL = "gpt-4o"
+LISTING_PROMPT_VERSION = prompt_version(LISTING_PROMPT["content"] + json.dumps(LISTING_FORMAT, sort_keys=True))
+
+DISCLAIMER = ("Der Verkauf erfolgt unter Ausschluss jeglicher Sachmängelhaftung. "
+              "Die Haftung auf Schadenersatz wegen Verletzungen von Gesundheit, Körper oder Leben "
+              "und grob fahrlässiger und/oder vorsätzlicher Verletzungen meiner Pflichten als Verkäufer bleibt davon unberührt.")
+
+
+def finalize_listing(parsed: dict, features: dict, price) -> dict:
+    # Zustand, Kategorie und Preis aus den Eingaben, nicht vom Modell abgeschrieben
+    parsed.setdefault("title", "Titel fehlt")
+    parsed.setdefault("description", "Keine Beschreibung generiert")
+    parsed.setdefault("condition", features.get("condition", "Unbekannt"))
+    parsed.setdefault("category", features.get("category", "Unbekannt"))
+    parsed.setdefault("price", price if price is not None else "Preis auf Anfrage")
+
+    # Rechtliche Hinweise immer anhängen
+    parsed["description"] = f"{parsed['description'].rstrip()}\n\n{DISCLAIMER}"
+    return parsed
+
+
+def _listing_params(features: dict, preistext: str) -> dict:
+    # Parameter der Chat-Completions-API, auch als Body für die Batch-Schnittstelle (offline.py).
+    # Kompaktes JSON ohne \u-Escapes spart Tokens
+    user_input = {
+        "role": "user",
+        "content": f"Produktdaten: {json.dumps(features, ensure_ascii=False, separators=(',', ':'))}\nPreis: {preistext}"
+    }
+    return {
+        "model": LISTING_MODEL,
+        "messages": [LISTING_PROMPT, user_input],
+        "response_format": LISTING_FORMAT,
+        "prompt_cache_key": f"listing-{LISTING_PROMPT_VERSION}",
+        "temperature": 1,
+        "max_tokens": 2048
+    }
 
-@router.post("/generate/")
-async def generate_listing(req: ListingRequest):
-    ad_id = ObjectId(req.ad_process_id)
-    ad = await ad_collection.find_one({"_id": ad_id})
-    if not ad:
-        raise HTTPException(status_code=404, detail="AdProcess nicht gefunden")
 
-    features = ad.get("identification", {}).get("data", {})
-    suggestion = ad.get("price_data", {}).get("suggestion", {})
-    price = suggestion.get("suggested_price")
+def _parse_listing_reply(raw: str) -> dict:
+    try:
+        return ListingData.model_validate_json(raw).model_dump()
+    except ValidationError:
+        raise HTTPException(status_code=500, detail=f"Antwort entspricht nicht dem Schema: {raw}")
 
-    if not features:
-        raise HTTPException(status_code=400, detail="Produktmerkmale fehlen")
 
-    preistext = format_price(price) if price is not None else "Preis auf Anfrage"
+async def _llm_listing(features: dict, preistext: str) -> dict:
+    response = await llm.create_chat_completion(**_listing_params(features, preistext))
 
-    prompt = {
-        "role": "system",
-        "content": """
-        Du bist ein Experte für Kleinanzeigen-Texte. Deine Aufgabe:
+    raw = response.choices[0].message.content or ""
+    if log.sampled():
+        logger.info("OpenAI-Aufruf (Anzeigentext)", extra={"features": log.redact(features), "reply": log.redact(raw)})
 
-        Erstelle aus den folgenden Produktdaten eine Anzeige mit:
+    return _parse_listing_reply(raw)
 
-        - **title** (max. 60 Zeichen):
-        Verwende klare Schlagwörter wie Produktname, Marke, Zustand und ggf. relevante Eigenschaften (sofern in den Daten enthalten).
-        Verwende keine erfundenen Begriffe. Nutze nur die bereitgestellten Informationen.
 
-        - **description** (max. 500 Zeichen):
-        Gib möglichst viele relevante Informationen wieder: Maße, Gewicht, Kaufdatum, Zustand, Zubehör, Besonderheiten – aber **nur**, wenn sie in den Daten vorkommen.
-        Keine Halluzinationen oder Ergänzungen. Verwende ausschließlich die gelieferten Daten.
-        Du darfst freundliche Formulierungen und strukturierte Sätze nutzen, solange sie inhaltlich korrekt bleiben.
-        Wenn möglich, formuliere ehrlich und transparent, ohne Dinge hinzuzufügen, die nicht erwähnt wurden (z. B. keine Versandinfos erfinden).
+def listing_key(features: dict, preistext: str) -> str:
+    # Normalisierte Merkmale: Schreibvarianten von Marke/Modell ergeben denselben Schlüssel
+    normalized = {
+        "product": catalog.product_key(features.get("brand"), features.get("model_or_type")),
+        **{
+            field: " ".join(str(features.get(field) or "").casefold().split())
+            for field in ("category", "color", "condition", "special_notes")
+        }
+    }
+    return make_key(json.dumps(normalized, sort_keys=True), preistext, LISTING_MODEL, LISTING_PROMPT_VERSION)
 
-        - **condition**:
-        Wird direkt aus dem übergebenen Zustand übernommen.
 
-        - **category**:
-        Wird direkt übernommen.
+async def _prepared_listing(features: dict, preistext: str, generator: str, use_cache: bool):
+    # Vorlage oder Cache-Treffer, sonst (None, None) -> LLM nötig
+    if generator == "template" and listing_templates.supports(features):
+        return listing_templates.render(features, preistext), "template"
+    if use_cache:
+        cached = await listing_cache.get(listing_key(features, preistext))
+        if cached is not None:
+            return cached, "cache"
+    return None, None
 
-        - **price**:
-        Wenn Preis vorhanden, gib ihn als Zahl aus.
-        Wenn kein Preis übergeben wird, schreibe \"Preis auf Anfrage\".
 
-        Gib die Antwort **ausschließlich** im folgenden JSON-Format aus:
+async def _cache_listing(features: dict, preistext: str, parsed: dict):
+    await listing_cache.set(listing_key(features, preistext), parsed,
+                            model=LISTING_MODEL, prompt_version=LISTING_PROMPT_VERSION)
 
-        {
-        \"title\": \"...\",
-        \"description\": \"...\",
-        \"condition\": \"...\",
-        \"category\": \"...\",
-        \"price\": \"...\" // Preis auf Anfrage oder formatierter Preis
-        }
 
-        ⚠️ Wichtig: Antworte **nur basierend auf den übergebenen Daten**.
-        Erfinde keine zusätzlichen Eigenschaften, Zubehörteile oder Nutzungsangaben.
-        """
-    }
+async def write_listing(features: dict, price, generator: str = "llm", use_cache: bool = True) -> dict:
+    preistext = format_price(price) if price is not None else "Preis auf Anfrage"
 
-    user_input = {
-        "role": "user",
-        "content": f"Produktdaten: {json.dumps(features)}\nPreis: {preistext}"
-    }
+    parsed, method = await _prepared_listing(features, preistext, generator, use_cache)
+    if parsed is None:
+        parsed, method = await _llm_listing(features, preistext), "llm"
+        await _cache_listing(features, preistext, parsed)
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[prompt, user_input],
-            temperature=1,
-            max_tokens=2048
-        )
+    listing = finalize_listing(dict(parsed), features, price)
+    listing["method"] = method
+    return listing
+
+
+LISTING_INPUTS = {"identification.data": 1, "price_data.suggestion": 1}
 
-        raw = response.choices[0].message.content.strip()
-        print("🔎 GPT-Rohantwort:", raw)
 
-        if raw.startswith("```json"):
-            raw = raw.removeprefix("```json").removesuffix("```").strip()
-        elif raw.startswith("```"):
-            raw = raw.removeprefix("```").removesuffix("```").strip()
+async def _load_listing_inputs(ad_process_id: str, claim: bool = True):
+    # claim: Schritt "listing" für diesen Aufruf belegen (doppelte Starts -> 409)
+    ad_id = wizard.object_id(ad_process_id)
+    if claim:
+        ad = await wizard.begin(ad_id, "listing", LISTING_INPUTS, require={
+            "identification.data": {"$exists": True}
+        }, missing="Produktmerkmale fehlen")
+    else:
+        ad = await wizard.load(ad_id, LISTING_INPUTS)
 
+    features = ad.get("identification", {}).get("data", {})
+    suggestion = ad.get("price_data", {}).get("suggestion", {})
+    if not features:
+        error = HTTPException(status_code=400, detail="Produktmerkmale fehlen")
+        if claim:
+            await wizard.fail(ad_id, "listing", error)
+        raise error
+    return ad_id, features, suggestion.get("suggested_price")
+
+
+async def _store_listing(ad_id: ObjectId, listing: dict):
+    if not await wizard.complete(ad_id, "listing", {"listing": listing}, WizardState.LISTING_READY):
+        raise wizard.StepLost()
+
+
+@router.post("/generate/")
+async def generate_listing(req: ListingRequest, job: bool = False):
+    if job:
+        return await jobs.submit("listing", req)
+
+    ad_id, features, price = await _load_listing_inputs(req.ad_process_id, claim=not req.deferred)
+    if req.deferred:
+        return await offline.defer(ad_id, "listing")
+
+    with metrics.stage("listing"):
         try:
-            parsed = json.loads(raw)
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=500, detail=f"Antwort kein gültiges JSON: {raw}")
+            parsed = await write_listing(features, price, req.generator, req.use_cache)
+            await _store_listing(ad_id, parsed)
+
+            return {"status": "listing generated", "title": parsed.get("title"), "method": parsed["method"]}
 
-          # Fallbacks setzen, wenn GPT Mist baut
-        parsed.setdefault("title", "Titel fehlt")
-        parsed.setdefault("description", "Keine Beschreibung generiert")
-        parsed.setdefault("condition", features.get("condition", "Unbekannt"))
-        parsed.setdefault("category", features.get("category", "Unbekannt"))
-        parsed.setdefault("price", price if price is not None else "Preis auf Anfrage")
+        except Exception as e:
+            await wizard.fail(ad_id, "listing", e)
+            if isinstance(e, (upstream.UpstreamError, wizard.StepLost)):
+                raise
+            raise HTTPException(status_code=500, detail=f"OpenAI-Fehler: {str(e)}")
 
-        # Rechtliche Hinweise immer anhängen
-        disclaimer = ("Der Verkauf erfolgt unter Ausschluss jeglicher Sachmängelhaftung. "
-                      "Die Haftung auf Schadenersatz wegen Verletzungen von Gesundheit, Körper oder Leben "
-                      "und grob fahrlässiger und/oder vorsätzlicher Verletzungen meiner Pflichten als Verkäufer bleibt davon unberührt.")
-        parsed["description"] = f"{parsed['description'].rstrip()}\n\n{disclaimer}"
 
-        await ad_collection.update_one(
-            {"_id": ad_id},
-            {"$set": {
-                "listing": parsed,
-                "wizard_state": "LISTING_READY"
-            }}
-        )
+@router.post("/generate/stream/")
+async def stream_listing(req: ListingRequest):
+    # Wie /generate/, aber als Server-Sent Events: "token" für jedes Text-Stück,
+    # "field" sobald ein JSON-Feld (z. B. title) vollständig ist, "done" mit dem gespeicherten Listing
+    # Eingaben vorab prüfen (400/404 als HTTP-Status), belegt wird der Schritt erst im
+    # Stream: bricht der Client vor dem ersten Byte ab, läuft der Generator nie an und
+    # der Schritt bliebe sonst bis WIZARD_STEP_TIMEOUT blockiert
+    await _load_listing_inputs(req.ad_process_id, claim=False)
+
+    async def events():
+        try:
+            ad_id, features, price = await _load_listing_inputs(req.ad_process_id)
+        except HTTPException as e:
+            yield sse("error", {"detail": e.detail, "status_code": e.status_code})
+            return
+        preistext = format_price(price) if price is not None else "Preis auf Anfrage"
+
+        with metrics.stage("listing"):
+            try:
+                parsed, method = await _prepared_listing(features, preistext, req.generator, req.use_cache)
+                if parsed is None:
+                    fields, raw = JsonFieldStream(), []
+                    async for delta in llm.stream_chat_completion(**_listing_params(features, preistext)):
+                        raw.append(delta)
+                        yield sse("token", {"text": delta})
+                        for name, value in fields.feed(delta):
+                            yield sse("field", {"name": name, "value": value})
+                    parsed, method = _parse_listing_reply("".join(raw)), "llm"
+                    await _cache_listing(features, preistext, parsed)
+                else:
+                    for name, value in parsed.items():
+                        yield sse("field", {"name": name, "value": value})
+
+                listing = finalize_listing(dict(parsed), features, price)
+                listing["method"] = method
+                await _store_listing(ad_id, listing)
+                yield sse("done", listing)
+
+            except upstream.UpstreamError as e:
+                await wizard.fail(ad_id, "listing", e)
+                yield sse("error", {"detail": e.detail, "status_code": e.status_code, "retry_after": e.retry_after})
+            except wizard.StepLost as e:
+                yield sse("error", {"detail": e.detail, "status_code": e.status_code})
+            except (asyncio.CancelledError, GeneratorExit):
+                # Client hat die Verbindung getrennt: Schritt gleich freigeben, nicht erst nach
+                # WIZARD_STEP_TIMEOUT. Abgeschirmt, weil das Abbrechen jedes weitere await trifft.
+                await asyncio.shield(wizard.fail(ad_id, "listing", "Verbindung vom Client getrennt"))
+                raise
+            except Exception as e:
+                await wizard.fail(ad_id, "listing", e)
+                yield sse("error", {"detail": f"OpenAI-Fehler: {getattr(e, 'detail', str(e))}"})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+jobs.register("listing", generate_listing, ListingRequest)
+
+
+def _listing_inputs(ad: dict) -> tuple[dict, object, str]:
+    features = ad.get("identification", {}).get("data") or {}
+    price = ad.get("price_data", {}).get("suggestion", {}).get("suggested_price")
+    return features, price, format_price(price) if price is not None else "Preis auf Anfrage"
+
+
+def _offline_request(ad: dict) -> dict | None:
+    features, _, preistext = _listing_inputs(ad)
+    if not features:
+        return None
+    return _listing_params(features, preistext)
 
-        return {"status": "listing generated", "title": parsed.get("title")}
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"OpenAI-Fehler: {str(e)}")
+async def _offline_result(ad: dict, text: str) -> dict:
+    features, price, preistext = _listing_inputs(ad)
+    parsed = _parse_listing_reply(text)
+    await _cache_listing(features, preistext, parsed)
+    listing = finalize_listing(dict(parsed), features, price)
+    listing["method"] = "offline"
+    return {"listing": listing, "wizard_state": WizardState.LISTING_READY}
+
+offline.register("listing", "/v1/chat/completions", _offline_request, _offline_result,
+                 after=("identification", "price"))
 
 
 @router.get("/ad-process/{ad_process_id}/")
@@ -143,15 +299,66 @@ async def get_process_details(ad_process_id: str):
         "wizard_state": 1,
         "identification.data": 1,
         "price_data.suggestion": 1,
-        "listing": 1
+        "listing": 1,
+        "timings": 1
     })
     if not ad:
         raise HTTPException(status_code=404, detail="AdProcess nicht gefunden")
 
-    return json.loads(dumps(ad))
+    return MongoJSONResponse(ad)
+
+
+# Felder für die Übersicht; Vergleichsanzeigen und Texte nur über die Detailansicht
+AD_PROCESS_SUMMARY = {
+    "user_id": 1,
+    "created_at": 1,
+    "wizard_state": 1,
+    "image_urls": {"$slice": 1},
+    "identification.status": 1,
+    "identification.data.brand": 1,
+    "identification.data.model_or_type": 1,
+    "identification.data.category": 1,
+    "price_data.suggestion.suggested_price": 1,
+    "listing.title": 1
+}
+
+
+def _encode_cursor(ad: dict) -> str:
+    return base64.urlsafe_b64encode(f"{ad['created_at'].isoformat()}|{ad['_id']}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, ObjectId]:
+    try:
+        created_at, ad_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), ObjectId(ad_id)
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=400, detail="Ungültiger cursor")
 
 
 @router.get("/ad-processes/")
-async def list_ad_processes(user_id: str = Query(...)):
-    results = await ad_collection.find({"user_id": user_id}).to_list(length=100)
-    return json.loads(dumps(results))
+async def list_ad_processes(user_id: str = Query(...), limit: int = Query(100, ge=1, le=100),
+                            cursor: Optional[str] = None, state: Optional[str] = None):
+    # Antwort: {"items": [...], "next_cursor": str | None} statt einer bloßen Liste;
+    # die nächste Seite mit ?cursor=<next_cursor>. Standardgröße wie bisher 100 Einträge.
+    # Keyset-Pagination über (created_at, _id) absteigend: jede Seite ist ein Index-Bereich,
+    # unabhängig davon, wie viele Anzeigen der Nutzer schon hat
+    query = {"user_id": user_id}
+    if state:
+        query["wizard_state"] = state
+    if cursor:
+        created_at, ad_id = _decode_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": ad_id}}
+        ]
+
+    results = await ad_collection.find(query, AD_PROCESS_SUMMARY) \
+        .sort([("created_at", -1), ("_id", -1)]) \
+        .limit(limit + 1) \
+        .to_list(length=limit + 1)
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = _encode_cursor(results[-1])
+    return MongoJSONResponse({"items": results, "next_cursor": next_cursor})
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from decouple import config
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from database import metrics_collection
+import metrics
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# Prometheus-Endpunkt. Jeder Worker-Prozess speichert seine Zähler regelmäßig in der
+# Collection "metrics"; /metrics addiert die aktuellen Stände aller Worker, egal
+# welcher Worker die Anfrage bedient. Mit METRICS_TOKEN nur mit Bearer-Token abrufbar.
+
+METRICS_FLUSH_INTERVAL = config("METRICS_FLUSH_INTERVAL", default=15.0, cast=float)
+# Stände beendeter Worker zählen so lange weiter mit
+METRICS_WORKER_TTL = config("METRICS_WORKER_TTL", default=3600, cast=int)
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_task: asyncio.Task | None = None
+
+
+async def flush():
+    await metrics_collection.update_one(
+        {"_id": WORKER_ID},
+        {"$set": {"metrics": metrics.snapshot(), "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+
+@router.get("", response_class=PlainTextResponse)
+async def get_metrics(authorization: str = Header("")):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Nicht autorisiert")
+
+    cutoff = datetime.utcnow() - timedelta(seconds=METRICS_WORKER_TTL)
+    others = [
+        doc["metrics"]
+        async for doc in metrics_collection.find({"_id": {"$ne": WORKER_ID}, "updated_at": {"$gt": cutoff}})
+    ]
+    return PlainTextResponse(
+        metrics.render(metrics.merge([metrics.snapshot(), *others])),
+        media_type="text/plain; version=0.0.4"
+    )
+
+
+async def _loop():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception:
+            logger.warning("Metriken nicht gespeichert", exc_info=True)
+
+
+def start():
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_loop())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    await flush()
+
+
+async def ensure_indexes():
+    await metrics_collection.create_index("updated_at", expireAfterSeconds=METRICS_WORKER_TTL)
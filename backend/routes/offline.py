@@ -0,0 +1,30 @@
+from fastapi import APIRouter, HTTPException
+from database import offline_collection
+import offline
+
+router = APIRouter()
+
+
+@router.post("/submit")
+async def submit_offline():
+    # Zurückgestellte Schritte sofort übergeben, statt auf den nächsten Durchlauf zu warten
+    return {"submitted": await offline.submit_pending()}
+
+
+@router.post("/poll")
+async def poll_offline():
+    return {"finished": await offline.poll()}
+
+
+@router.get("/batches")
+async def list_offline_batches(limit: int = 50):
+    cursor = offline_collection.find({}).sort("created_at", -1).limit(min(limit, 500))
+    return [{"batch_id": doc.pop("_id"), **doc} async for doc in cursor]
+
+
+@router.get("/batches/{batch_id}")
+async def get_offline_batch(batch_id: str):
+    doc = await offline_collection.find_one({"_id": batch_id})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Batch nicht gefunden")
+    return {"batch_id": doc.pop("_id"), **doc}
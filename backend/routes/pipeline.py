@@ -0,0 +1,136 @@
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from typing import Literal, Optional
+from datetime import datetime
+from database import ad_collection
+from models import StepStatus, WizardState
+from routes.identify import identify_images
+from routes.price import search_comparables, suggest_price
+from routes.listing import write_listing
+import asyncio
+import images
+import jobs
+import log
+import metrics
+import wizard
+
+router = APIRouter()
+
+class PipelineRequest(BaseModel):
+    image_urls: list[str]
+    ad_process_id: Optional[str] = None
+    user_id: Optional[str] = None
+    # Bekannte Marke/Modell (z. B. vom Nutzer) überschreiben die Erkennung
+    # und erlauben den Start der Vergleichssuche parallel zur Bildanalyse
+    brand: Optional[str] = None
+    model_or_type: Optional[str] = None
+    # Preisbegründung durch das LLM statt statistischer Schätzung
+    explain_price: bool = False
+    listing_generator: Literal["llm", "template"] = "llm"
+
+
+@router.post("/")
+async def run_pipeline(req: PipelineRequest, job: bool = False):
+    # Erkennung, Vergleichsanzeigen, Preis und Anzeigentext in einem Durchlauf.
+    # Zwischenergebnisse bleiben im Speicher, pro Stufe genau ein Schreibzugriff.
+    if job:
+        return await jobs.submit("pipeline", req)
+
+    if not req.image_urls:
+        raise HTTPException(status_code=400, detail="No image URLs provided")
+
+    manifests = await images.load_manifests(req.image_urls)
+    now = datetime.utcnow()
+    stage_fields = {
+        "wizard_state": WizardState.STARTED,
+        "identification": {"status": StepStatus.PENDING, "started_at": now},
+        "image_urls": req.image_urls,
+        "images": manifests
+    }
+
+    if not req.ad_process_id:
+        insert_result = await ad_collection.insert_one({
+            **stage_fields,
+            "pipeline": {"status": StepStatus.PENDING, "started_at": now},
+            "user_id": req.user_id,
+            "created_at": now
+        })
+        ad_id = insert_result.inserted_id
+        log.bind(ad_process_id=ad_id)
+    else:
+        # Abgelehnt, solange die Pipeline oder einer der Einzelschritte läuft (wizard.CONFLICTS)
+        ad_id = wizard.object_id(req.ad_process_id)
+        await wizard.begin(ad_id, "pipeline", {"_id": 1}, fields=stage_fields)
+
+    hints = {k: v for k, v in (("brand", req.brand), ("model_or_type", req.model_or_type)) if v}
+    early_search = None
+    if len(hints) == 2:
+        early_search = asyncio.create_task(search_comparables(hints))
+        # Fehler der Vorab-Suche nicht als "never retrieved" melden, falls sie verworfen wird
+        early_search.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    stage = "identification"
+    with metrics.stage("pipeline"):
+        try:
+            with metrics.stage("identification"):
+                features, confidence = await identify_images(req.image_urls, manifests)
+                features.update(hints)
+                await wizard.save(ad_id, "pipeline", {
+                    "identification.data": features,
+                    "identification.confidence": confidence,
+                    "identification.status": StepStatus.DONE,
+                    "identification.finished_at": datetime.utcnow(),
+                    "wizard_state": WizardState.IDENTIFIED
+                })
+
+            stage = "comparables"
+            with metrics.stage("comparables"):
+                if not features.get("brand") or not features.get("model_or_type"):
+                    raise HTTPException(status_code=400, detail="Produktdaten unvollständig für Vergleichssuche")
+                comparables = await (early_search or search_comparables(features))
+                await wizard.save(ad_id, "pipeline", {
+                    "price_data.comparables": comparables,
+                    "wizard_state": WizardState.COMPARABLES_RETRIEVED
+                })
+
+            stage = "price"
+            suggestion = {}
+            if comparables:
+                with metrics.stage("price"):
+                    suggestion = await suggest_price(features, comparables, req.explain_price)
+                    await wizard.save(ad_id, "pipeline", {
+                        "price_data.suggestion": suggestion,
+                        "wizard_state": WizardState.PRICE_SUGGESTED
+                    })
+
+            stage = "listing"
+            with metrics.stage("listing"):
+                listing = await write_listing(features, suggestion.get("suggested_price"), req.listing_generator)
+            if not await wizard.complete(ad_id, "pipeline", {"listing": listing}, WizardState.LISTING_READY):
+                raise wizard.StepLost()
+
+        except Exception as e:
+            if early_search:
+                early_search.cancel()
+            fields = {"pipeline.failed_stage": stage}
+            if stage == "identification":
+                fields["identification.status"] = StepStatus.ERROR
+            await wizard.fail(ad_id, "pipeline", e, fields)
+
+            if isinstance(e, HTTPException):
+                raise
+            raise HTTPException(status_code=500, detail=f"Pipeline-Fehler ({stage}): {e}")
+
+    return {
+        "status": "listing generated",
+        "ad_process_id": str(ad_id),
+        "identification": features,
+        "confidence": confidence,
+        "comparables_count": len(comparables),
+        "suggested_price": suggestion.get("suggested_price"),
+        "explanation": suggestion.get("explanation"),
+        "listing": listing
+    }
+
+
+jobs.register("pipeline", run_pipeline, PipelineRequest)
@@ -1,17 +1,26 @@
 # price.py
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
 from bson import ObjectId
-from decouple import config
-from database import ad_collection
-from openai import OpenAI
-from bson.errors import InvalidId
-import httpx
+from models import PriceSuggestionData, WizardState
+from cache import prompt_version
+from streaming import JsonFieldStream, SSE_HEADERS, sse
+import asyncio
+import catalog
+import comparables
+import jobs
+import market
+import pricing
+import llm
+import metrics
+import offline
+import upstream
+import wizard
 import re
 import json
 
 router = APIRouter()
-client = OpenAI(api_key=config("OPENAI_API_KEY"))
 
 # Hilfsfunktion für die Preisformatierung
 def format_price(price: str | float | None) -> str:
@@ -37,6 +46,10 @@ class ComparableRequest(BaseModel):
 
 class PriceSuggestionRequest(BaseModel):
     ad_process_id: str
+    # Begründung durch das LLM erzwingen statt der statistischen Schätzung
+    explain: bool = False
+    # Nicht dringend: LLM-Vorschlag über die Batch-Schnittstelle (offline.py)
+    deferred: bool = False
 
 def extract_condition(details_text):
     if not details_text:
@@ -46,84 +59,56 @@ def extract_condition(details_text):
 
 @router.post("/update_attributes/")
 async def update_attributes(req: UpdateAttributesRequest):
-    try:
-        ad_id = ObjectId(req.ad_process_id)
-    except InvalidId:
-        raise HTTPException(status_code=400, detail="Ungültige ad_process_id")
-
-    result = await ad_collection.update_one(
-        {"_id": ad_id},
-        {"$set": {
+    # Ein Aufruf: ändern und die gespeicherten Werte zurückgeben
+    ad = await wizard.update(
+        wizard.object_id(req.ad_process_id),
+        {
             "identification.data.brand": req.brand,
             "identification.data.model_or_type": req.model_or_type
-        }}
+        },
+        {"identification.data.brand": 1, "identification.data.model_or_type": 1},
+        idle="identification"
     )
+    catalog.learn(req.brand, req.model_or_type)
 
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Dokument nicht gefunden")
-    # modified_count kann auch 0 sein – ist ok, wenn keine Änderung
-
-    ad = await ad_collection.find_one({"_id": ad_id})
     data = ad.get("identification", {}).get("data", {})
     return {"brand": data.get("brand"), "model_or_type": data.get("model_or_type")}
 
 
 @router.post("/ads/comparables/")
 async def get_comparables_from_query(req: AdSearchRequest):
-    api_key = config("KLEINANZEIGEN_API_KEY")
-    url = "https://api.kleinanzeigen-agent.de/ads/v1/kleinanzeigen/search"
-
-    params = {
-        "query": req.query,
-        "limit": str(req.limit)
-    }
-    headers = {
-        "ads_key": api_key,
-        "Content-Type": "application/json"
-    }
-
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers, params=params)
-
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail=f"Fehler bei Abruf der Vergleichsanzeigen: {response.text}")
-
-    return response.json()
-
-@router.post("/comparables/")
-async def fetch_and_store_comparables(req: ComparableRequest):
-    ad_id = ObjectId(req.ad_process_id)
-    ad = await ad_collection.find_one({"_id": ad_id})
-    if not ad:
-        raise HTTPException(status_code=404, detail="AdProcess nicht gefunden")
-
-    data = ad.get("identification", {}).get("data", {})
-    brand = data.get("brand")
-    model = data.get("model_or_type")
+    try:
+        return await comparables.search(req.query, req.limit)
+    except comparables.ComparablesError as e:
+        raise HTTPException(status_code=500, detail=f"Fehler bei Abruf der Vergleichsanzeigen: {e}")
 
-    if not brand or not model:
-        raise HTTPException(status_code=400, detail="Produktdaten unvollständig für Vergleichssuche")
+def comparables_query(features: dict) -> str:
+    # Suchtext für Kleinanzeigen: Marke und Modell wie erkannt
+    return " ".join(str(v).strip() for v in (features.get("brand"), features.get("model_or_type")) if v)
 
 
-    query = f"{brand} {model}"
+def comparables_key(features: dict) -> str:
+    # Kanonischer Produktschlüssel, damit Schreibvarianten denselben Cache und dieselbe
+    # laufende Suche treffen; nicht als Suchtext geeignet ("galaxy s 21")
+    return catalog.product_key(features.get("brand"), features.get("model_or_type"))
 
-    # Vergleichsanzeigen abrufen
-    api_key = config("KLEINANZEIGEN_API_KEY")
-    url = "https://api.kleinanzeigen-agent.de/ads/v1/kleinanzeigen/search"
-    params = {"query": query, "limit": "5"}
-    headers = {"ads_key": api_key, "Content-Type": "application/json"}
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers, params=params)
+async def search_comparables(features: dict, limit: int = 5) -> list[dict]:
+    # Zuerst der lokale Preisindex, nur bei zu wenigen frischen Treffern die externe Suche
+    local = await market.find_comparables(features, limit)
+    if local is not None:
+        return local
 
-    if response.status_code != 200:
+    # Vergleichsanzeigen abrufen (gepoolt, gecacht, zusammengefasst)
+    try:
+        full_data = await comparables.search(comparables_query(features), limit, key=comparables_key(features))
+    except comparables.ComparablesError:
         raise HTTPException(status_code=500, detail="Vergleichsanzeigen konnten nicht geladen werden")
 
-    full_data = response.json()
     ads = full_data.get("data", {}).get("ads", [])
 
     # Nur relevante Felder extrahieren
-    cleaned_ads = [
+    cleaned = [
         {
             "title": ad.get("title"),
             "description": ad.get("description"),
@@ -132,14 +117,34 @@ async def fetch_and_store_comparables(req: ComparableRequest):
         }
         for ad in ads
     ]
+    await market.store(ads, cleaned, features)
+    return cleaned
 
-    await ad_collection.update_one(
-        {"_id": ad_id},
-        {"$set": {
-            "price_data.comparables": cleaned_ads,
-            "wizard_state": "COMPARABLES_RETRIEVED"
-        }}
-    )
+
+@router.post("/comparables/")
+async def fetch_and_store_comparables(req: ComparableRequest, job: bool = False):
+    if job:
+        return await jobs.submit("comparables", req)
+
+    ad_id = wizard.object_id(req.ad_process_id)
+    ad = await wizard.begin(ad_id, "comparables", {"identification.data": 1}, require={
+        "identification.data.brand": {"$nin": [None, ""]},
+        "identification.data.model_or_type": {"$nin": [None, ""]}
+    }, missing="Produktdaten unvollständig für Vergleichssuche")
+
+    data = ad["identification"]["data"]
+    query = comparables_query(data)
+    with metrics.stage("comparables"):
+        try:
+            cleaned_ads = await search_comparables(data)
+        except Exception as e:
+            await wizard.fail(ad_id, "comparables", e)
+            raise
+
+        saved = await wizard.complete(ad_id, "comparables", {"price_data.comparables": cleaned_ads},
+                                      WizardState.COMPARABLES_RETRIEVED)
+        if not saved:
+            raise wizard.StepLost()
 
     return {
         "status": "comparables saved",
@@ -147,88 +152,218 @@ async def fetch_and_store_comparables(req: ComparableRequest):
         "count": len(cleaned_ads)
     }
 
-@router.post("/suggest/")
-async def generate_price_suggestion(req: PriceSuggestionRequest):
-    ad_id = ObjectId(req.ad_process_id)
-    ad = await ad_collection.find_one({"_id": ad_id})
-    if not ad:
-        raise HTTPException(status_code=404, detail="AdProcess nicht gefunden")
 
-    features = ad.get("identification", {}).get("data", {})
-    comparables = ad.get("price_data", {}).get("comparables", [])
+# Konstanter System-Prompt zuerst, Produktdaten und Vergleichsanzeigen danach
+# (Prompt-Caching bei OpenAI). Das Antwortformat erzwingt models.PriceSuggestionData.
+PRICE_PROMPT = {
+    "role": "system",
+    "content": (
+        "Du bist Experte für die Preisfindung gebrauchter Produkte auf Kleinanzeigen-Plattformen. "
+        "Du erhältst Produktdaten eines Nutzers und Vergleichsanzeigen ähnlicher Produkte. "
+        "Berücksichtige nur Anzeigen zum exakt gesuchten Produkt und schlage daraus einen Preis vor. "
+        "Antworte immer auf Deutsch."
+    )
+}
+PRICE_FORMAT = llm.chat_response_format(PriceSuggestionData)
+PRICE_PROMPT_VERSION = prompt_version(PRICE_PROMPT["content"] + json.dumps(PRICE_FORMAT, sort_keys=True))
+
+PRICE_MODEL = "gpt-4o"
 
-    if not features or not comparables:
-        raise HTTPException(status_code=400, detail="Notwendige Daten fehlen für Preisanalyse")
-
-    prompt = {
-        "role": "system",
-        "content": """
-            Du bist ein KI-Experte für Preisfindung gebrauchter Produkte auf Kleinanzeigenplattformen.
-        Antworte **immer auf Deutsch** und gib ausschließlich gültiges JSON zurück.
-
-        Du erhältst:
-        (1) Produktdaten eines Nutzers
-        (2) Vergleichsanzeigen ähnlicher Produkte
-
-        Deine Aufgabe:
-        - Identifiziere passende Vergleichsanzeigen zum exakt gesuchten Produkt.
-        - Wenn keine passenden Anzeigen vorhanden sind, gib `"suggested_price": null`.
-        - Gib immer ein Feld `"explanation"` aus:
-            - Wenn Anzeigen gefunden wurden, fasse zusammen wie viele und welche Art.
-            - Wenn keine passenden Anzeigen vorhanden sind, schreibe warum.
-
-        **Wichtig:** Deine Antwort muss komplett auf Deutsch formuliert sein.
-        Antworte ausschließlich mit folgendem JSON-Schema:
-        {
-        "suggested_price": "XX.XX",
-        "pricerelevante_faktoren": "...",
-        "explanation": "..."
-        }
-        """
-    }
 
+def _price_params(features: dict, comparables: list[dict]) -> dict:
+    # Parameter der Chat-Completions-API, auch als Body für die Batch-Schnittstelle (offline.py)
+    compact = {"ensure_ascii": False, "separators": (",", ":")}
     user_input = {
         "role": "user",
-        "content": f"Produktdaten: {json.dumps(features)}\nVergleichsanzeigen: {json.dumps(comparables)}"
+        "content": f"Produktdaten: {json.dumps(features, **compact)}\nVergleichsanzeigen: {json.dumps(comparables, **compact)}"
+    }
+    return {
+        "model": PRICE_MODEL,
+        "messages": [PRICE_PROMPT, user_input],
+        "response_format": PRICE_FORMAT,
+        "prompt_cache_key": f"price-{PRICE_PROMPT_VERSION}",
+        "temperature": 1,
+        "max_tokens": 1000
     }
 
+
+def _parse_price_reply(raw: str) -> dict:
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[prompt, user_input],
-            temperature=1,
-            max_tokens=1000
-        )
+        parsed = PriceSuggestionData.model_validate_json(raw).model_dump()
+    except ValidationError:
+        raise HTTPException(status_code=500, detail=f"Antwort entspricht nicht dem Schema: {raw}")
+
+    # Formatiere den Preis
+    parsed["suggested_price"] = format_price(parsed["suggested_price"])
+    parsed["method"] = "llm"
+    return parsed
+
+
+async def _llm_suggest_price(features: dict, comparables: list[dict]) -> dict:
+    response = await llm.create_chat_completion(**_price_params(features, comparables))
+    return _parse_price_reply(response.choices[0].message.content or "")
+
+
+def _needs_llm(estimate: dict | None, explain: bool) -> bool:
+    # GPT-4o nur bei geringer Konfidenz oder wenn eine Begründung gewünscht ist
+    return explain or estimate is None or estimate["confidence"] < pricing.PRICE_ESTIMATE_MIN_CONFIDENCE
+
+
+def _statistical_suggestion(features: dict, estimate: dict) -> dict:
+    return {
+        "suggested_price": format_price(estimate["value"]),
+        "pricerelevante_faktoren": f"Zustand: {features.get('condition') or 'unbekannt'}",
+        "explanation": (
+            f"Gewichteter Median aus {estimate['samples']} Vergleichsanzeigen "
+            f"(Spanne {format_price(estimate['low'])} bis {format_price(estimate['high'])}"
+            + (f", {estimate['outliers_removed']} Ausreißer entfernt)." if estimate["outliers_removed"] else ").")
+        ),
+        "method": "statistical",
+        "estimate": estimate
+    }
+
+
+async def suggest_price(features: dict, comparables: list[dict], explain: bool = False) -> dict:
+    # Schneller Pfad: statistische Schätzung vor GPT-4o
+    estimate = pricing.estimate(features, comparables)
+    if not _needs_llm(estimate, explain):
+        return _statistical_suggestion(features, estimate)
 
-        raw = response.choices[0].message.content.strip()
+    parsed = await _llm_suggest_price(features, comparables)
+    if estimate is not None:
+        parsed["estimate"] = estimate
+    return parsed
 
-        if raw.startswith("```json"):
-            raw = raw.removeprefix("```json").removesuffix("```").strip()
-        elif raw.startswith("```"):
-            raw = raw.removeprefix("```").removesuffix("```").strip()
 
+PRICE_INPUTS = {"identification.data": 1, "price_data.comparables": 1}
+
+
+async def _load_price_inputs(ad_process_id: str, claim: bool = True):
+    # claim: Schritt "price" für diesen Aufruf belegen (doppelte Starts -> 409)
+    ad_id = wizard.object_id(ad_process_id)
+    if claim:
+        ad = await wizard.begin(ad_id, "price", PRICE_INPUTS, require={
+            "identification.data": {"$exists": True},
+            "price_data.comparables.0": {"$exists": True}
+        }, missing="Notwendige Daten fehlen für Preisanalyse")
+    else:
+        ad = await wizard.load(ad_id, PRICE_INPUTS)
+
+    features = ad.get("identification", {}).get("data", {})
+    comparables = ad.get("price_data", {}).get("comparables", [])
+    if not features or not comparables:
+        error = HTTPException(status_code=400, detail="Notwendige Daten fehlen für Preisanalyse")
+        if claim:
+            await wizard.fail(ad_id, "price", error)
+        raise error
+    return ad_id, features, comparables
+
+
+async def _store_suggestion(ad_id: ObjectId, parsed: dict):
+    if not await wizard.complete(ad_id, "price", {"price_data.suggestion": parsed}, WizardState.PRICE_SUGGESTED):
+        raise wizard.StepLost()
+
+
+@router.post("/suggest/")
+async def generate_price_suggestion(req: PriceSuggestionRequest, job: bool = False):
+    if job:
+        return await jobs.submit("price_suggestion", req)
+
+    ad_id, features, comparables = await _load_price_inputs(req.ad_process_id, claim=not req.deferred)
+    if req.deferred:
+        return await offline.defer(ad_id, "price")
+
+    with metrics.stage("price"):
         try:
-            parsed = json.loads(raw)
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=500, detail=f"Antwort kein gültiges JSON: {raw}")
-
-        # Formatiere den Preis
-        if "suggested_price" in parsed:
-            parsed["suggested_price"] = format_price(parsed["suggested_price"])
-
-        await ad_collection.update_one(
-            {"_id": ad_id},
-            {"$set": {
-                "price_data.suggestion": parsed,
-                "wizard_state": "PRICE_SUGGESTED"
-            }}
-        )
-
-        return {
-            "status": "suggestion stored",
-            "suggested_price": parsed.get("suggested_price"),
-            "explanation": parsed.get("explanation")
-        }
+            parsed = await suggest_price(features, comparables, req.explain)
+            await _store_suggestion(ad_id, parsed)
+
+            return {
+                "status": "suggestion stored",
+                "suggested_price": parsed.get("suggested_price"),
+                "explanation": parsed.get("explanation"),
+                "method": parsed.get("method"),
+                "estimate": parsed.get("estimate")
+            }
+
+        except Exception as e:
+            await wizard.fail(ad_id, "price", e)
+            if isinstance(e, (upstream.UpstreamError, wizard.StepLost)):
+                raise
+            raise HTTPException(status_code=500, detail=f"OpenAI-Fehler: {str(e)}")
+
+
+@router.post("/suggest/stream/")
+async def stream_price_suggestion(req: PriceSuggestionRequest):
+    # Wie /suggest/, aber als Server-Sent Events: "token" für jedes Text-Stück,
+    # "field" sobald suggested_price bzw. explanation vollständig sind, "done" mit dem gespeicherten Vorschlag
+    # Wie stream_listing: vorab prüfen, den Schritt erst im Stream belegen
+    await _load_price_inputs(req.ad_process_id, claim=False)
+
+    async def events():
+        try:
+            ad_id, features, comparables = await _load_price_inputs(req.ad_process_id)
+        except HTTPException as e:
+            yield sse("error", {"detail": e.detail, "status_code": e.status_code})
+            return
+
+        with metrics.stage("price"):
+            try:
+                estimate = pricing.estimate(features, comparables)
+                if not _needs_llm(estimate, req.explain):
+                    parsed = _statistical_suggestion(features, estimate)
+                    for name in ("suggested_price", "pricerelevante_faktoren", "explanation"):
+                        yield sse("field", {"name": name, "value": parsed[name]})
+                else:
+                    fields, raw = JsonFieldStream(), []
+                    async for delta in llm.stream_chat_completion(**_price_params(features, comparables)):
+                        raw.append(delta)
+                        yield sse("token", {"text": delta})
+                        for name, value in fields.feed(delta):
+                            if name == "suggested_price":
+                                value = format_price(value)
+                            yield sse("field", {"name": name, "value": value})
+                    parsed = _parse_price_reply("".join(raw))
+                    if estimate is not None:
+                        parsed["estimate"] = estimate
+
+                await _store_suggestion(ad_id, parsed)
+                yield sse("done", parsed)
+
+            except upstream.UpstreamError as e:
+                await wizard.fail(ad_id, "price", e)
+                yield sse("error", {"detail": e.detail, "status_code": e.status_code, "retry_after": e.retry_after})
+            except wizard.StepLost as e:
+                yield sse("error", {"detail": e.detail, "status_code": e.status_code})
+            except (asyncio.CancelledError, GeneratorExit):
+                # Client hat die Verbindung getrennt: Schritt gleich freigeben, nicht erst nach
+                # WIZARD_STEP_TIMEOUT. Abgeschirmt, weil das Abbrechen jedes weitere await trifft.
+                await asyncio.shield(wizard.fail(ad_id, "price", "Verbindung vom Client getrennt"))
+                raise
+            except Exception as e:
+                await wizard.fail(ad_id, "price", e)
+                yield sse("error", {"detail": f"OpenAI-Fehler: {getattr(e, 'detail', str(e))}"})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+jobs.register("comparables", fetch_and_store_comparables, ComparableRequest)
+jobs.register("price_suggestion", generate_price_suggestion, PriceSuggestionRequest)
+
+
+def _offline_request(ad: dict) -> dict | None:
+    features = ad.get("identification", {}).get("data")
+    comparables = ad.get("price_data", {}).get("comparables")
+    if not features or not comparables:
+        return None
+    return _price_params(features, comparables)
+
+
+async def _offline_result(ad: dict, text: str) -> dict:
+    parsed = _parse_price_reply(text)
+    parsed["method"] = "offline"
+    return {"price_data.suggestion": parsed, "wizard_state": WizardState.PRICE_SUGGESTED}
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"OpenAI-Fehler: {str(e)}")
+# Ohne after: zurückgestellt wird erst mit vorhandenen Vergleichsanzeigen (_load_price_inputs),
+# die wiederum eine fertige Erkennung voraussetzen
+offline.register("price", "/v1/chat/completions", _offline_request, _offline_result)
@@ -1,45 +1,125 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Request
-from PIL import Image
-import os, uuid, io
+from fastapi import APIRouter, UploadFile, HTTPException, Request
+from starlette.formparsers import MultiPartException
+from database import upload_collection
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime
+from identification import cached_identification
+from config import CurrentConfig
+import images
+import metrics
+import os, uuid
 
 router = APIRouter()
 
-# Upload-Verzeichnis aus .env oder Default verwenden
-UPLOAD_DIR = os.getenv("UPLOAD_DIR", "./uploads")
+# Upload-Verzeichnis wird beim Erstellen der App angelegt (main.create_app)
+UPLOAD_DIR = CurrentConfig.UPLOAD_DIR
 BASE_URL = os.getenv("BASE_URL")
 
-@router.post("/", response_model=dict)
-async def upload_file(request: Request, file: UploadFile = File(...)):
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
+# Body wird im Handler gelesen (images.receive_upload), daher das Schema von Hand
+UPLOAD_OPENAPI = {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+    "type": "object",
+    "properties": {"file": {"type": "string", "format": "binary"}, "user_id": {"type": "string"}},
+    "required": ["file"]
+}}}}}
+
+
+def _too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Datei zu groß (max. {images.UPLOAD_MAX_BYTES // (1024 * 1024)} MB)"
+    )
 
-    ext = os.path.splitext(file.filename)[1].lower()
-    new_name = f"{uuid.uuid4().hex}{ext}"
-    dest_path = os.path.join(UPLOAD_DIR, new_name)
 
+@router.post("/", response_model=dict, openapi_extra=UPLOAD_OPENAPI)
+async def upload_file(request: Request):
     try:
-        contents = await file.read()
+        form = await images.receive_upload(request)
+    except images.UploadTooLarge:
+        raise _too_large()
+    except MultiPartException as e:
+        raise HTTPException(status_code=400, detail=f"Ungültiger Upload: {e.message}")
+
+    try:
+        file = form.get("file")
+        if file is None or isinstance(file, str):
+            raise HTTPException(status_code=422, detail="Datei fehlt")
+        user_id = form.get("user_id")
+        return await _store_upload(request, file, user_id if isinstance(user_id, str) else None)
+    finally:
+        await form.close()
 
-        if ext in [".jpg", ".jpeg", ".png"]:
-            # EXIF entfernen durch Neu-Speichern des Bildes
-            image = Image.open(io.BytesIO(contents))
-            data = list(image.getdata())  # Bilddaten extrahieren
-            clean_image = Image.new(image.mode, image.size)
-            clean_image.putdata(data)
 
-            # In Datei schreiben (überschreibt EXIF)
-            clean_image.save(dest_path)
-        else:
-            # Nicht-Bilddateien einfach speichern
-            with open(dest_path, "wb") as f:
-                f.write(contents)
+async def _store_upload(request: Request, file: UploadFile, user_id: str | None) -> dict:
+    ext = os.path.splitext(file.filename)[1].lower()
+    tmp_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.part")
+    upload = None
+    duplicate = False
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Upload fehlgeschlagen: {e}")
+    with metrics.stage("upload"):
+        try:
+            size, digest = await images.save_upload(file, tmp_path)
+            kind = "other"
+
+            # Dateien werden über ihren Inhalt adressiert
+            new_name = f"{digest}{ext}"
+            dest_path = os.path.join(UPLOAD_DIR, new_name)
+
+            if ext in images.IMAGE_EXTENSIONS:
+                # Identisches Bild oder nahezu identisches Bild desselben Nutzers schon vorhanden?
+                upload = await images.find_exact(digest)
+                if upload is None:
+                    phash = await images.run_in_pool(images.perceptual_hash, tmp_path)
+                    upload = await images.find_similar(phash, user_id)
+                duplicate = upload is not None
+                kind = "image_duplicate" if duplicate else "image"
+
+                if upload is None:
+                    # EXIF entfernen und Varianten erzeugen (im Worker-Pool)
+                    manifest = await images.run_in_pool(images.ingest_image, tmp_path, dest_path)
+                    metrics.UPLOAD_PIXELS.observe(manifest["width"] * manifest["height"])
+                    upload = {
+                        "_id": new_name,
+                        **manifest,
+                        "sha256": digest,
+                        "user_id": user_id,
+                        "phash": phash,
+                        "phash_bands": images.phash_bands(phash),
+                        "created_at": datetime.utcnow()
+                    }
+                    try:
+                        await upload_collection.insert_one(upload)
+                    except DuplicateKeyError:
+                        # Gleiches Bild wurde parallel hochgeladen
+                        upload = await images.find_exact(digest)
+                new_name = upload["_id"]
+            elif not os.path.exists(dest_path):
+                # Nicht-Bilddateien einfach übernehmen
+                os.replace(tmp_path, dest_path)
+            metrics.UPLOAD_BYTES.observe(size, kind=kind)
+
+        except images.UploadTooLarge:
+            raise _too_large()
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Upload fehlgeschlagen: {e}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     base_url = BASE_URL or str(request.base_url).rstrip("/")
     if "kartenmitwirkung.de" in base_url:
         base_url = base_url.replace("http://", "https://")
 
     full_url = f"{base_url}/uploads/{new_name}"
-    return {"url": full_url}
+    derivatives = {
+        name: images.file_url(full_url, d["file"])
+        for name, d in (upload or {}).get("derivatives", {}).items()
+    }
+    response = {"url": full_url, "derivatives": derivatives, "duplicate": duplicate}
+
+    # Bereits erkanntes Bild: Ergebnis direkt mitliefern
+    if duplicate:
+        identification = await cached_identification(images.fingerprint(full_url, upload))
+        if identification is not None:
+            response["identification"] = identification
+    return response
 
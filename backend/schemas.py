@@ -3,4 +3,7 @@ from typing import Optional
 
 class IdentifyRequest(BaseModel):
     ad_process_id: Optional[str] = None
-    image_urls: list[str]
\ No newline at end of file
+    user_id: Optional[str] = None
+    image_urls: list[str]
+    # Nicht dringend: Erkennung über die Batch-Schnittstelle (offline.py)
+    deferred: bool = False
\ No newline at end of file
@@ -0,0 +1,50 @@
+import json
+from datetime import datetime, timezone
+from bson import ObjectId
+from fastapi.responses import Response
+
+# Direkte Ausgabe von ad_processes-Dokumenten als JSON-Bytes, ohne den Umweg
+# bson.json_util.dumps -> json.loads -> jsonable_encoder -> json.dumps.
+# Das Format entspricht json_util (relaxed): {"$oid": ...} und {"$date": ...},
+# damit sich für bestehende Clients nichts ändert.
+# Mit installiertem orjson wird dieses verwendet, sonst die Standardbibliothek.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _date(value: datetime) -> str:
+    # Wie json_util: Millisekunden nur wenn vorhanden, naive Zeitpunkte gelten als UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    millis = value.microsecond // 1000
+    return value.strftime("%Y-%m-%dT%H:%M:%S") + (f".{millis:03d}" if millis else "") + "Z"
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, datetime):
+        return {"$date": _date(value)}
+    raise TypeError(f"Typ {type(value).__name__} nicht serialisierbar")
+
+
+def _dumps_stdlib(content) -> bytes:
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _dumps_orjson(content) -> bytes:
+    # datetime selbst behandeln, orjson würde sonst ISO-Strings ohne $date schreiben
+    return orjson.dumps(content, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+dumps = _dumps_orjson if orjson is not None else _dumps_stdlib
+
+
+class MongoJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,86 @@
+import json
+
+# Hilfen für Server-Sent Events und inkrementelles Parsen von LLM-Antworten.
+
+
+# Kein Caching und kein Puffern im Reverse-Proxy, damit Events sofort ankommen
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"
+}
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str, ensure_ascii=False)}\n\n"
+
+
+class JsonFieldStream:
+    # Liest ein JSON-Objekt in Teilstücken und meldet jedes Feld der obersten Ebene,
+    # sobald sein Wert vollständig ist. Text vor dem ersten "{" (z. B. ```json) wird ignoriert.
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.expect = None  # "key" | "colon" | "value" | "scalar" | "nested" | "comma"
+        self.key = None
+        self.start = 0
+
+    def _value(self, end: int):
+        try:
+            return json.loads(self.buffer[self.start:end])
+        except json.JSONDecodeError:
+            return self.buffer[self.start:end].strip()
+
+    def feed(self, chunk: str) -> list[tuple[str, object]]:
+        self.buffer += chunk
+        fields = []
+        for i in range(self.pos, len(self.buffer)):
+            c = self.buffer[i]
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.expect == "key":
+                        self.key = json.loads(self.buffer[self.start:i + 1])
+                        self.expect = "colon"
+                    elif self.depth == 1 and self.expect == "value":
+                        fields.append((self.key, self._value(i + 1)))
+                        self.expect = "comma"
+                continue
+
+            if c == '"':
+                self.in_string = True
+                if self.depth == 1 and self.expect in ("key", "value"):
+                    self.start = i
+            elif c in "{[":
+                self.depth += 1
+                if self.depth == 1:
+                    self.expect = "key"
+                elif self.depth == 2 and self.expect == "value":
+                    self.start, self.expect = i, "nested"
+            elif c in "}]":
+                if self.depth == 1 and self.expect == "scalar":
+                    fields.append((self.key, self._value(i)))
+                self.depth -= 1
+                if self.depth == 1 and self.expect == "nested":
+                    fields.append((self.key, self._value(i + 1)))
+                    self.expect = "comma"
+            elif self.depth == 1:
+                if c == ":":
+                    self.expect = "value"
+                elif c == ",":
+                    if self.expect == "scalar":
+                        fields.append((self.key, self._value(i)))
+                    self.expect = "key"
+                elif self.expect == "value" and not c.isspace():
+                    self.start, self.expect = i, "scalar"
+
+        self.pos = len(self.buffer)
+        return fields
@@ -0,0 +1,10 @@
+# Unit-Tests der reinen Logik, aus backend/: pip install -r requirements-dev.txt && python -m pytest -q
+import os
+import sys
+
+# Module lesen Zugangsdaten beim Import; die Tests rufen weder MongoDB noch OpenAI auf
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("KLEINANZEIGEN_API_KEY", "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,44 @@
+import pytest
+import catalog
+
+
+@pytest.fixture(autouse=True)
+def empty_catalog(monkeypatch):
+    monkeypatch.setattr(catalog, "_brands", catalog._FuzzyIndex())
+    monkeypatch.setattr(catalog, "_models", {})
+    monkeypatch.setattr(catalog, "_model_brand", {})
+    monkeypatch.setattr(catalog, "_unsaved", set())
+
+
+def test_normalize():
+    assert catalog.normalize("Apple / iPhone 12Pro 128GB") == "apple iphone 12 pro"
+
+
+@pytest.mark.parametrize("learned, other", [
+    (("Samsung", "Galaxy Tab S7"), ("Samsung", "Galaxy Tab A7")),
+    (("Samsung", "Galaxy S21 Ultra"), ("Samsung", "Galaxy A21 Ultra")),
+    (("Canon", "EOS 5D"), ("Canon", "EOS 5DS")),
+    (("Apple", "iPhone 12"), ("Apple", "iPhone 13")),
+    (("Apple", "iPhone 12"), ("Apple", "iPhone 12 mini")),
+    (("Apple", "iPhone SE"), ("Apple", "iPhone XR")),
+    (("Nvidia", "GTX 3080"), ("Nvidia", "RTX 3080")),
+])
+def test_different_models_stay_apart(learned, other):
+    key = catalog.learn(*learned)
+    assert catalog.product_key(*other) != key
+
+
+@pytest.mark.parametrize("learned, typo", [
+    (("Samsung", "Galaxy S21 Ultra"), ("Samsung", "Galaxxy S21 Ultra")),
+    (("Apple", "iPhone 12 Pro"), ("Aple", "iphone 12pro")),
+    (("Sony", "WH-1000XM4"), ("Sony", "wh 1000 xm4")),
+])
+def test_typos_merge(learned, typo):
+    key = catalog.learn(*learned)
+    assert catalog.product_key(*typo) == key
+
+
+def test_brand_from_model():
+    catalog.learn("Apple", "iPhone 12")
+    assert catalog.product_key(None, "Apple iPhone 12") == "apple iphone 12"
+    assert catalog.product_key("", "iPhone 12") == "apple iphone 12"
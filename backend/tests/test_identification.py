@@ -0,0 +1,42 @@
+from identification import fuse_identifications
+
+
+def test_weighted_majority():
+    fused, confidence = fuse_identifications([
+        ({"brand": "Apple", "model_or_type": "iPhone 12"}, 1),
+        ({"brand": "apple ", "model_or_type": "iPhone 13"}, 2),
+        ({"brand": "Samsung", "model_or_type": "iPhone 12"}, 1),
+    ])
+    # Schreibvarianten zählen zusammen, ausgegeben wird die erste
+    assert fused["brand"] == "Apple"
+    assert confidence["brand"] == 0.75
+    # Gleichstand 2:2 nach Gewicht
+    assert fused["model_or_type"] == "iPhone 12"
+    assert confidence["model_or_type"] == 0.5
+
+
+def test_tie_goes_to_earlier_image():
+    fused, confidence = fuse_identifications([({"color": "Schwarz"}, 1), ({"color": "Weiß"}, 1)])
+    assert fused["color"] == "Schwarz"
+    assert confidence["color"] == 0.5
+
+
+def test_missing_values_do_not_vote():
+    fused, confidence = fuse_identifications([({"color": None}, 1), ({"color": ""}, 1), ({"color": "Rot"}, 1)])
+    assert fused["color"] == "Rot"
+    assert confidence["color"] == 0.33
+
+    fused, confidence = fuse_identifications([({"color": None}, 2)])
+    assert fused["color"] is None
+    assert confidence["color"] == 0.0
+
+
+def test_special_notes_are_merged():
+    fused, confidence = fuse_identifications([
+        ({"special_notes": "Kratzer am Rand"}, 1),
+        ({"special_notes": "OVP vorhanden"}, 1),
+        ({"special_notes": "Kratzer am Rand "}, 1),
+        ({"special_notes": ""}, 1),
+    ])
+    assert fused["special_notes"] == "Kratzer am Rand; OVP vorhanden"
+    assert "special_notes" not in confidence
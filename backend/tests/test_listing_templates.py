@@ -0,0 +1,57 @@
+import catalog
+import listing_templates
+from routes.listing import format_price, listing_key
+
+PHONE = {
+    "brand": "Apple",
+    "model_or_type": "iPhone 12",
+    "category": "Elektronik/Handy & Telefon",
+    "color": "Schwarz",
+    "condition": "Gut",
+    "special_notes": "Displayschutzfolie",
+}
+
+
+def test_supports_structured_categories_only():
+    assert listing_templates.supports(PHONE)
+    assert not listing_templates.supports({**PHONE, "category": "Mode & Beauty/Damenschuhe"})
+    assert not listing_templates.supports({**PHONE, "model_or_type": None})
+
+
+def test_render():
+    listing = listing_templates.render(PHONE, "420,00 €")
+    assert listing["title"] == "Apple iPhone 12 – Schwarz – Gut"
+    assert listing["description"].startswith("Ich verkaufe hier mein Apple iPhone 12. Farbe: Schwarz.")
+    assert "Displayschutzfolie." in listing["description"]
+    assert listing["price"] == "420,00 €"
+    assert listing["condition"] == "Gut"
+
+
+def test_render_does_not_repeat_brand():
+    listing = listing_templates.render({**PHONE, "model_or_type": "Apple iPhone 12"}, "420,00 €")
+    assert listing["title"].startswith("Apple iPhone 12 –")
+
+
+def test_title_stays_within_limit():
+    long_model = {**PHONE, "model_or_type": "iPhone 12 Pro Max " + "x" * 50}
+    assert len(listing_templates.render(long_model, "1 €")["title"]) <= listing_templates.TITLE_MAX
+
+
+def test_format_price():
+    assert format_price("1234.5") == "1.234,50 €"
+    assert format_price(None) == "Preis auf Anfrage"
+    assert format_price("VB") == "VB"
+
+
+def test_listing_key(monkeypatch):
+    monkeypatch.setattr(catalog, "_brands", catalog._FuzzyIndex())
+    monkeypatch.setattr(catalog, "_models", {})
+    monkeypatch.setattr(catalog, "_model_brand", {})
+    monkeypatch.setattr(catalog, "_unsaved", set())
+    catalog.learn("Apple", "iPhone 12")
+
+    key = listing_key(PHONE, "420,00 €")
+    variant = {**PHONE, "brand": "apple", "model_or_type": "Apple iphone 12", "color": " schwarz "}
+    assert listing_key(variant, "420,00 €") == key
+    assert listing_key(PHONE, "400,00 €") != key
+    assert listing_key({**PHONE, "condition": "Sehr Gut"}, "420,00 €") != key
@@ -0,0 +1,55 @@
+import numpy as np
+import pricing
+
+FEATURES = {"brand": "Apple", "model_or_type": "iPhone 12", "condition": "Gut"}
+
+
+def ad(price, title="Apple iPhone 12", condition="Gut"):
+    return {"title": title, "price": price, "condition": condition}
+
+
+def test_weighted_median():
+    assert pricing._weighted_median(np.array([3.0, 1.0, 2.0]), np.array([1.0, 1.0, 1.0])) == 2.0
+    assert pricing._weighted_median(np.array([1.0, 2.0, 3.0]), np.array([1.0, 1.0, 10.0])) == 3.0
+
+
+def test_no_usable_prices():
+    assert pricing.estimate(FEATURES, []) is None
+    assert pricing.estimate(FEATURES, [ad("Zu verschenken"), ad("VB")]) is None
+    # Keine Übereinstimmung mit Marke/Modell -> Gewicht 0
+    assert pricing.estimate(FEATURES, [ad("300 €", title="Samsung Galaxy S21")]) is None
+
+
+def test_estimate():
+    comparables = [ad(f"{p} € VB") for p in (380, 400, 410, 420, 450)]
+    result = pricing.estimate(FEATURES, comparables)
+    assert result["value"] == 410
+    assert result["low"] <= result["value"] <= result["high"]
+    assert result["samples"] == 5
+    assert result["outliers_removed"] == 0
+    assert 0 < result["confidence"] <= 1
+    # Fester Seed: gleiche Eingabe, gleiches Ergebnis
+    assert pricing.estimate(FEATURES, comparables) == result
+
+
+def test_outliers_removed():
+    comparables = [ad(f"{p} €") for p in (380, 400, 410, 420, 450)] + [ad("1 €"), ad("9.999 €")]
+    result = pricing.estimate(FEATURES, comparables)
+    assert result["outliers_removed"] == 2
+    assert result["samples"] == 5
+    assert result["value"] == 410
+
+
+def test_condition_weighting():
+    comparables = [ad("300 €", condition="Defekt"), ad("310 €", condition="In Ordnung"),
+                   ad("500 €", condition="Gut"), ad("520 €", condition="Sehr Gut")]
+    assert pricing.estimate(FEATURES, comparables)["value"] >= 500
+    assert pricing.estimate({**FEATURES, "condition": "Defekt"}, comparables)["value"] <= 310
+
+
+def test_confidence_grows_with_agreeing_samples():
+    few = pricing.estimate(FEATURES, [ad("400 €"), ad("420 €")])
+    many = pricing.estimate(FEATURES, [ad(f"{p} €") for p in (395, 400, 405, 410, 415, 420, 425, 430)])
+    scattered = pricing.estimate(FEATURES, [ad(f"{p} €") for p in (150, 250, 400, 600, 800, 950, 300, 700)])
+    assert many["confidence"] > few["confidence"]
+    assert many["confidence"] > scattered["confidence"]
@@ -0,0 +1,43 @@
+import json
+import pytest
+from streaming import JsonFieldStream, sse
+
+REPLY = {
+    "title": "iPhone 12 – \"wie neu\"",
+    "suggested_price": 420.5,
+    "tags": ["a", {"b": "}"}],
+    "details": {"color": "Schwarz", "nested": [1, 2]},
+    "sold": False,
+    "description": "Zeile 1\nZeile 2 mit , und : und {",
+}
+
+
+def feed_all(text: str, size: int) -> list[tuple[str, object]]:
+    stream = JsonFieldStream()
+    fields = []
+    for i in range(0, len(text), size):
+        fields += stream.feed(text[i:i + size])
+    return fields
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 1000])
+def test_fields_in_any_chunking(size):
+    text = json.dumps(REPLY, ensure_ascii=False, indent=2)
+    assert feed_all(text, size) == list(REPLY.items())
+
+
+def test_ignores_code_fence():
+    text = "```json\n" + json.dumps({"title": "x", "price": 1}) + "\n```"
+    assert feed_all(text, 3) == [("title", "x"), ("price", 1)]
+
+
+def test_field_reported_as_soon_as_complete():
+    stream = JsonFieldStream()
+    assert stream.feed('{"title": "iPh') == []
+    assert stream.feed('one", "descr') == [("title", "iPhone")]
+    assert stream.feed('iption": "x"}') == [("description", "x")]
+
+
+def test_sse():
+    assert sse("field", {"name": "title", "value": "Ä"}) == \
+        'event: field\ndata: {"name": "title", "value": "Ä"}\n\n'
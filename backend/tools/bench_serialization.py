@@ -0,0 +1,132 @@
+import json
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+from pathlib import Path
+from bson import ObjectId
+from bson.json_util import dumps as bson_dumps
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import serialization
+
+# Mikro-Benchmark für die Antworten von /listing/ad-process/ und /listing/ad-processes/:
+# alter Weg (json_util -> json.loads -> jsonable_encoder -> JSONResponse) gegen
+# MongoJSONResponse mit Standardbibliothek und, falls installiert, orjson.
+#
+#   python tools/bench_serialization.py [anzahl_dokumente]
+
+random.seed(7)
+NOW = datetime(2025, 3, 14, 12, 30, 15, 123456)
+
+
+def comparable(i: int) -> dict:
+    return {
+        "title": f"Apple iPhone 12 128GB Schwarz – Angebot {i}",
+        "description": "Gepflegtes Gerät mit leichten Gebrauchsspuren, Akku 87 %, Originalverpackung "
+                       "und Ladekabel dabei. Versand oder Abholung möglich. " * 3,
+        "price": f"{random.randint(300, 520)}.00",
+        "condition": random.choice(["Neu", "Sehr Gut", "Gut", "In Ordnung"]),
+        "location": "10115 Berlin",
+        "date": (NOW - timedelta(days=i)).isoformat(),
+        "url": f"https://www.kleinanzeigen.de/s-anzeige/{2900000000 + i}"
+    }
+
+
+def full_document(i: int) -> dict:
+    created = NOW - timedelta(minutes=i)
+    return {
+        "_id": ObjectId(),
+        "user_id": "user-42",
+        "created_at": created,
+        "wizard_state": "LISTING_READY",
+        "image_urls": [f"/uploads/{ObjectId()}.jpg" for _ in range(4)],
+        "identification": {
+            "status": "DONE",
+            "started_at": created,
+            "finished_at": created + timedelta(seconds=6),
+            "confidence": 0.91,
+            "data": {
+                "brand": "Apple",
+                "model_or_type": "iPhone 12",
+                "category": "Elektronik/Handy & Telefon",
+                "color": "Schwarz",
+                "condition": "Gut",
+                "special_notes": "Mit Originalverpackung"
+            }
+        },
+        "price_data": {
+            "comparables": [comparable(j) for j in range(10)],
+            "suggestion": {
+                "suggested_price": "420,00 €",
+                "pricerelevante_faktoren": "Zustand, Speicher, Zubehör",
+                "explanation": "Gewichteter Median aus 10 Vergleichsanzeigen (Spanne 320,00 € bis 510,00 €)."
+            }
+        },
+        "listing": {
+            "title": "Apple iPhone 12 Schwarz – guter Zustand",
+            "description": "Gepflegtes iPhone 12 in Schwarz mit Originalverpackung. " * 8,
+            "condition": "Gut",
+            "category": "Elektronik/Handy & Telefon",
+            "price": "420,00 €",
+            "method": "llm"
+        },
+        "steps": {"listing": {"status": "DONE", "started_at": created, "finished_at": created}}
+    }
+
+
+def summary_document(doc: dict) -> dict:
+    # Entspricht der Projektion AD_PROCESS_SUMMARY
+    data = doc["identification"]["data"]
+    return {
+        "_id": doc["_id"],
+        "user_id": doc["user_id"],
+        "created_at": doc["created_at"],
+        "wizard_state": doc["wizard_state"],
+        "image_urls": doc["image_urls"][:1],
+        "identification": {"status": "DONE", "data": {k: data[k] for k in ("brand", "model_or_type", "category")}},
+        "price_data": {"suggestion": {"suggested_price": doc["price_data"]["suggestion"]["suggested_price"]}},
+        "listing": {"title": doc["listing"]["title"]}
+    }
+
+
+def old_path(content) -> bytes:
+    return JSONResponse(jsonable_encoder(json.loads(bson_dumps(content)))).body
+
+
+def measure(name: str, fn, content, per: int, number: int):
+    seconds = min(timeit.repeat(lambda: fn(content), number=number, repeat=5)) / number
+    print(f"  {name:<22} {seconds / per * 1e6:9.1f} µs/Dokument  {len(fn(content)):>9} Bytes")
+    return seconds
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    docs = [full_document(i) for i in range(count)]
+    cases = {
+        "Detailansicht (1 Dokument)": (docs[0], 1),
+        f"Übersicht ({count} Dokumente)": ({"items": [summary_document(d) for d in docs], "next_cursor": None}, count),
+        f"Volle Dokumente ({count})": (docs, count),
+    }
+    encoders = [("json_util + encoder", old_path), ("stdlib", serialization._dumps_stdlib)]
+    if serialization.orjson is not None:
+        encoders.append(("orjson", serialization._dumps_orjson))
+
+    for title, (content, per) in cases.items():
+        # Gleiche Ausgabe wie bisher sicherstellen
+        expected = json.loads(old_path(content))
+        for name, fn in encoders[1:]:
+            assert json.loads(fn(content)) == expected, name
+
+        print(title)
+        number = max(1, 2000 // per)
+        baseline = measure(*encoders[0], content, per, number)
+        for name, fn in encoders[1:]:
+            seconds = measure(name, fn, content, per, number)
+            print(f"  {'':<22} {baseline / seconds:9.1f}x schneller")
+
+
+if __name__ == "__main__":
+    main()
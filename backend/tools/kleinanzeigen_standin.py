@@ -0,0 +1,49 @@
+import hashlib
+import json
+import random
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import Response
+from tools import standin_faults as faults
+
+# Lokaler Stand-in für die Kleinanzeigen-Suche (comparables.py):
+#
+#   uvicorn tools.kleinanzeigen_standin:app --port 8101
+#   KLEINANZEIGEN_SEARCH_URL=http://localhost:8101/ads/v1/kleinanzeigen/search
+#
+# Gleiche Suchbegriffe liefern immer dieselben Anzeigen. Latenz, 429 und abgeschnittenes
+# JSON steuert tools/standin_faults.py.
+
+app = FastAPI()
+
+CONDITIONS = ["Neu", "Sehr Gut", "Gut", "In Ordnung"]
+
+
+def _ads(query: str, limit: int) -> list[dict]:
+    seed = int(hashlib.sha256(query.casefold().encode()).hexdigest()[:8], 16)
+    rng = random.Random(seed)
+    base = rng.randint(50, 900)
+    ads = []
+    for i in range(limit):
+        ad_id = str(2_900_000_000 + seed % 1_000_000 * 100 + i)
+        ads.append({
+            "id": ad_id,
+            "url": f"https://www.kleinanzeigen.de/s-anzeige/{ad_id}",
+            "title": f"{query} – Angebot {i + 1}",
+            "description": f"Verkaufe {query}, gepflegt, mit leichten Gebrauchsspuren. Versand möglich.",
+            "price": f"{round(base * rng.uniform(0.8, 1.2))} € VB",
+            "metadata": {"details_text": f"Zustand: {rng.choice(CONDITIONS)} | Versand: möglich"}
+        })
+    return ads
+
+
+@app.get("/ads/v1/kleinanzeigen/search")
+async def search(query: str, limit: int = 5, ads_key: str = Header("", convert_underscores=False)):
+    if not ads_key:
+        raise HTTPException(status_code=401, detail="missing ads_key")
+    await faults.delay()
+    if (limited := faults.rate_limited()) is not None:
+        return limited
+    body = json.dumps({"data": {"ads": _ads(query, limit)}}, ensure_ascii=False)
+    if faults.malformed():
+        body = faults.truncate(body)
+    return Response(body, media_type="application/json")
@@ -0,0 +1,461 @@
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import httpx
+import numpy as np
+from PIL import Image
+
+# End-to-End-Lasttest: startet das Backend (uvicorn, wahlweise mit mehreren Workern)
+# gegen lokale Stand-ins für OpenAI (tools/openai_standin.py) und die Kleinanzeigen-Suche
+# (tools/kleinanzeigen_standin.py) sowie eine frische MongoDB und erzeugt gemischten
+# Wizard-Verkehr. Ausgabe: Durchsatz, p50/p95/p99 je Endpunkt und maximaler RSS des Backends.
+#
+#   python tools/loadtest.py --users 20 --duration 60
+#   python tools/loadtest.py --openai-latency 1.5 --rate-limit 0.02 --malformed 0.01
+#   python tools/loadtest.py --json neu.json --baseline alt.json --max-regression 0.2
+#
+# Ohne --mongo-uri wird mongod aus dem PATH in einem temporären Verzeichnis gestartet,
+# sonst landen die Daten in der Datenbank --mongo-db. Mit --baseline endet der Lauf mit
+# Exit-Code 1, wenn p95, Durchsatz oder RSS um mehr als --max-regression schlechter sind.
+#
+# Ablauf der virtuellen Nutzer (Gewichte über --mix):
+#   wizard    Upload, Erkennung, Vergleichsanzeigen, Preis, Anzeigentext (teils gestreamt), Detailansicht
+#   pipeline  Upload und /pipeline/ in einem Aufruf
+#   browse    Übersicht der eigenen AdProcesses
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+API = "/api"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Lasttest gegen lokale Stand-ins")
+    parser.add_argument("--users", type=int, default=20, help="gleichzeitige virtuelle Nutzer")
+    parser.add_argument("--duration", type=float, default=60, help="Messdauer in Sekunden")
+    parser.add_argument("--warmup", type=float, default=5, help="nicht gemessene Anlaufzeit in Sekunden")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn-Worker des Backends")
+    parser.add_argument("--mix", default="wizard=6,pipeline=3,browse=1")
+    parser.add_argument("--stream-rate", type=float, default=0.5, help="Anteil gestreamter Anzeigentexte")
+    parser.add_argument("--repeat-rate", type=float, default=0.1, help="Anteil erneut hochgeladener Bilder")
+    parser.add_argument("--images", type=int, default=100, help="Anzahl vorab erzeugter Testbilder")
+    parser.add_argument("--image-size", default="1600x1200")
+    parser.add_argument("--openai-latency", type=float, default=0.8)
+    parser.add_argument("--search-latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.2, help="Anteil der Latenz als Streuung")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Anteil 429-Antworten der Stand-ins")
+    parser.add_argument("--malformed", type=float, default=0.0, help="Anteil kaputter JSON-Antworten")
+    parser.add_argument("--mongo-uri", default=None)
+    parser.add_argument("--mongo-db", default="kleinanzeigen_loadtest")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_path", default=None, help="Ergebnis als JSON speichern")
+    parser.add_argument("--baseline", default=None, help="früheres JSON-Ergebnis zum Vergleich")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    parser.add_argument("--keep", action="store_true", help="Logs und Daten nicht löschen")
+    return parser.parse_args()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, proc: subprocess.Popen, name: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"{name} wurde beendet (Exit-Code {proc.returncode}), siehe Log")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    sys.exit(f"{name} nicht erreichbar auf Port {port}")
+
+
+def wait_for_http(url: str, proc: subprocess.Popen, name: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"{name} wurde beendet (Exit-Code {proc.returncode}), siehe Log")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    sys.exit(f"{name} antwortet nicht: {url}")
+
+
+class Services:
+    # Stand-ins, MongoDB und Backend als Unterprozesse; Ausgaben in <workdir>/logs
+    def __init__(self, args, workdir: Path):
+        self.args = args
+        self.workdir = workdir
+        self.procs: list[subprocess.Popen] = []
+        (workdir / "logs").mkdir()
+
+    def spawn(self, name: str, cmd: list[str], env: dict | None = None) -> subprocess.Popen:
+        log = open(self.workdir / "logs" / f"{name}.log", "wb")
+        proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, env={**os.environ, **(env or {})},
+                                stdout=log, stderr=subprocess.STDOUT)
+        self.procs.append(proc)
+        return proc
+
+    def standin(self, name: str, module: str, latency: float) -> str:
+        port = free_port()
+        proc = self.spawn(name, [sys.executable, "-m", "uvicorn", f"tools.{module}:app",
+                                 "--port", str(port), "--no-access-log", "--log-level", "warning"], {
+            "STANDIN_LATENCY": str(latency),
+            "STANDIN_JITTER": str(latency * self.args.jitter),
+            "STANDIN_429_RATE": str(self.args.rate_limit),
+            "STANDIN_MALFORMED_RATE": str(self.args.malformed),
+            "STANDIN_SEED": str(self.args.seed),
+        })
+        wait_for_port(port, proc, name)
+        return f"http://127.0.0.1:{port}"
+
+    def mongo(self) -> str:
+        if self.args.mongo_uri:
+            return self.args.mongo_uri
+        mongod = shutil.which("mongod")
+        if mongod is None:
+            sys.exit("mongod nicht gefunden: --mongo-uri angeben, z. B. nach "
+                     "'docker run -d -p 27017:27017 mongo:6' --mongo-uri mongodb://localhost:27017")
+        port = free_port()
+        (self.workdir / "db").mkdir()
+        proc = self.spawn("mongod", [mongod, "--dbpath", str(self.workdir / "db"), "--port", str(port),
+                                     "--bind_ip", "127.0.0.1", "--quiet"])
+        wait_for_port(port, proc, "mongod")
+        return f"mongodb://127.0.0.1:{port}"
+
+    def start(self) -> tuple[str, subprocess.Popen]:
+        openai_url = self.standin("openai_standin", "openai_standin", self.args.openai_latency)
+        search_url = self.standin("kleinanzeigen_standin", "kleinanzeigen_standin", self.args.search_latency)
+        mongo_uri = self.mongo()
+
+        port = free_port()
+        (self.workdir / "uploads").mkdir()
+        backend = self.spawn("backend", [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                                         "--workers", str(self.args.workers), "--no-access-log",
+                                         # wie hinter dem Reverse Proxy: keine Abbrüche wiederverwendeter Verbindungen
+                                         "--timeout-keep-alive", "75"], {
+            "MONGODB_URI": mongo_uri,
+            "MONGODB_DB": self.args.mongo_db,
+            "OPENAI_API_KEY": "loadtest",
+            "OPENAI_BASE_URL": f"{openai_url}/v1",
+            "OPENAI_BATCH_BASE_URL": f"{openai_url}/v1",
+            "KLEINANZEIGEN_API_KEY": "loadtest",
+            "KLEINANZEIGEN_SEARCH_URL": f"{search_url}/ads/v1/kleinanzeigen/search",
+            "UPLOAD_DIR": str(self.workdir / "uploads"),
+            "WEB_CONCURRENCY": str(self.args.workers),
+        })
+        base_url = f"http://127.0.0.1:{port}"
+        wait_for_http(f"{base_url}/metrics", backend, "backend")
+        return base_url, backend
+
+    def stop(self):
+        for proc in reversed(self.procs):
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def make_images(count: int, size: str, seed: int) -> list[bytes]:
+    # Unterschiedliche Motive (grober Farbverlauf + Rauschen), damit weder SHA-256 noch
+    # der Wahrnehmungs-Hash des Uploads zwei Testbilder als Duplikat erkennen
+    width, height = (int(v) for v in size.split("x"))
+    rng = np.random.default_rng(seed)
+    result = []
+    for _ in range(count):
+        coarse = Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8))
+        image = np.asarray(coarse.resize((width, height), Image.BICUBIC), dtype=np.int16)
+        image = image + rng.integers(-12, 13, image.shape, dtype=np.int16)
+        buffer = io.BytesIO()
+        Image.fromarray(image.clip(0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=88)
+        result.append(buffer.getvalue())
+    return result
+
+
+class Recorder:
+    def __init__(self, measure_from: float, measure_until: float):
+        self.measure_from = measure_from
+        self.measure_until = measure_until
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, dict[str, int]] = {}
+        self.flows: dict[str, dict[str, int]] = {}
+
+    def measured(self, started: float) -> bool:
+        return self.measure_from <= started < self.measure_until
+
+    def request(self, endpoint: str, started: float, seconds: float, status: str | None):
+        if not self.measured(started):
+            return
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        if status is not None:
+            errors = self.errors.setdefault(endpoint, {})
+            errors[status] = errors.get(status, 0) + 1
+
+    def flow(self, name: str, started: float, ok: bool):
+        if not self.measured(started):
+            return
+        counts = self.flows.setdefault(name, {"ok": 0, "failed": 0})
+        counts["ok" if ok else "failed"] += 1
+
+
+class FlowFailed(Exception):
+    pass
+
+
+class User:
+    def __init__(self, index: int, client: httpx.AsyncClient, recorder: Recorder, images: "ImagePool",
+                 args, rng: random.Random):
+        self.user_id = f"loadtest-{index}"
+        self.client = client
+        self.recorder = recorder
+        self.images = images
+        self.args = args
+        self.rng = rng
+
+    async def call(self, endpoint: str, method: str, path: str, stream: bool = False, **kwargs):
+        started = time.monotonic()
+        status = None
+        try:
+            if stream:
+                async with self.client.stream(method, API + path, **kwargs) as response:
+                    body = b"".join([chunk async for chunk in response.aiter_bytes()])
+                    # Fehler im Stream kommen als SSE-Event mit Status 200
+                    if response.status_code == 200 and b"event: error" in body:
+                        status = "stream-error"
+            else:
+                response = await self.client.request(method, API + path, **kwargs)
+            if response.status_code >= 400:
+                status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        self.recorder.request(endpoint, started, time.monotonic() - started, status)
+        if status is not None:
+            raise FlowFailed(f"{endpoint}: {status}")
+        return None if stream else response.json()
+
+    async def upload(self) -> str:
+        name, data = self.images.pick(self.rng)
+        result = await self.call("POST /upload/", "POST", "/upload/",
+                                 files={"file": (name, data, "image/jpeg")})
+        return result["url"]
+
+    async def wizard(self):
+        url = await self.upload()
+        identified = await self.call("POST /identify/", "POST", "/identify/",
+                                     json={"image_urls": [url], "user_id": self.user_id})
+        ad_process_id = identified["ad_process_id"]
+        await self.call("POST /price/comparables/", "POST", "/price/comparables/",
+                        json={"ad_process_id": ad_process_id})
+        await self.call("POST /price/suggest/", "POST", "/price/suggest/",
+                        json={"ad_process_id": ad_process_id})
+        if self.rng.random() < self.args.stream_rate:
+            await self.call("POST /listing/generate/stream/", "POST", "/listing/generate/stream/",
+                            stream=True, json={"ad_process_id": ad_process_id})
+        else:
+            await self.call("POST /listing/generate/", "POST", "/listing/generate/",
+                            json={"ad_process_id": ad_process_id})
+        await self.call("GET /listing/ad-process/{id}/", "GET", f"/listing/ad-process/{ad_process_id}/")
+
+    async def pipeline(self):
+        url = await self.upload()
+        await self.call("POST /pipeline/", "POST", "/pipeline/",
+                        json={"image_urls": [url], "user_id": self.user_id})
+
+    async def browse(self):
+        await self.call("GET /listing/ad-processes/", "GET", "/listing/ad-processes/",
+                        params={"user_id": self.user_id})
+
+    async def run(self, flows: list[str], weights: list[float], deadline: float):
+        while time.monotonic() < deadline:
+            name = self.rng.choices(flows, weights)[0]
+            started = time.monotonic()
+            try:
+                await getattr(self, name)()
+                ok = True
+            except FlowFailed:
+                ok = False
+            self.recorder.flow(name, started, ok)
+
+
+class ImagePool:
+    def __init__(self, images: list[bytes], repeat_rate: float):
+        self.images = images
+        self.repeat_rate = repeat_rate
+        self.next = 0
+
+    def pick(self, rng: random.Random) -> tuple[str, bytes]:
+        # Neue Bilder der Reihe nach, ein Teil der Uploads wiederholt ein bereits genutztes
+        if self.next and rng.random() < self.repeat_rate:
+            index = rng.randrange(min(self.next, len(self.images)))
+        else:
+            index = self.next % len(self.images)
+            self.next += 1
+        return f"loadtest_{index}.jpg", self.images[index]
+
+
+def _children(pid: int) -> list[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(c) for c in f.read().split()]
+    except OSError:
+        return []
+    return children + [grandchild for child in children for grandchild in _children(child)]
+
+
+def _rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+async def sample_rss(pid: int, peak: dict):
+    # Summe über den uvicorn-Hauptprozess und alle Worker (nur Linux, /proc)
+    while True:
+        total = sum(_rss_bytes(p) for p in [pid, *_children(pid)])
+        peak["bytes"] = max(peak["bytes"], total)
+        await asyncio.sleep(0.25)
+
+
+def percentile(values: list[float], p: float) -> float:
+    # Nearest-Rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(recorder: Recorder, window: float, peak_rss: int, args) -> dict:
+    endpoints = {}
+    for endpoint, values in sorted(recorder.latencies.items()):
+        errors = recorder.errors.get(endpoint, {})
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "errors": sum(errors.values()),
+            "error_status": errors,
+            "rps": round(len(values) / window, 2),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+        }
+    requests = sum(e["requests"] for e in endpoints.values())
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in ("json_path", "baseline", "keep")},
+        "window_s": round(window, 1),
+        "requests": requests,
+        "rps": round(requests / window, 2),
+        "flows": recorder.flows,
+        "flows_per_s": round(sum(f["ok"] for f in recorder.flows.values()) / window, 2),
+        "peak_rss_mb": round(peak_rss / 1024 ** 2, 1),
+        "endpoints": endpoints,
+    }
+
+
+def print_report(result: dict):
+    print(f"\nMessfenster {result['window_s']} s, {result['requests']} Anfragen, "
+          f"{result['rps']} Anfragen/s, {result['flows_per_s']} erfolgreiche Abläufe/s")
+    for name, counts in sorted(result["flows"].items()):
+        print(f"  {name:<10} {counts['ok']:>6} ok {counts['failed']:>6} fehlgeschlagen")
+    print(f"Maximaler RSS des Backends: {result['peak_rss_mb']} MB\n")
+    header = f"{'Endpunkt':<34} {'n':>7} {'Fehler':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, e in result["endpoints"].items():
+        print(f"{endpoint:<34} {e['requests']:>7} {e['errors']:>7} {e['rps']:>8} "
+              f"{e['p50_ms']:>9} {e['p95_ms']:>9} {e['p99_ms']:>9}")
+        if e["error_status"]:
+            print(f"{'':<34} Fehler: {json.dumps(e['error_status'])}")
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> list[str]:
+    regressions = []
+    limit = 1 + max_regression
+    if result["rps"] < baseline["rps"] / limit:
+        regressions.append(f"Durchsatz {baseline['rps']} -> {result['rps']} Anfragen/s")
+    if result["peak_rss_mb"] > baseline["peak_rss_mb"] * limit:
+        regressions.append(f"RSS {baseline['peak_rss_mb']} -> {result['peak_rss_mb']} MB")
+    for endpoint, e in result["endpoints"].items():
+        old = baseline["endpoints"].get(endpoint)
+        if old and e["p95_ms"] > old["p95_ms"] * limit:
+            regressions.append(f"{endpoint}: p95 {old['p95_ms']} -> {e['p95_ms']} ms")
+    return regressions
+
+
+async def drive(base_url: str, backend_pid: int, images: ImagePool, args) -> dict:
+    flows, weights = [], []
+    for part in args.mix.split(","):
+        name, weight = part.split("=")
+        if name not in ("wizard", "pipeline", "browse"):
+            sys.exit(f"Unbekannter Ablauf in --mix: {name}")
+        flows.append(name)
+        weights.append(float(weight))
+
+    start = time.monotonic()
+    recorder = Recorder(start + args.warmup, start + args.warmup + args.duration)
+    peak = {"bytes": 0}
+    sampler = asyncio.create_task(sample_rss(backend_pid, peak))
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        rng = random.Random(args.seed)
+        users = [User(i, client, recorder, images, args, random.Random(rng.random())) for i in range(args.users)]
+        await asyncio.gather(*(user.run(flows, weights, recorder.measure_until) for user in users))
+    sampler.cancel()
+    return summarize(recorder, args.duration, peak["bytes"], args)
+
+
+def main():
+    args = parse_args()
+    print(f"Erzeuge {args.images} Testbilder ({args.image_size}) …")
+    images = ImagePool(make_images(args.images, args.image_size, args.seed), args.repeat_rate)
+
+    workdir = Path(tempfile.mkdtemp(prefix="loadtest_"))
+    services = Services(args, workdir)
+    try:
+        base_url, backend = services.start()
+        print(f"Backend {base_url} mit {args.workers} Worker(n), {args.users} Nutzer, "
+              f"{args.warmup:g} s Anlauf + {args.duration:g} s Messung …")
+        result = asyncio.run(drive(base_url, backend.pid, images, args))
+    finally:
+        services.stop()
+        if args.keep:
+            print(f"Logs und Daten: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(result)
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(result, indent=2, ensure_ascii=False))
+
+    if args.baseline:
+        regressions = compare(result, json.loads(Path(args.baseline).read_text()), args.max_regression)
+        if regressions:
+            print(f"\nRegressionen (> {args.max_regression:.0%}):")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"\nKeine Regression gegenüber {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
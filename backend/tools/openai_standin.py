@@ -0,0 +1,259 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from tools import standin_faults as faults
+
+# Lokaler Stand-in für die OpenAI-Schnittstellen (Responses, Chat Completions inkl.
+# Streaming, Dateien und Batches), um ohne echte Aufrufe zu testen:
+#
+#   uvicorn tools.openai_standin:app --port 8100
+#   OPENAI_BASE_URL=http://localhost:8100/v1
+#   OPENAI_BATCH_BASE_URL=http://localhost:8100/v1
+#
+# Batches gelten nach STANDIN_BATCH_DELAY Sekunden als fertig. Jede Anfrage erhält
+# eine feste, zum Endpunkt und Prompt passende Antwort im Schema aus models.py; bei der Erkennung hängt das
+# Produkt von den Bildern ab, damit Caches und Preisindex realistisch getroffen werden. Latenz, 429 und kaputtes JSON
+# der direkten Aufrufe steuert tools/standin_faults.py (im Modelltext, wie bei einem
+# Modell, das sich nicht ans Format hält).
+
+STANDIN_BATCH_DELAY = float(os.getenv("STANDIN_BATCH_DELAY", "0"))
+
+IDENTIFICATION = {
+    "brand": "Apple",
+    "model_or_type": "iPhone 12",
+    "category": "Elektronik/Handy & Telefon",
+    "color": "Schwarz",
+    "condition": "Gut",
+    "special_notes": "Mit Originalverpackung"
+}
+# Marke, Modell, Kategorie; mit VARIANTS ergeben sich rund hundert Produkte
+PRODUCTS = [
+    ("Apple", "iPhone 12", "Elektronik/Handy & Telefon"),
+    ("Samsung", "Galaxy S21", "Elektronik/Handy & Telefon"),
+    ("Apple", "iPad Air", "Elektronik/Tablets & Reader"),
+    ("Sony", "WH-1000XM4", "Elektronik/Audio & Hifi"),
+    ("Nintendo", "Switch", "Elektronik/Konsolen"),
+    ("Canon", "EOS 250D", "Elektronik/Foto"),
+    ("IKEA", "Kallax Regal", "Haus & Garten/Wohnzimmer"),
+    ("Bosch", "Akkuschrauber GSR 12V", "Haus & Garten/Heimwerken"),
+    ("Cube", "Aim Mountainbike", "Auto, Rad & Boot/Fahrräder & Zubehör"),
+    ("Apple", "MacBook Air", "Elektronik/Notebooks"),
+    ("Philips", "Airfryer XL", "Haus & Garten/Küche & Esszimmer"),
+    ("Dyson", "V11 Staubsauger", "Elektronik/Haushaltsgeräte"),
+]
+VARIANTS = ["", " 64GB", " 128GB", " 256GB", " Pro", " Mini", " Schwarz", " Weiß"]
+
+PRICE = {
+    "suggested_price": 420.0,
+    "pricerelevante_faktoren": "Zustand, Speicher",
+    "explanation": "Fünf vergleichbare Anzeigen zwischen 380 und 460 €."
+}
+LISTING = {
+    "title": "Apple iPhone 12 Schwarz – guter Zustand",
+    "description": "Gepflegtes iPhone 12 in Schwarz mit Originalverpackung."
+}
+
+app = FastAPI()
+_files: dict[str, dict] = {}
+_batches: dict[str, dict] = {}
+
+
+class BatchCreate(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+
+
+def identification(body: dict) -> dict:
+    # Gleiche Bilder -> gleiches Produkt
+    digest = hashlib.sha256(json.dumps(body.get("input"), sort_keys=True).encode()).digest()
+    brand, model, category = PRODUCTS[digest[0] % len(PRODUCTS)]
+    return {
+        **IDENTIFICATION,
+        "brand": brand,
+        "model_or_type": model + VARIANTS[digest[1] % len(VARIANTS)],
+        "category": category
+    }
+
+
+def reply_text(url: str, body: dict) -> str:
+    if url == "/v1/responses":
+        return json.dumps(identification(body), ensure_ascii=False)
+    system = (body.get("messages") or [{}])[0].get("content", "")
+    return json.dumps(PRICE if "Preisfindung" in system else LISTING, ensure_ascii=False)
+
+
+def reply_body(url: str, body: dict, text: str | None = None) -> dict:
+    text = reply_text(url, body) if text is None else text
+    usage = {"input_tokens": 500, "output_tokens": 100, "total_tokens": 600}
+    if url == "/v1/responses":
+        return {
+            "id": f"resp_{uuid.uuid4().hex}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body.get("model"),
+            "status": "completed",
+            "output": [{
+                "id": f"msg_{uuid.uuid4().hex}",
+                "type": "message",
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}]
+            }],
+            "usage": usage
+        }
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": text},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": 500, "completion_tokens": 100, "total_tokens": 600}
+    }
+
+
+def _store_file(content: bytes, filename: str, purpose: str) -> dict:
+    file_id = f"file-{uuid.uuid4().hex}"
+    _files[file_id] = {
+        "id": file_id,
+        "object": "file",
+        "bytes": len(content),
+        "created_at": int(time.time()),
+        "filename": filename,
+        "purpose": purpose,
+        "status": "processed",
+        "content": content
+    }
+    return _files[file_id]
+
+
+def _public(file: dict) -> dict:
+    return {k: v for k, v in file.items() if k != "content"}
+
+
+def _run(batch: dict):
+    # Alle Anfragen der Eingabedatei beantworten und Ausgabedatei anlegen
+    lines = []
+    for raw in _files[batch["input_file_id"]]["content"].decode().splitlines():
+        if not raw.strip():
+            continue
+        request = json.loads(raw)
+        lines.append(json.dumps({
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": request["custom_id"],
+            "response": {
+                "status_code": 200,
+                "request_id": uuid.uuid4().hex,
+                "body": reply_body(request["url"], request["body"])
+            },
+            "error": None
+        }, ensure_ascii=False))
+    output = _store_file("\n".join(lines).encode(), "output.jsonl", "batch_output")
+    batch.update({
+        "status": "completed",
+        "output_file_id": output["id"],
+        "completed_at": int(time.time()),
+        "request_counts": {"total": len(lines), "completed": len(lines), "failed": 0}
+    })
+
+
+@app.post("/v1/files")
+async def create_file(file: UploadFile = File(...), purpose: str = Form(...)):
+    return _public(_store_file(await file.read(), file.filename, purpose))
+
+
+@app.get("/v1/files/{file_id}/content")
+async def file_content(file_id: str):
+    if file_id not in _files:
+        raise HTTPException(status_code=404, detail="file not found")
+    return PlainTextResponse(_files[file_id]["content"].decode())
+
+
+@app.post("/v1/batches")
+async def create_batch(req: BatchCreate):
+    if req.input_file_id not in _files:
+        raise HTTPException(status_code=404, detail="input file not found")
+    batch_id = f"batch_{uuid.uuid4().hex}"
+    _batches[batch_id] = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": req.endpoint,
+        "input_file_id": req.input_file_id,
+        "completion_window": req.completion_window,
+        "status": "in_progress",
+        "created_at": int(time.time()),
+        "output_file_id": None,
+        "error_file_id": None,
+        "request_counts": {"total": 0, "completed": 0, "failed": 0}
+    }
+    return _batches[batch_id]
+
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str):
+    batch = _batches.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="batch not found")
+    if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= STANDIN_BATCH_DELAY:
+        _run(batch)
+    return batch
+
+
+def _direct_text(url: str, body: dict) -> str:
+    text = reply_text(url, body)
+    return faults.truncate(text) if faults.malformed() else text
+
+
+def _chunk(completion_id: str, model: str, choices: list, usage: dict | None = None) -> str:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": choices,
+        "usage": usage
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def _stream(body: dict, text: str):
+    # Text in kleinen Stücken wie ein echtes Modell, Usage zum Schluss
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    model = body.get("model")
+    yield _chunk(completion_id, model, [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+    for i in range(0, len(text), 16):
+        yield _chunk(completion_id, model, [{"index": 0, "delta": {"content": text[i:i + 16]}, "finish_reason": None}])
+    yield _chunk(completion_id, model, [{"index": 0, "delta": {}, "finish_reason": "stop"}])
+    if (body.get("stream_options") or {}).get("include_usage"):
+        yield _chunk(completion_id, model, [], {"prompt_tokens": 500, "completion_tokens": 100, "total_tokens": 600})
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/responses")
+async def create_response(request: Request):
+    body = await request.json()
+    await faults.delay()
+    if (limited := faults.rate_limited()) is not None:
+        return limited
+    return reply_body("/v1/responses", body, _direct_text("/v1/responses", body))
+
+
+@app.post("/v1/chat/completions")
+async def create_chat_completion(request: Request):
+    body = await request.json()
+    await faults.delay()
+    if (limited := faults.rate_limited()) is not None:
+        return limited
+    text = _direct_text("/v1/chat/completions", body)
+    if body.get("stream"):
+        return StreamingResponse(_stream(body, text), media_type="text/event-stream")
+    return reply_body("/v1/chat/completions", body, text)
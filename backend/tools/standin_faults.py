@@ -0,0 +1,42 @@
+import asyncio
+import os
+import random
+from fastapi.responses import JSONResponse
+
+# Gemeinsame Störungen der lokalen Stand-ins, über Umgebungsvariablen je Prozess:
+#
+#   STANDIN_LATENCY         mittlere Antwortzeit in Sekunden
+#   STANDIN_JITTER          gleichverteilte Abweichung davon (+/-) in Sekunden
+#   STANDIN_429_RATE        Anteil der Anfragen, die mit 429 und Retry-After abgelehnt werden
+#   STANDIN_MALFORMED_RATE  Anteil der Antworten mit abgeschnittenem JSON
+#   STANDIN_SEED            Startwert des Zufallsgenerators
+
+STANDIN_LATENCY = float(os.getenv("STANDIN_LATENCY", "0"))
+STANDIN_JITTER = float(os.getenv("STANDIN_JITTER", "0"))
+STANDIN_429_RATE = float(os.getenv("STANDIN_429_RATE", "0"))
+STANDIN_MALFORMED_RATE = float(os.getenv("STANDIN_MALFORMED_RATE", "0"))
+
+_random = random.Random(int(os.getenv("STANDIN_SEED", "0")))
+
+
+async def delay():
+    await asyncio.sleep(max(0.0, STANDIN_LATENCY + _random.uniform(-STANDIN_JITTER, STANDIN_JITTER)))
+
+
+def rate_limited() -> JSONResponse | None:
+    # Antwort im Format der OpenAI-Fehler, die Suche liefert dieselbe Form
+    if _random.random() >= STANDIN_429_RATE:
+        return None
+    return JSONResponse(
+        {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+        status_code=429,
+        headers={"retry-after": "1"}
+    )
+
+
+def malformed() -> bool:
+    return _random.random() < STANDIN_MALFORMED_RATE
+
+
+def truncate(text: str) -> str:
+    return text[:len(text) // 2]
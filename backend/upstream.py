@@ -0,0 +1,270 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import random
+import time
+from contextlib import asynccontextmanager, contextmanager
+from decouple import config
+from fastapi import HTTPException
+from config import CurrentConfig
+import metrics
+
+# Zugangskontrolle vor allen Upstream-Aufrufen (OpenAI, Kleinanzeigen-API).
+# Je Upstream: begrenzte Parallelität mit Prioritäts-Warteschlange fester Länge,
+# Token-Buckets für Anfragen und Tokens pro Minute, ein Circuit Breaker und
+# Wiederholungen mit exponentiellem Backoff und Jitter. Bei Überlast antwortet die
+# API schnell mit 503 und Retry-After, statt Anfragen bis zum Timeout zu stauen.
+# Die Zustände leben pro Prozess: bei mehreren uvicorn-Workern (WEB_CONCURRENCY)
+# erhält jeder Worker seinen Anteil an Parallelität und Quoten.
+
+UPSTREAM_MAX_QUEUE = config("UPSTREAM_MAX_QUEUE", default=200, cast=int)
+UPSTREAM_QUEUE_TIMEOUT = config("UPSTREAM_QUEUE_TIMEOUT", default=30.0, cast=float)
+UPSTREAM_RETRIES = config("UPSTREAM_RETRIES", default=3, cast=int)
+UPSTREAM_BACKOFF_BASE = config("UPSTREAM_BACKOFF_BASE", default=0.5, cast=float)
+UPSTREAM_BACKOFF_MAX = config("UPSTREAM_BACKOFF_MAX", default=20.0, cast=float)
+UPSTREAM_FAILURE_THRESHOLD = config("UPSTREAM_FAILURE_THRESHOLD", default=5, cast=int)
+UPSTREAM_RESET_SECONDS = config("UPSTREAM_RESET_SECONDS", default=30.0, cast=float)
+
+# Kleinere Zahl = höhere Priorität. Hintergrund-Jobs lassen Nutzeranfragen vor.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_priority = contextvars.ContextVar("upstream_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def priority(level: int):
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class UpstreamError(HTTPException):
+    def __init__(self, detail: str, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(status_code=503, detail=detail,
+                         headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+class UpstreamBusy(UpstreamError):
+    # Warteschlange voll, Wartezeit überschritten oder Wiederholungen aufgebraucht
+    pass
+
+
+class UpstreamUnavailable(UpstreamError):
+    # Circuit Breaker offen
+    pass
+
+
+def backoff(attempt: int) -> float:
+    # "Full Jitter": zufällige Wartezeit bis zur exponentiellen Obergrenze
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+
+
+def _retry_after(exc: Exception) -> float | None:
+    response = getattr(exc, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(value), UPSTREAM_BACKOFF_MAX) if value else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        # Sekunden, bis amount verfügbar ist (0 = sofort)
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, amount: float):
+        # Schätzung nachträglich korrigieren (positiv = Tokens zurückgeben)
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class CircuitBreaker:
+    # Nach threshold Fehlern in Folge offen; nach reset_seconds darf ein Probe-Aufruf durch
+    def __init__(self, threshold: int, reset_seconds: float):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def retry_after(self) -> float:
+        # 0 = Aufruf erlaubt, sonst Sekunden bis zum nächsten Versuch
+        if self.opened_at is None:
+            return 0.0
+        remaining = self.opened_at + self.reset_seconds - time.monotonic()
+        if remaining > 0:
+            return remaining
+        if self.probing:
+            return 1.0
+        self.probing = True
+        return 0.0
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def release(self):
+        # Aufruf ohne Ergebnis (abgebrochen, kein Upstream-Fehler): ein laufender
+        # Probe-Aufruf gibt die Probe frei, sonst bliebe der Breaker dauerhaft offen
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+
+class _PriorityGate:
+    # Semaphore, deren Warteschlange nach Priorität (dann Ankunft) bedient wird
+    def __init__(self, concurrency: int, max_queue: int):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self._waiters: list = []
+        self._seq = itertools.count()
+
+    async def acquire(self, level: int, timeout: float, name: str):
+        if self.active < self.concurrency and not self.waiting:
+            self.active += 1
+            return
+        if self.waiting >= self.max_queue:
+            raise UpstreamBusy(f"{name}: zu viele wartende Anfragen", UPSTREAM_BACKOFF_MAX)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (level, next(self._seq), future))
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Slot wurde gerade noch übergeben -> weiterreichen
+            if future.done() and not future.cancelled():
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                raise UpstreamBusy(f"{name}: Wartezeit überschritten", UPSTREAM_BACKOFF_MAX)
+            raise
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # Slot direkt an den nächsten Wartenden übergeben
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+def per_worker(limit: int) -> int:
+    # Gesamtlimit auf die Worker-Prozesse aufteilen (0 = kein Limit bleibt 0)
+    return max(1, limit // CurrentConfig.WORKERS) if limit else 0
+
+
+class Upstream:
+    def __init__(self, name: str, *, concurrency: int, rpm: int = 0, tpm: int = 0,
+                 max_queue: int = UPSTREAM_MAX_QUEUE):
+        self.name = name
+        self.gate = _PriorityGate(per_worker(concurrency), max_queue)
+        # 0 = kein Limit
+        self.requests = TokenBucket(per_worker(rpm)) if rpm else None
+        self.tokens = TokenBucket(per_worker(tpm)) if tpm else None
+        self.breaker = CircuitBreaker(UPSTREAM_FAILURE_THRESHOLD, UPSTREAM_RESET_SECONDS)
+
+    async def _throttle(self, tokens: int, deadline: float):
+        # Die Wartezeit auf die Quote zählt zur Wartezeit in der Schlange
+        # (UPSTREAM_QUEUE_TIMEOUT), der Slot ist dabei schon belegt
+        while True:
+            wait = max(
+                self.requests.delay(1) if self.requests else 0.0,
+                self.tokens.delay(tokens) if self.tokens and tokens else 0.0
+            )
+            if wait <= 0:
+                break
+            if time.monotonic() + wait > deadline:
+                raise UpstreamBusy(f"{self.name}: Ratenlimit erreicht", wait)
+            await asyncio.sleep(wait)
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens and tokens:
+            self.tokens.take(tokens)
+
+    def spend(self, estimated: int, actual: int | None):
+        # Tatsächlichen Verbrauch (usage) statt der Schätzung verbuchen
+        if self.tokens and actual is not None:
+            self.tokens.adjust(estimated - actual)
+
+    def refund(self, estimated: int):
+        # Fehlgeschlagener Versuch: die Schätzung zurückgeben. Die Anfrage selbst bleibt
+        # verbucht, der Upstream zählt auch abgelehnte Anfragen.
+        self.spend(estimated, 0)
+
+    @asynccontextmanager
+    async def admit(self, tokens: int = 0):
+        wait = self.breaker.retry_after()
+        if wait:
+            raise UpstreamUnavailable(f"{self.name} ist vorübergehend nicht erreichbar", wait)
+        queued = time.perf_counter()
+        deadline = time.monotonic() + UPSTREAM_QUEUE_TIMEOUT
+        await self.gate.acquire(_priority.get(), UPSTREAM_QUEUE_TIMEOUT, self.name)
+        try:
+            await self._throttle(tokens, deadline)
+            metrics.UPSTREAM_WAIT_SECONDS.observe(time.perf_counter() - queued, upstream=self.name)
+            yield
+        finally:
+            self.gate.release()
+
+    async def call(self, fn, *, tokens: int = 0, retries: int = UPSTREAM_RETRIES, transient: tuple = ()):
+        # fn wird bei vorübergehenden Fehlern (transient) wiederholt; andere Fehler
+        # gehen unverändert an den Aufrufer und zählen nicht für den Circuit Breaker
+        for attempt in range(retries + 1):
+            async with self.admit(tokens):
+                started = time.perf_counter()
+                try:
+                    result = await fn()
+                except transient as e:
+                    metrics.record_upstream(self.name, time.perf_counter() - started, "transient")
+                    self.breaker.failure()
+                    self.refund(tokens)
+                    wait = _retry_after(e) or backoff(attempt)
+                    if attempt == retries or self.breaker.open:
+                        raise UpstreamBusy(f"{self.name} überlastet: {e}", max(wait, 1.0)) from e
+                except BaseException:
+                    metrics.record_upstream(self.name, time.perf_counter() - started, "error")
+                    self.breaker.release()
+                    self.refund(tokens)
+                    raise
+                else:
+                    metrics.record_upstream(self.name, time.perf_counter() - started, "ok")
+                    self.breaker.success()
+                    return result
+            # Wartezeit außerhalb des Slots, damit andere Anfragen weiterlaufen
+            await asyncio.sleep(wait)
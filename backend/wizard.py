@@ -0,0 +1,175 @@
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from decouple import config
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+from database import ad_collection
+from models import StepStatus, WizardState
+import log
+import metrics
+
+# Zustandsübergänge der AdProcesses als einzelne, bedingte find_one_and_update-Aufrufe.
+# Ein laufender Schritt steht auf PENDING; ein zweiter Start desselben Schritts
+# (Doppelklick, paralleler Job) wird mit 409 abgelehnt, ohne Upstream-Aufrufe auszulösen.
+# Bleibt ein Schritt nach einem Absturz hängen, gilt er nach WIZARD_STEP_TIMEOUT als frei.
+
+WIZARD_STEP_TIMEOUT = config("WIZARD_STEP_TIMEOUT", default=300, cast=int)
+
+# Schritt -> Unterdokument mit status/started_at/finished_at
+STEP_FIELDS = {
+    "identification": "identification",
+    "comparables": "steps.comparables",
+    "price": "steps.price",
+    "listing": "steps.listing",
+    "pipeline": "pipeline",
+}
+
+# Schritte, die nicht gleichzeitig laufen dürfen: die Pipeline schreibt die Ergebnisse
+# aller Einzelschritte, ein paralleler Einzelschritt würde sie überschreiben (oder umgekehrt)
+_SINGLE_STEPS = ("identification", "comparables", "price", "listing")
+CONFLICTS = {step: ("pipeline",) for step in _SINGLE_STEPS}
+CONFLICTS["pipeline"] = _SINGLE_STEPS
+
+
+class StepLost(HTTPException):
+    # complete() ohne Wirkung: der Schritt wurde inzwischen neu gestartet (nach
+    # WIZARD_STEP_TIMEOUT) oder ist nicht mehr PENDING. Das Ergebnis ist verworfen.
+    def __init__(self):
+        super().__init__(status_code=409, detail="Ergebnis nicht gespeichert, Schritt wurde inzwischen neu gestartet")
+
+
+def object_id(ad_process_id: str) -> ObjectId:
+    try:
+        ad_id = ObjectId(ad_process_id)
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=400, detail="Ungültige ad_process_id")
+    # Korrelations-ID für alle weiteren Log-Einträge dieser Anfrage
+    log.bind(ad_process_id=ad_id)
+    return ad_id
+
+
+def _idle(prefix: str) -> dict:
+    # Schritt läuft nicht oder hängt seit mehr als WIZARD_STEP_TIMEOUT
+    cutoff = datetime.utcnow() - timedelta(seconds=WIZARD_STEP_TIMEOUT)
+    return {"$or": [
+        {f"{prefix}.status": {"$ne": StepStatus.PENDING}},
+        {f"{prefix}.started_at": {"$lt": cutoff}}
+    ]}
+
+
+def _idle_steps(step: str) -> dict:
+    # Der Schritt selbst und alle mit ihm unvereinbaren Schritte laufen nicht
+    return {"$and": [_idle(STEP_FIELDS[s]) for s in (step, *CONFLICTS.get(step, ()))]}
+
+
+async def _rejected(ad_id: ObjectId, step: str | None, detail: str):
+    # Nur im Fehlerfall: Grund für die abgelehnte Bedingung ermitteln
+    prefixes = [STEP_FIELDS[s] for s in (step, *CONFLICTS.get(step, ()))] if step else []
+    ad = await ad_collection.find_one({"_id": ad_id}, {f"{prefix}.status": 1 for prefix in prefixes} or {"_id": 1})
+    if ad is None:
+        raise HTTPException(status_code=404, detail="AdProcess nicht gefunden")
+    for prefix in prefixes:
+        node = ad
+        for part in prefix.split("."):
+            node = node.get(part) or {}
+        if node.get("status") == StepStatus.PENDING:
+            raise HTTPException(status_code=409, detail="Schritt läuft bereits")
+    raise HTTPException(status_code=400, detail=detail)
+
+
+async def load(ad_id: ObjectId, projection: dict | None = None) -> dict:
+    ad = await ad_collection.find_one({"_id": ad_id}, projection)
+    if not ad:
+        raise HTTPException(status_code=404, detail="AdProcess nicht gefunden")
+    return ad
+
+
+async def begin(ad_id: ObjectId, step: str, projection: dict | None = None, *,
+                require: dict | None = None, fields: dict | None = None,
+                missing: str = "Notwendige Daten fehlen") -> dict:
+    # Schritt auf PENDING setzen und die benötigten Felder in einem Aufruf lesen.
+    # require: zusätzliche Vorbedingungen (z. B. vorhandene Identifikationsdaten)
+    prefix = STEP_FIELDS[step]
+    ad = await ad_collection.find_one_and_update(
+        {"_id": ad_id, **_idle_steps(step), **(require or {})},
+        {"$set": {
+            **(fields or {}),
+            f"{prefix}.status": StepStatus.PENDING,
+            f"{prefix}.started_at": datetime.utcnow()
+        }, "$unset": {f"{prefix}.error": ""}},
+        projection=projection,
+        return_document=ReturnDocument.AFTER
+    )
+    if ad is None:
+        await _rejected(ad_id, step, missing)
+    return ad
+
+
+async def complete(ad_id: ObjectId, step: str, fields: dict, state: WizardState | str | None = None) -> bool:
+    # Ergebnis speichern, nur solange dieser Lauf den Schritt noch hält
+    prefix = STEP_FIELDS[step]
+    update = {
+        **fields,
+        f"{prefix}.status": StepStatus.DONE,
+        f"{prefix}.finished_at": datetime.utcnow()
+    }
+    if state is not None:
+        update["wizard_state"] = state
+    span = metrics.span_for(step)
+    if span is not None:
+        update.update(span.timings())
+    result = await ad_collection.update_one(
+        {"_id": ad_id, f"{prefix}.status": StepStatus.PENDING},
+        {"$set": update}
+    )
+    return result.modified_count == 1
+
+
+async def save(ad_id: ObjectId, step: str, fields: dict):
+    # Zwischenergebnis eines laufenden Schritts (Pipeline-Stufen), ebenfalls nur solange
+    # dieser Lauf den Schritt hält
+    result = await ad_collection.update_one(
+        {"_id": ad_id, f"{STEP_FIELDS[step]}.status": StepStatus.PENDING},
+        {"$set": fields}
+    )
+    if result.matched_count == 0:
+        raise StepLost()
+
+
+async def fail(ad_id: ObjectId, step: str, error, fields: dict | None = None):
+    if isinstance(error, StepLost):
+        # Der Schritt gehört einem anderen Lauf, dessen Status bleibt unberührt
+        return
+    prefix = STEP_FIELDS[step]
+    span = metrics.span_for(step)
+    if span is not None:
+        span.failed = True
+        fields = {**(fields or {}), **span.timings()}
+    await ad_collection.update_one(
+        {"_id": ad_id, f"{prefix}.status": StepStatus.PENDING},
+        {"$set": {
+            **(fields or {}),
+            f"{prefix}.status": StepStatus.ERROR,
+            f"{prefix}.error": str(getattr(error, "detail", error)),
+            f"{prefix}.finished_at": datetime.utcnow()
+        }}
+    )
+
+
+async def update(ad_id: ObjectId, fields: dict, projection: dict, *, idle: str | None = None,
+                 state: WizardState | str | None = None) -> dict:
+    # Direkte Änderung durch den Nutzer; idle: Schritt, der dabei nicht laufen darf
+    query = {"_id": ad_id}
+    if idle:
+        query.update(_idle_steps(idle))
+    if state is not None:
+        fields = {**fields, "wizard_state": state}
+    ad = await ad_collection.find_one_and_update(
+        query, {"$set": fields},
+        projection=projection,
+        return_document=ReturnDocument.AFTER
+    )
+    if ad is None:
+        await _rejected(ad_id, idle, "Änderung nicht möglich")
+    return ad